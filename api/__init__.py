@@ -72,6 +72,7 @@ from api.hearts import hearts_views
 from api.problemstatements import problem_statement_views
 
 from common.utils import safe_get_env_var
+from common.utils import outbox
 import os
 
 def create_app():
@@ -89,6 +90,9 @@ def create_app():
     app = Flask(__name__, instance_relative_config=True)
     logger.info("Started Flask")
 
+    # Slack messages and emails are queued by request handlers and sent from these threads
+    outbox.start_workers()
+
 
 
     ##########################################
@@ -2,49 +2,204 @@ from typing import *
 from PIL import Image, ImageFont, ImageDraw, ImageEnhance
 import base64
 from io import BytesIO
+from functools import lru_cache
 import os
-import openai
-import urllib
+import random
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from openai import OpenAI
+from common.utils.files import replace_when_written
+from common.utils.render_engine import in_render_process
 
 CERTIFICATE_MASK_PATH: str = "./api/certificates/assets/cert_mask_1024.png"
-BACKGROUND_SAVE_LOC: str   = "/tmp/generated_image.png"
 BACKUP_BACKGROUND_LOC: str = "./api/certificates/assets/generated_image.png"
+BACKGROUND_POOL_DIR: str   = os.getenv("CERTIFICATE_BACKGROUND_DIR", os.path.join(tempfile.gettempdir(), "certificate_backgrounds"))
+BACKGROUND_POOL_SIZE: int  = int(os.getenv("CERTIFICATE_BACKGROUND_POOL_SIZE", "5"))
+# After OpenAI fails we don't ask again for this long
+BACKGROUND_RETRY_SECONDS: int = 10 * 60
+# Render processes look for backgrounds their parent added to the directory this often
+BACKGROUND_RESCAN_SECONDS: int = 60
 
 FONT_DEFAULT: ImageFont = ImageFont.load_default()
 FONT_COLOR_DEFAULT: str = "#000000"
 
 OUT_DIRECTORY: str = "./certificates"
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+
+class BackgroundPool:
+    """
+    Certificate backgrounds, decoded and darkened once per process and handed out as copies.
+
+    Backgrounds are read from directory, where anyone can drop pre-generated pngs. While it has fewer
+    than size of them a background thread asks OpenAI for more, rendering never waits on the network
+    and uses the bundled background until the first one arrives. Only the web workers ask OpenAI,
+    render processes pick up what they generate from the directory.
+    """
+
+    def __init__(self, directory: str = BACKGROUND_POOL_DIR, size: int = BACKGROUND_POOL_SIZE, fallback: str = BACKUP_BACKGROUND_LOC):
+        self.directory = directory
+        self.size = size
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._templates: List[Image.Image] = None
+        self._loaded: Set[str] = set()
+        self._scanned_at: float = 0
+        self._fallback_template: Image.Image = None
+        self._filling = False
+        self._failed_at: float = 0
+        # A fork can happen while the fill thread holds the lock, and that thread doesn't exist in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def get(self) -> Image.Image:
+        return self.choose().copy()
+
+    def choose(self) -> Image.Image:
+        """One of the shared backgrounds, draw on a copy of it and never on it directly."""
+        return random.choice(self.warm())
+
+    def warm(self) -> List[Image.Image]:
+        """Every background there is now, loading them if this is the first time."""
+        with self._lock:
+            if self._templates is None:
+                self._templates = []
+                self._scan()
+            if len(self._templates) < self.size:
+                if in_render_process():
+                    if time.time() - self._scanned_at > BACKGROUND_RESCAN_SECONDS:
+                        self._scan()
+                elif (not self._filling and os.getenv("OPENAI_API_KEY")
+                        and time.time() - self._failed_at > BACKGROUND_RETRY_SECONDS):
+                    self._filling = True
+                    threading.Thread(target=self._fill, name="certificate backgrounds", daemon=True).start()
+            return list(self._templates) or [self._get_fallback()]
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._filling = False
+
+    def _scan(self) -> None:
+        self._scanned_at = time.time()
+        if not os.path.isdir(self.directory):
+            return
+        new = [name for name in sorted(os.listdir(self.directory)) if name.endswith(".png") and name not in self._loaded]
+        for name in new:
+            try:
+                self._templates.append(_darken(Image.open(os.path.join(self.directory, name))))
+            except OSError as e:
+                logger.warning(f"Skipping certificate background {name}: {e}")
+            self._loaded.add(name)
+        if new:
+            logger.info(f"Loaded {len(new)} certificate backgrounds from {self.directory}")
+
+    def _get_fallback(self) -> Image.Image:
+        if self._fallback_template is None:
+            self._fallback_template = _darken(Image.open(self.fallback))
+        return self._fallback_template
+
+    def _fill(self) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            while len(self._templates) < self.size:
+                path = self._generate()
+                template = _darken(Image.open(path))
+                with self._lock:
+                    self._templates.append(template)
+                    self._loaded.add(os.path.basename(path))
+        except Exception as e:
+            logger.error(f"Could not generate certificate background, using what we have: {e}")
+            self._failed_at = time.time()
+        finally:
+            self._filling = False
+
+    def _generate(self) -> str:
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        response = client.images.generate(
+            prompt="without text a mesmerizing background with geometric shapes and fireworks no text high resolution 4k",
+            n=1,
+            size="1024x1024"
+        )
+        image_url = response.data[0].url
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex}.png")
+        # Render processes rescanning the directory skip it until the download is complete
+        with replace_when_written(path) as partial:
+            urllib.request.urlretrieve(image_url, partial)
+        logger.info(f"Generated certificate background {path}")
+        return path
+
+
+def _darken(image: Image.Image) -> Image.Image:
+    image = ImageEnhance.Brightness(image).enhance(0.35)
+    # Decode now, copies of a lazily loaded image would each read the file again
+    image.load()
+    return image
+
+
+background_pool = BackgroundPool()
+
+
+@lru_cache(maxsize=None)
+def get_certificate_mask() -> Image.Image:
+    """The decoded frame pasted over every certificate, shared so it must not be drawn on."""
+    mask = Image.open(CERTIFICATE_MASK_PATH)
+    mask.load()
+    return mask
+
+
+class CertificateTemplate:
+    """
+    The parts of a certificate that are the same for everyone, drawn by draw_static onto each pool
+    background the first time it is used and kept for the life of the process.
+
+    new_certificate() copies the result, so each certificate only draws its own text. The mask is
+    still pasted last in toBytes since it covers text near the frame.
+    """
+
+    def __init__(self, draw_static: Callable[["CertificateGenerator"], None], pool: BackgroundPool = background_pool):
+        self.draw_static = draw_static
+        self.pool = pool
+        self._lock = threading.Lock()
+        # id of the background -> (background, the background with the static layers drawn on it)
+        self._compiled: Dict[int, Tuple[Image.Image, Image.Image]] = {}
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def new_certificate(self) -> "CertificateGenerator":
+        return CertificateGenerator(self._compile(self.pool.choose()).copy())
+
+    def warm(self) -> None:
+        """Draw the static layers onto every background the pool has now, e.g. as a render process starts."""
+        for background in self.pool.warm():
+            self._compile(background)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def _compile(self, background: Image.Image) -> Image.Image:
+        with self._lock:
+            compiled = self._compiled.get(id(background))
+            if compiled is None or compiled[0] is not background:
+                certGen = CertificateGenerator(background.copy())
+                self.draw_static(certGen)
+                compiled = (background, certGen.certificateTemplate)
+                self._compiled[id(background)] = compiled
+        return compiled[1]
 
 
 class CertificateGenerator:
 
-    def __init__(self):
-        self.certificateTemplate: Image = self._get_background_image()
-        enhancer = ImageEnhance.Brightness(self.certificateTemplate)
-        self.certificateTemplate = enhancer.enhance(0.35)
-        self.certificateMask: Image = Image.open(CERTIFICATE_MASK_PATH)
+    def __init__(self, background: Image.Image = None):
+        self.certificateTemplate: Image = background if background is not None else background_pool.get()
+        self.certificateMask: Image = get_certificate_mask()
         self.imageDrawer: ImageDraw = ImageDraw.Draw(self.certificateTemplate)
 
-    def _get_background_image(self) -> Image:
-        try:
-            response = openai.Image.create(
-                prompt="without text a mesmerizing background with geometric shapes and fireworks no text high resolution 4k",
-                n=1,
-                size="1024x1024"
-            )
-            image_url = response['data'][0]['url']
-            urllib.request.urlretrieve(image_url, BACKGROUND_SAVE_LOC)
-        except:
-            ...
-        
-        if (os.path.exists(BACKGROUND_SAVE_LOC)):
-            return Image.open(BACKGROUND_SAVE_LOC)
-    
-        return Image.open(BACKUP_BACKGROUND_LOC)
-
-
     def draw_multiline_text_relative(self, text: str, xPosPercentage: float, yPosPercentage: float, fontColor: str = FONT_COLOR_DEFAULT, font: ImageFont = FONT_DEFAULT, align: str = "center") -> None:
         xPosition, yPosition = self.percentageToPixelCoords(xPosPercentage, yPosPercentage)
         self.draw_multiline_text_absolute(text, xPosition, yPosition, fontColor=fontColor, font=font, align=align)
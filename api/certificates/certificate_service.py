@@ -12,19 +12,27 @@ import base64
 import hashlib
 
 # Import get_team_by_slack_channel
+from common.exceptions import InvalidInputError
 from common.utils.firebase import get_team_by_slack_channel, save_certificate, get_certficate_by_file_id, get_recent_certs_from_db
 from common.utils.cdn import upload_to_cdn
+from common.utils.render_engine import render_engine
 
 # Import QR code generator
 from api.certificates.qr_code import generate_qr_code
 
-from api.certificates.certificate import CertificateGenerator
+from api.certificates.certificate import CertificateGenerator, CertificateTemplate
 from api.certificates.scan_repo import GitFameRow, getGitFameData, GitFameTableCombined
 from api.certificates.certificate_cryptography import signCertificate, verifyCertificate
 load_dotenv()
 
 CDN_SERVER = getenv("CDN_SERVER")
 
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
 LARGE_FONT: ImageFont   = ImageFont.truetype("./api/certificates/assets/Gidole-Regular.ttf", size=25)
 SMALL_FONT: ImageFont   = ImageFont.truetype("./api/certificates/assets/Gidole-Regular.ttf", size=19)
 SMALLER_FONT: ImageFont = ImageFont.truetype("./api/certificates/assets/Gidole-Regular.ttf", size=12)
@@ -34,6 +42,33 @@ WHITE_COLOR: Tuple[int, int, int] = (255, 255, 255)
 GOLD_COLOR:  Tuple[int, int, int] = (255, 215, 0)
 BLACK_COLOR: Tuple[int, int, int] = (0, 0, 0)
 
+EX_TEXT: str = "This certifies that hard work, determination, and extreme learning are innate in this person as they volunteered their summer to help non-profits. They could have been doing anything else, but they chose to do something for their community!"
+FOOTER_TEXT: str = "Write code for social good @ ohack.dev\nFollow us on Facebook, Instagram, and Linkedin @opportunityhack"
+
+
+def _draw_static_layers(certGen: CertificateGenerator) -> None:
+    """Everything on a certificate that doesn't depend on the author or the repository."""
+    certGen.draw_multiline_text_absolute("Certificate of Achievement", 1024 // 2, 360, GOLD_COLOR, HEADER_FONT, "center")
+    certGen.draw_multiline_text_absolute("Congratulations", 1024 // 2, 405, GOLD_COLOR, LARGE_FONT, "center")
+
+    wrappedText: str = "\n".join(textwrap.wrap(EX_TEXT, width=85))
+    certGen.draw_multiline_text_absolute(wrappedText, 1024 // 2, 540, WHITE_COLOR, SMALL_FONT, "center")
+
+    certGen.draw_text_absolute("Stats", 1024 // 2, 620, WHITE_COLOR, HEADER_FONT, "center")
+
+    certGen.draw_multiline_text_absolute(FOOTER_TEXT, 1024 // 2, 890, WHITE_COLOR, SMALL_FONT, "center")
+
+
+CERTIFICATE_TEMPLATE: CertificateTemplate = CertificateTemplate(_draw_static_layers)
+
+
+def warm_certificate_template() -> None:
+    CERTIFICATE_TEMPLATE.warm()
+
+
+# Backgrounds and static layers are loaded and drawn once per render process, as it starts
+render_engine.warm_in_render_processes(warm_certificate_template)
+
 
 def get_cert_info(id):
     return get_certficate_by_file_id(id)
@@ -93,19 +128,31 @@ def generate_certificate_from_slack(slack_channel: str) -> List[str]:
     
     if "github_links" in team:
         github_links = team["github_links"]
-        return [generate_certificate_for_all_authors(link["link"]) for link in github_links]
+        return [_generate_certificate_for_link(link["link"]) for link in github_links]
 
 
     return []
 
 
+def _generate_certificate_for_link(repositoryURL: str) -> str:
+    try:
+        return generate_certificate_for_all_authors(repositoryURL)
+    except InvalidInputError as e:
+        # Teams can save any link, only GitHub repositories get certificates
+        logger.warning(f"Not generating certificates for {repositoryURL}: {e.message}")
+        return ""
+
+
 def generate_certificate_for_all_authors(repositoryURL: str) -> str:
    """ Generate certificate for each GitFameData.authors """
    gitFameData: GitFameTableCombined = getGitFameData(repositoryURL)
    
    print(f"gitFameData: {gitFameData}")
    print(f"gitFameData.authors: {gitFameData.authors}")
-   return [generate_certificate(repositoryURL, row.author) for row in gitFameData.authors]
+   certificates = [_certificate_details(repositoryURL, row.author, gitFameData) for row in gitFameData.authors]
+   # Rendered side by side in the render processes, uploaded as each one finishes
+   published = iter(render_engine.map(render_certificate, _publish_certificate, [c for c in certificates if c]))
+   return [next(published) if c else "" for c in certificates]
 
 def generate_hash(data: str) -> str:
     hash_object = hashlib.sha256(data.encode())
@@ -114,12 +161,19 @@ def generate_hash(data: str) -> str:
 
 def generate_certificate(repositoryURL: str, username: str) -> str:
     """ Automatically generate a certificate and returns the base64 representation of it"""
-    certGen: CertificateGenerator = CertificateGenerator()
-
     gitFameData: GitFameTableCombined = getGitFameData(repositoryURL)
     print(f"gitFameData: {gitFameData}")
     print(f"gitFameData.authors: {gitFameData.authors}")
 
+    certificate = _certificate_details(repositoryURL, username, gitFameData)
+    if (not certificate): return ""
+
+    certificateBytes: bytes = render_engine.render(render_certificate, certificate)
+    return _publish_certificate(certificate, certificateBytes)
+
+
+def _certificate_details(repositoryURL: str, username: str, gitFameData: GitFameTableCombined) -> Dict[str, Any]:
+    """ What goes on username's certificate and into the certificates collection, None if they aren't an author """
     authorWithEmailData: GitFameRow = None
     authorData: GitFameRow = None
 
@@ -134,64 +188,14 @@ def generate_certificate(repositoryURL: str, username: str) -> str:
 
         index += 1
 
-    if (not authorData): return ""
-
-    certGen.draw_multiline_text_absolute("Certificate of Achievement", 1024 // 2, 360, GOLD_COLOR, HEADER_FONT, "center")
-    certGen.draw_multiline_text_absolute("Congratulations", 1024 // 2, 405, GOLD_COLOR, LARGE_FONT, "center")
-    certGen.draw_multiline_text_absolute(username, 1024 // 2, 450, WHITE_COLOR, HEADER_FONT, "center")
-
-    exText = "This certifies that hard work, determination, and extreme learning are innate in this person as they volunteered their summer to help non-profits. They could have been doing anything else, but they chose to do something for their community!"
-    wrappedText: str = "\n".join(textwrap.wrap(exText, width=85))
-    certGen.draw_multiline_text_absolute(wrappedText, 1024 // 2, 540, WHITE_COLOR, SMALL_FONT, "center")
-
-    certGen.draw_text_absolute("Stats", 1024 // 2, 620, WHITE_COLOR, HEADER_FONT, "center")
-
-    stats = [
-        ["Hours", f"{authorData.hours}"],
-        ["Commits", f"{authorData.commits}"],
-        ["Lines of Code", f"{authorData.linesOfCode }"],
-        ["Files", f"{authorData.files }"],
-    ]
+    if (not authorData): return None
 
-    statsInfo: Dict[str, int | List[str]] = _get_stat_text_info(certGen, stats, LARGE_FONT)
-    _write_stat_to_certificate(certGen, statsInfo, 660, LARGE_FONT, None)
-
-    certGen.draw_text_absolute(f"∑ Team Totals | Hours: { gitFameData.totalHours } Commits: { gitFameData.totalCommits } LOC: {gitFameData.totalLinesOfCode} Files: {gitFameData.totalFiles}", 1024 // 2, 820, WHITE_COLOR, SMALL_FONT, "center")
-    
-
-
-    certGen.draw_multiline_text_absolute("Write code for social good @ ohack.dev\nFollow us on Facebook, Instagram, and Linkedin @opportunityhack", 1024 // 2, 890, WHITE_COLOR, SMALL_FONT, "center")
     # Make a short SHA file_id a hash of authorData.author, repositoryURL, authorData.commits, authorData.linesOfCode, authorData.files
 
     file_id_hash = f"{authorData.author}{repositoryURL}{authorData.commits}{authorData.linesOfCode}{authorData.files}"
     file_id = generate_hash(file_id_hash)
     az_time = datetime.now(pytz.timezone('US/Arizona'))
     iso_date = az_time.isoformat()  # Using ISO 8601 format
-    
-
-    # Generate QR code
-    qr_code_text = f"https://ohack.dev/cert/{file_id}"
-    qr_code = generate_qr_code(qr_code_text)
-    # Draw image on certificate
-    certGen.draw_image(qr_code, 1024 - 125, 1024 - 125)
-
-    bottom_text = iso_date + " | " + qr_code_text
-    certGen.draw_text_absolute(bottom_text, 1024 // 2, 1024 - 25, WHITE_COLOR, SMALLER_FONT, "center")
-    
-
-    certificateBytes: bytes = certGen.toBytes()
-    signedCertificate: bytes = signCertificate(certificateBytes)
-    certificateBase64Bytes: bytes = base64.b64encode(signedCertificate)
-    
-    # Save bytes to file
-    with open(f"certificate_{file_id}.png", "wb") as f:
-        f.write(certificateBytes)    
-
-    # Save certificate to CDN
-    file_url = upload_to_cdn("certificates", f"certificate_{file_id}.png")
-
-    # Delete file
-    remove(f"certificate_{file_id}.png")
 
     stats_json = {
         "hours": authorData.hours,
@@ -206,8 +210,7 @@ def generate_certificate(repositoryURL: str, username: str) -> str:
         "files": gitFameData.totalFiles
     }
 
-    result = {
-        "certificate_url" : file_url,
+    return {
         "author_name": username,
         "author_email" : authorWithEmailData.author,
         "stats": stats_json,
@@ -218,6 +221,58 @@ def generate_certificate(repositoryURL: str, username: str) -> str:
         "repository_url": repositoryURL        
     }
 
+
+def render_certificate(certificate: Dict[str, Any]) -> bytes:
+    """ Draw the certificate described by _certificate_details and return the png. Runs in a render process """
+    certGen: CertificateGenerator = CERTIFICATE_TEMPLATE.new_certificate()
+    certGen.draw_multiline_text_absolute(certificate["author_name"], 1024 // 2, 450, WHITE_COLOR, HEADER_FONT, "center")
+
+    authorStats = certificate["stats"]
+    stats = [
+        ["Hours", f"{authorStats['hours']}"],
+        ["Commits", f"{authorStats['commits']}"],
+        ["Lines of Code", f"{authorStats['lines_of_code']}"],
+        ["Files", f"{authorStats['files']}"],
+    ]
+
+    statsInfo: Dict[str, int | List[str]] = _get_stat_text_info(certGen, stats, LARGE_FONT)
+    _write_stat_to_certificate(certGen, statsInfo, 660, LARGE_FONT, None)
+
+    totals = certificate["totals"]
+    certGen.draw_text_absolute(f"∑ Team Totals | Hours: { totals['hours'] } Commits: { totals['commits'] } LOC: {totals['lines_of_code']} Files: {totals['files']}", 1024 // 2, 820, WHITE_COLOR, SMALL_FONT, "center")
+
+    # Generate QR code
+    qr_code_text = f"https://ohack.dev/cert/{certificate['file_id']}"
+    qr_code = generate_qr_code(qr_code_text)
+    # Draw image on certificate
+    certGen.draw_image(qr_code, 1024 - 125, 1024 - 125)
+
+    bottom_text = certificate["date"] + " | " + qr_code_text
+    certGen.draw_text_absolute(bottom_text, 1024 // 2, 1024 - 25, WHITE_COLOR, SMALLER_FONT, "center")
+
+    return certGen.toBytes()
+
+
+def _publish_certificate(certificate: Dict[str, Any], certificateBytes: bytes) -> Dict[str, Any]:
+    """ Sign, upload and save a rendered certificate. Not signed in the render process, without
+    CERTIFICATE_KEY set that would make up a key of its own """
+    file_id = certificate["file_id"]
+    signedCertificate: bytes = signCertificate(certificateBytes)
+    certificateBase64Bytes: bytes = base64.b64encode(signedCertificate)
+    
+    # Save bytes to file
+    with open(f"certificate_{file_id}.png", "wb") as f:
+        f.write(certificateBytes)    
+
+    try:
+        # Save certificate to CDN
+        file_url = upload_to_cdn("certificates", f"certificate_{file_id}.png")
+    finally:
+        # Delete file
+        remove(f"certificate_{file_id}.png")
+
+    result = {"certificate_url" : file_url, **certificate}
+
     save_certificate(result)
     return result
 
@@ -2,6 +2,7 @@ from typing import Dict
 
 from flask import Blueprint
 from flask import request
+from common.exceptions import InvalidInputError
 from api.certificates.certificate_service import generate_certificate, validateCertificate, generate_certificate_from_slack, get_cert_info, get_recent_certs
 
 bp_name = "api-certificates"
@@ -18,7 +19,10 @@ def generateCertificate():
     if ("repoURL" not in form or "username" not in form): return {}
     repoUrl: str = form["repoURL"]
     username: str = form["username"]
-    return {"img data": generate_certificate(repoUrl, username)}
+    try:
+        return {"img data": generate_certificate(repoUrl, username)}
+    except InvalidInputError as e:
+        return {"error": e.message}, 400
 
 @bp.route("/verify", methods=["POST"])
 def verifyCertificate():
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from git import Repo
+from common.utils.files import replace_when_written
+
+REPO_STATS_DIR: str = os.getenv("REPO_STATS_DIR", os.path.join(tempfile.gettempdir(), "repo_stats"))
+
+# The git-hours estimate git-fame --cost=hours used: the time between an author's surviving changes
+# counts when they are less than MAX_COMMIT_GAP_SECONDS apart, plus FIRST_COMMIT_MINUTES once
+MAX_COMMIT_GAP_SECONDS: int = 2 * 60 * 60
+FIRST_COMMIT_MINUTES: int = 120
+
+# Files with a NUL byte in their first BINARY_SNIFF_BYTES are binary, the same test git uses
+BINARY_SNIFF_BYTES: int = 8000
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+
+@dataclass
+class FileBlame:
+    blob: str
+    # author -> lines of this file they wrote that are still there
+    lines: Dict[str, int]
+    # author -> time of each blamed chunk of those lines
+    times: Dict[str, List[int]]
+
+
+@dataclass
+class RepoStats:
+    """Who wrote what in a repository at commit head, kept so the next scan only redoes what changed."""
+    head: str = ""
+    files: Dict[str, FileBlame] = field(default_factory=dict)
+    # author -> commits they made
+    commits: Dict[str, int] = field(default_factory=dict)
+    # author -> email -> commits made with it
+    emails: Dict[str, Dict[str, int]] = field(default_factory=dict)
+
+
+@dataclass
+class AuthorStats:
+    author: str
+    email: str
+    hours: float
+    linesOfCode: int
+    commits: int
+    files: int
+    # blamed chunks of surviving lines, git-fame's ctimes
+    changes: int
+
+
+def estimateHours(times: List[int]) -> float:
+    """Hours of work behind changes made at times (seconds)."""
+    times = sorted(times)
+    seconds: int = sum(gap for gap in (current - previous for previous, current in zip(times, times[1:]))
+                       if gap < MAX_COMMIT_GAP_SECONDS)
+    return (seconds / 60 + FIRST_COMMIT_MINUTES) / 60
+
+
+def _isBinary(blob) -> bool:
+    return b"\0" in blob.data_stream.read(BINARY_SNIFF_BYTES)
+
+
+def _blameFile(repo: Repo, head: str, path: str, blob: str) -> FileBlame:
+    lines: Counter = Counter()
+    times: Dict[str, List[int]] = defaultdict(list)
+    for commit, blamedLines in repo.blame(head, path):
+        lines[commit.author.name] += len(blamedLines)
+        times[commit.author.name].append(commit.authored_date)
+    return FileBlame(blob, dict(lines), dict(times))
+
+
+def updateRepoStats(repo: Repo, previous: Optional[RepoStats] = None) -> RepoStats:
+    """Blame and log repo at its HEAD, starting from previous, a scan of an earlier commit, when there is one.
+
+    Only files whose contents differ from previous are blamed again, and only commits made since
+    previous.head are read if it is an ancestor of HEAD. Anything else, e.g. a force push, reads the
+    whole history again.
+    """
+    head: str = repo.head.commit.hexsha
+    previous = previous or RepoStats()
+    if (previous.head == head): return previous
+
+    files: Dict[str, FileBlame] = {}
+    reblamed: int = 0
+    for blob in repo.head.commit.tree.traverse():
+        if (blob.type != "blob"): continue
+        known: FileBlame = previous.files.get(blob.path)
+        if (known is not None and known.blob == blob.hexsha):
+            files[blob.path] = known
+            continue
+        if (_isBinary(blob)): continue
+        files[blob.path] = _blameFile(repo, head, blob.path, blob.hexsha)
+        reblamed += 1
+
+    incremental: bool = bool(previous.head) and repo.is_ancestor(previous.head, head)
+    commits: Counter = Counter(previous.commits if incremental else {})
+    emails: Dict[str, Counter] = defaultdict(Counter)
+    if (incremental):
+        for author, counts in previous.emails.items(): emails[author].update(counts)
+
+    revisions: str = f"{previous.head}..{head}" if incremental else head
+    # Names and emails after .mailmap, blame --porcelain applies it to the names _blameFile counts too
+    for line in repo.git.log("--format=%aN%x00%aE", revisions).splitlines():
+        author, email = line.split("\0")
+        commits[author] += 1
+        emails[author][email] += 1
+
+    logger.info(f"Scanned {repo.working_dir} at {head}: blamed {reblamed} of {len(files)} files, "
+                f"{'commits since ' + previous.head if incremental else 'all commits'}")
+    return RepoStats(head, files, dict(commits), {author: dict(counts) for author, counts in emails.items()})
+
+
+def authorStats(stats: RepoStats) -> List[AuthorStats]:
+    """One row per author, most lines of code first, the way git-fame sorts them."""
+    linesOfCode: Counter = Counter()
+    files: Counter = Counter()
+    times: Dict[str, List[int]] = defaultdict(list)
+    for blame in stats.files.values():
+        for author, lines in blame.lines.items():
+            linesOfCode[author] += lines
+            files[author] += 1
+            times[author].extend(blame.times.get(author, []))
+
+    rows: List[AuthorStats] = []
+    for author in set(linesOfCode) | set(stats.commits):
+        # No email for an author with surviving lines but no commits in the log
+        emails: Dict[str, int] = stats.emails.get(author) or {"": 0}
+        rows.append(AuthorStats(
+            author,
+            max(emails, key=emails.get),
+            estimateHours(times[author]),
+            linesOfCode[author],
+            stats.commits.get(author, 0),
+            files[author],
+            len(times[author]),
+        ))
+    rows.sort(key=lambda row: (-row.linesOfCode, -row.commits, row.author))
+    return rows
+
+
+def _statsPath(repositoryURL: str) -> str:
+    return os.path.join(REPO_STATS_DIR, hashlib.sha256(repositoryURL.encode()).hexdigest() + ".json")
+
+
+def loadRepoStats(repositoryURL: str) -> Optional[RepoStats]:
+    """The last scan saved for repositoryURL by any worker, None if there is none or it can't be read."""
+    try:
+        with open(_statsPath(repositoryURL)) as f:
+            saved: dict = json.load(f)
+        saved["files"] = {path: FileBlame(**blame) for path, blame in saved["files"].items()}
+        return RepoStats(**saved)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        logger.warning(f"Ignoring saved scan of {repositoryURL}: {e}")
+        return None
+
+
+def saveRepoStats(repositoryURL: str, stats: RepoStats) -> None:
+    os.makedirs(REPO_STATS_DIR, exist_ok=True)
+    with replace_when_written(_statsPath(repositoryURL)) as partial:
+        with open(partial, "w") as f:
+            json.dump(asdict(stats), f)
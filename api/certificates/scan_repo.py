@@ -1,13 +1,20 @@
-import os
 import re
-import shutil
-import subprocess
-import uuid
 from dataclasses import dataclass
 from typing import List
 
-from git import Repo
-import json
+from git import Git
+
+from api.certificates.repo_stats import AuthorStats, RepoStats, authorStats, loadRepoStats, saveRepoStats, updateRepoStats
+from api.certificates.workspaces import repo_workspaces
+from common.exceptions import InvalidInputError
+from common.utils.cache import dependency_cached
+
+# A scan is pinned to a commit, so it only goes away to make room or after a day of nobody asking
+SCAN_CACHE_SIZE = 32
+SCAN_CACHE_TTL = 24 * 60 * 60
+
+# The only repositories we scan. URLs end up on git command lines, anything else could be an option
+REPOSITORY_URL_PATTERN = re.compile(r"https://github\.com/[A-Za-z0-9][A-Za-z0-9-]*/(?!\.\.?(?:\.git)?$)[A-Za-z0-9_.-]+")
 
 
 @dataclass
@@ -41,125 +48,75 @@ class GitFameTableCombined:
     authors: List[GitFameRow]
     authorsEmails: List[GitFameRow]
 
-def _parseTotalLine(line: str) -> int:
-    return int(re.search(r"([0-9]+)|$", line).group())
 
-
-def _parseGitFameRow(row: str) -> GitFameRow:        
-    author, hrs, linesOfCode, commits, files, linesOfCodeDist, commitsDist, filesDist = row
-    
-    return GitFameRow(
-        author,
-        round(float(hrs),1),
-        int(linesOfCode),
-        int(commits),
-        int(files),
-        float(linesOfCodeDist),
-        float(commitsDist),
-        float(filesDist)
-    )
+def validateRepositoryURL(repositoryURL: str) -> None:
+    """Raise InvalidInputError unless repositoryURL is https://github.com/<owner>/<repo>, optionally ending in .git."""
+    if (not isinstance(repositoryURL, str) or not REPOSITORY_URL_PATTERN.fullmatch(repositoryURL)):
+        raise InvalidInputError("Only https://github.com/<owner>/<repo> repositories can be scanned")
 
 
-def _parseGitFameResults(gitFameOutput: bytes) -> List[GitFameRow]:
-    gitFameStr: str = gitFameOutput.decode("UTF-8")
-    gitFameJson: dict = json.loads(gitFameStr)
-
-    '''
-    Example output:
-    {
-        "total": {
-            "loc": 79788,
-            "files": 146,
-            "ctimes": 342,
-            "commits": 172,
-            "hours": "40.0"
-        },
-        "data": [
-            ["Gabe Jimenez", 5.990555555555556, 33145, 33, 34, 41.5, 19.2, 23.3],
-            ["aitzeng", 7.089722222222222, 16061, 27, 28, 20.1, 15.7, 19.2],
-            ["David Tran", 6.433055555555556, 14770, 24, 32, 18.5, 14.0, 21.9],
-            ["Maximus Chen", 10.258055555555556, 14646, 43, 25, 18.4, 25.0, 17.1],
-            ["John Novakowski", 6.191944444444444, 1129, 35, 24, 1.4, 20.3, 16.4],
-            ["Greg V", 2.0, 32, 2, 2, 0.0, 1.2, 1.4],
-            ["Anthony Tzeng", 2.0, 5, 8, 1, 0.0, 4.7, 0.7]
-        ],
-        "columns": ["Author", "hrs", "loc", "coms", "fils", "%loc", "%coms", "%fils"]
-    }
-    '''
-
-    (totalCommits, totalCtimes, totalFiles, totalLoc, totalHours) = gitFameJson["total"]["commits"], gitFameJson["total"]["ctimes"], gitFameJson["total"]["files"], gitFameJson["total"]["loc"], round(float(gitFameJson["total"]["hours"]), 1)
-
-    tableRows: List[str] = gitFameJson["data"]
-    
-    authorInformation: List[GitFameRow] = [
-        _parseGitFameRow(row) for row in tableRows]
-    
-    return GitFameTable(
-        totalCommits,
-        totalCtimes,
-        totalFiles,
-        totalLoc,
-        totalHours,
-        authorInformation
-    )
+def _remoteHead(repoUrl: str) -> str:
+    """The commit the remote's default branch points at, without cloning it."""
+    output: str = Git().ls_remote("--", repoUrl, "HEAD")
+    return output.split()[0] if output else ""
 
 
-def _pullRepository(repoUrl: str) -> str:
-    """Downloads a remote Github repository locally."""
-    saveLoc: str = os.path.join("/tmp", f"GitPull-{uuid.uuid4()}")
-    # WARNING: Possible command injection, testing needed!
-    repo: Repo = Repo.clone_from(repoUrl, saveLoc)    
-    return saveLoc if (repo is not None) else ""
-
-
-def _runGitFame(repoLoc: str, showEmail: bool) -> GitFameTable:
-    """Scans a local repository with the GitFame tool"""
-    
-    args = ["git-fame", "--cost=hours", "--format=json"]
-    if showEmail:
-        args.append("-e")
-        
-    args.append(repoLoc)
-    result: subprocess.CompletedProcess[bytes] = subprocess.run(
-        args, stdout=subprocess.PIPE)
-    if (result.stderr):
-        return None
-    return _parseGitFameResults(result.stdout)
-
-
-def _removePulledRepo(repoLoc: str) -> None:
-    """Helper function that deletes a directory and all subfolders."""
-    shutil.rmtree(repoLoc)
-
-
-def getGitFameData(repositoryURL: str) -> GitFameTable:
-    """Pull and scan a GitHub repository using the Gitfame tool.
+def getGitFameData(repositoryURL: str) -> GitFameTableCombined:
+    """Pull a GitHub repository and work out who wrote what, the way the Gitfame tool did.
 
     Parameters:
         repositoryURL (str): a string representation of the GitHub URL to be scraped
     
     Returns:
-        A GitFameTable dataclass object containing the parsed GitFame output
+        A GitFameTableCombined dataclass object with each author's stats, served from
+        cache when the repository hasn't changed since it was last scanned
+
+    Raises InvalidInputError, before running any git command, if repositoryURL isn't a GitHub repository
     """
-    saveLoc: str = _pullRepository(repositoryURL)
-    results: GitFameTable = _runGitFame(saveLoc, False)
-
-    # FIXME: This is pretty hacky to get the email address along with the name 
-    # We run this again, but with the email flag set to True
-    # As of 12FEB2024: There is no current way to get this as a single output with git-fame
-    resultsWithEmail: GitFameTable = _runGitFame(saveLoc, True)
-
-    # Combine results and resultsWithEmail into GitFameTableCombined    
-    resultsCombined: GitFameTableCombined = GitFameTableCombined(
-        results.totalCommits,
-        results.totalCtimes,
-        results.totalFiles,
-        results.totalLinesOfCode,
-        results.totalHours,
-        results.authors,
-        resultsWithEmail.authors
+    validateRepositoryURL(repositoryURL)
+    return scanRepository(repositoryURL, _remoteHead(repositoryURL))
+
+
+def _percentage(part: int, total: int) -> float:
+    return round(100 * part / max(1, total), 1)
+
+
+def _toGitFameTable(stats: RepoStats) -> GitFameTableCombined:
+    """Lay out stats the way the git-fame JSON output used to be parsed."""
+    rows: List[AuthorStats] = authorStats(stats)
+    totalLinesOfCode: int = sum(row.linesOfCode for row in rows)
+    totalCommits: int = sum(row.commits for row in rows)
+    totalFiles: int = sum(1 for blame in stats.files.values() if blame.lines)
+
+    def gitFameRow(row: AuthorStats, author: str) -> GitFameRow:
+        return GitFameRow(
+            author,
+            round(row.hours, 1),
+            row.linesOfCode,
+            row.commits,
+            row.files,
+            _percentage(row.linesOfCode, totalLinesOfCode),
+            _percentage(row.commits, totalCommits),
+            _percentage(row.files, totalFiles)
+        )
+
+    return GitFameTableCombined(
+        totalCommits,
+        sum(row.changes for row in rows),
+        totalFiles,
+        totalLinesOfCode,
+        round(sum(row.hours for row in rows), 1),
+        [gitFameRow(row, row.author) for row in rows],
+        # Same rows in the same order with the email each author commits with most as the author
+        [gitFameRow(row, row.email) for row in rows]
     )
 
 
-    _removePulledRepo(saveLoc)
-    return resultsCombined
\ No newline at end of file
+@dependency_cached(maxsize=SCAN_CACHE_SIZE, ttl=SCAN_CACHE_TTL)
+def scanRepository(repositoryURL: str, head: str) -> GitFameTableCombined:
+    """Check out repositoryURL at head and scan it, starting from the last scan of it if there is one.
+    head keys the cache, so the scan is of head even if the remote has moved on since."""
+    with repo_workspaces.checkout(repositoryURL, head) as repo:
+        stats: RepoStats = updateRepoStats(repo, loadRepoStats(repositoryURL))
+    saveRepoStats(repositoryURL, stats)
+    return _toGitFameTable(stats)
@@ -0,0 +1,59 @@
+import pytest
+from PIL import Image
+from api.certificates import certificate
+from api.certificates.certificate import BackgroundPool, CertificateGenerator, CertificateTemplate
+
+
+def test_backgrounds_are_loaded_from_disk_once(tmp_path, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    Image.new("RGB", (1024, 1024), (200, 200, 200)).save(tmp_path / "one.png")
+    pool = BackgroundPool(directory=str(tmp_path), size=1)
+
+    first = pool.get()
+    second = pool.get()
+    assert first is not second
+    # Darkened once when loaded
+    assert first.getpixel((0, 0)) == (70, 70, 70)
+
+    # Drawing on one certificate doesn't touch the next
+    CertificateGenerator(first).draw_text_absolute("Ada", 10, 10, "#ffffff")
+    assert pool.get().getpixel((10, 10)) == (70, 70, 70)
+
+
+def test_falls_back_to_the_bundled_background_without_network(tmp_path, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    pool = BackgroundPool(directory=str(tmp_path / "missing"), size=3)
+    assert pool.get().size == (1024, 1024)
+
+
+def test_template_draws_static_layers_once_per_background(tmp_path, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    Image.new("RGB", (1024, 1024), (200, 200, 200)).save(tmp_path / "one.png")
+    drawn = []
+
+    def draw_static(certGen):
+        drawn.append(1)
+        certGen.draw_text_absolute("Congratulations", 100, 100, "#ffffff")
+
+    template = CertificateTemplate(draw_static, pool=BackgroundPool(directory=str(tmp_path), size=1))
+    first = template.new_certificate()
+    first.draw_text_absolute("Ada", 500, 500, "#ffffff")
+    second = template.new_certificate()
+
+    assert len(drawn) == 1
+    assert second.certificateTemplate.getpixel((500, 500)) == (70, 70, 70)
+    assert first.certificateTemplate.crop((0, 0, 200, 200)).tobytes() == second.certificateTemplate.crop((0, 0, 200, 200)).tobytes()
+
+
+def test_render_processes_leave_filling_to_their_parent(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "key")
+    monkeypatch.setattr(certificate, "in_render_process", lambda: True)
+    monkeypatch.setattr(certificate, "BACKGROUND_RESCAN_SECONDS", 0)
+    pool = BackgroundPool(directory=str(tmp_path), size=2)
+    monkeypatch.setattr(pool, "_generate", lambda: pytest.fail("render processes must not ask OpenAI"))
+
+    assert pool.warm() == [pool._get_fallback()]
+
+    # Generated by the parent after the fork
+    Image.new("RGB", (1024, 1024), (200, 200, 200)).save(tmp_path / "one.png")
+    assert [background.getpixel((0, 0)) for background in pool.warm()] == [(70, 70, 70)]
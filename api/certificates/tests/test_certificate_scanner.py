@@ -1,24 +1,65 @@
+from api.certificates import repo_stats, scan_repo
 from api.certificates.scan_repo import (
-    _pullRepository,
-    _removePulledRepo,
     getGitFameData, 
     GitFameTable, 
 )
+from api.certificates.workspaces import RepoWorkspaces
+from common.exceptions import InvalidInputError
+from common.utils.cache import clear_all
+from common.utils.shared_cache import SQLiteSharedCache, set_shared_cache
+from git import Actor, GitCommandError, Repo
 import pytest
-import shutil
 import os
+import re
 
+ADA = Actor("Ada", "ada@example.org")
 
-def test_pulling_removing_repo():
-    memUsageBefore: shutil._ntuple_diskusage = shutil.disk_usage(pytest.CERTIFICATE_SAVE_DIR)
-    saveLoc: str = _pullRepository(pytest.CERTIFICATE_TEST_REPO_URL)
-    assert saveLoc is not "", f"Failed to pull repository \"{pytest.CERTIFICATE_TEST_REPO_URL}\""
-    assert os.path.exists(saveLoc), f"Path \"{saveLoc}\" does not exist"
 
-    _removePulledRepo(saveLoc)
-    assert not os.path.exists(saveLoc), f"Path \"{saveLoc}\" not removed"
-    memUsageAfter: shutil._ntuple_diskusage = shutil.disk_usage(pytest.CERTIFICATE_SAVE_DIR)
-    assert memUsageBefore.free == memUsageAfter.free, f"Memory usage before / after does not match"
+def make_repo(path) -> Repo:
+    repo: Repo = Repo.init(path)
+    (path / "app.py").write_text("print('hello')\n")
+    repo.index.add(["app.py"])
+    repo.index.commit("hello", author=ADA, committer=ADA)
+    return repo
+
+
+def test_checkout_reuses_clones(tmp_path):
+    source: Repo = make_repo(tmp_path / "source")
+    workspaces = RepoWorkspaces(str(tmp_path / "workspaces"))
+    url: str = f"file://{tmp_path / 'source'}"
+
+    with workspaces.checkout(url) as repo:
+        clonePath: str = repo.git_dir
+        assert repo.head.commit == source.head.commit
+
+    head = source.index.commit("more", author=ADA, committer=ADA)
+    with workspaces.checkout(url) as repo:
+        assert repo.git_dir == clonePath
+        assert repo.head.commit.hexsha == head.hexsha
+
+
+def test_failed_clones_leave_nothing_behind(tmp_path):
+    workspaces = RepoWorkspaces(str(tmp_path / "workspaces"))
+    with pytest.raises(GitCommandError):
+        with workspaces.checkout(f"file://{tmp_path / 'missing'}"):
+            pass
+    assert [name for name in os.listdir(tmp_path / "workspaces") if not name.endswith(".lock")] == []
+
+
+def test_least_recently_used_clones_go_over_quota(tmp_path):
+    make_repo(tmp_path / "one")
+    make_repo(tmp_path / "two")
+    workspaces = RepoWorkspaces(str(tmp_path / "workspaces"), quotaBytes=1)
+
+    with workspaces.checkout(f"file://{tmp_path / 'one'}") as repo:
+        first: str = repo.working_dir
+    assert not os.path.exists(first)
+
+    with workspaces.checkout(f"file://{tmp_path / 'two'}") as repo:
+        second: str = repo.working_dir
+        # Never removed while it is being read
+        workspaces._enforceQuota()
+        assert os.path.exists(second)
 
 
 def test_scanning_reop():
@@ -28,4 +69,77 @@ def test_scanning_reop():
         if (row.author == pytest.CERTIFICATE_TEST_USERNAME):
             break
     else:
-        assert False, f"Did not get test user \"{pytest.CERTIFICATE_TEST_USERNAME}\" in table {results}"
\ No newline at end of file
+        assert False, f"Did not get test user \"{pytest.CERTIFICATE_TEST_USERNAME}\" in table {results}"
+
+
+@pytest.fixture
+def scanning(tmp_path, monkeypatch):
+    """Workspaces, saved scans and the shared cache of a test's own, and the file:// url of a repository
+    with commits by Ada and Grace. Returns the url, the repository and the list of urls cloned."""
+    monkeypatch.setattr(repo_stats, "REPO_STATS_DIR", str(tmp_path / "stats"))
+    monkeypatch.setattr(scan_repo, "REPOSITORY_URL_PATTERN", re.compile(f"file://{re.escape(str(tmp_path))}/.*"))
+    previous = set_shared_cache(SQLiteSharedCache(str(tmp_path / "cache.sqlite3")))
+    clear_all()
+
+    source = Repo.init(tmp_path / "source")
+    for name, email in [("Ada", "ada@example.org"), ("Grace", "grace@example.org")]:
+        (tmp_path / "source" / f"{name}.txt").write_text("line\n" * 10)
+        source.index.add([f"{name}.txt"])
+        source.index.commit(f"{name} was here", author=Actor(name, email), committer=Actor(name, email))
+
+    clones = []
+    workspaces = RepoWorkspaces(str(tmp_path / "workspaces"))
+    clone = workspaces._clone
+    monkeypatch.setattr(workspaces, "_clone", lambda url, path: clones.append(url) or clone(url, path))
+    monkeypatch.setattr(scan_repo, "repo_workspaces", workspaces)
+
+    yield f"file://{tmp_path / 'source'}", source, clones
+    clear_all()
+    set_shared_cache(previous)
+
+
+def test_scan_is_cached_by_head_commit(scanning):
+    url, source, clones = scanning
+
+    first = getGitFameData(url)
+    assert getGitFameData(url) == first
+    assert len(clones) == 1
+    assert [row.author for row in first.authorsEmails] == [
+        {"Ada": "ada@example.org", "Grace": "grace@example.org"}[row.author] for row in first.authors]
+
+    # A new commit is a new scan, of the same clone
+    source.index.commit("empty", author=ADA, committer=ADA)
+    assert getGitFameData(url).totalCommits == first.totalCommits + 1
+    assert len(clones) == 1
+
+
+def test_scan_is_of_the_head_it_is_cached_under(scanning, monkeypatch):
+    url, source, _ = scanning
+    head = source.head.commit.hexsha
+    first = getGitFameData(url)
+
+    # Pushed to between asking the remote for its head and fetching it
+    source.index.commit("empty", author=ADA, committer=ADA)
+    monkeypatch.setattr(scan_repo, "_remoteHead", lambda repoUrl: head)
+    scan_repo.scanRepository.cache_clear()
+    assert getGitFameData(url).totalCommits == first.totalCommits
+
+
+@pytest.mark.parametrize("url", [
+    "--upload-pack=touch /tmp/pwned;",
+    "-u touch /tmp/pwned",
+    "https://github.com/--upload-pack=x/repo",
+    "https://github.com/owner/..",
+    "ssh://github.com/owner/repo",
+    "https://github.com.evil.example/owner/repo",
+    "https://github.com/owner/repo/../../other",
+])
+def test_only_github_repositories_are_scanned(url, monkeypatch):
+    monkeypatch.setattr(scan_repo, "Git", lambda: pytest.fail("git must not run for an invalid url"))
+    with pytest.raises(InvalidInputError):
+        getGitFameData(url)
+
+
+def test_github_repository_urls_are_accepted():
+    scan_repo.validateRepositoryURL("https://github.com/opportunity-hack/backend-ohack.dev")
+    scan_repo.validateRepositoryURL("https://github.com/opportunity-hack/backend-ohack.dev.git")
@@ -0,0 +1,60 @@
+from git import Actor, Repo
+from api.certificates.repo_stats import estimateHours, updateRepoStats, authorStats
+
+ADA = Actor("Ada", "ada@example.org")
+GRACE = Actor("Grace", "grace@example.org")
+
+
+def commit(repo, path, text, author):
+    with open(f"{repo.working_dir}/{path}", "w") as f:
+        f.write(text)
+    repo.index.add([path])
+    repo.index.commit(f"{author.name} changed {path}", author=author, committer=author)
+
+
+def test_hours_count_gaps_under_two_hours_plus_a_first_commit():
+    assert estimateHours([]) == 2
+    assert estimateHours([0, 30 * 60, 10 * 60 * 60]) == 2.5
+
+
+def test_author_stats(tmp_path):
+    repo = Repo.init(tmp_path)
+    commit(repo, "app.py", "a\nb\nc\n", ADA)
+    commit(repo, "README.md", "hello\n", GRACE)
+    commit(repo, "app.py", "a\nb\nc\nd\n", GRACE)
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG\0\0\0")
+    repo.index.add(["logo.png"])
+    repo.index.commit("logo", author=ADA, committer=ADA)
+
+    rows = {row.author: row for row in authorStats(updateRepoStats(repo))}
+
+    assert (rows["Ada"].linesOfCode, rows["Ada"].commits, rows["Ada"].files) == (3, 2, 1)
+    assert (rows["Grace"].linesOfCode, rows["Grace"].commits, rows["Grace"].files) == (2, 2, 2)
+    assert rows["Grace"].email == "grace@example.org"
+
+
+def test_rescans_only_redo_what_changed(tmp_path, monkeypatch):
+    repo = Repo.init(tmp_path)
+    commit(repo, "app.py", "a\n", ADA)
+    commit(repo, "README.md", "hello\n", GRACE)
+    base = updateRepoStats(repo)
+
+    commit(repo, "app.py", "a\nb\n", GRACE)
+    blamed = []
+    blame = repo.blame
+    monkeypatch.setattr(repo, "blame", lambda rev, path: blamed.append(path) or blame(rev, path))
+    incremental = updateRepoStats(repo, base)
+
+    assert blamed == ["app.py"]
+    assert incremental == updateRepoStats(Repo(tmp_path))
+
+
+def test_lines_and_commits_are_counted_under_the_same_name_with_a_mailmap(tmp_path):
+    repo = Repo.init(tmp_path)
+    commit(repo, ".mailmap", "Ada Lovelace <ada@example.org> Ada <ada@example.org>\n", ADA)
+    commit(repo, "app.py", "a\nb\n", ADA)
+
+    rows = authorStats(updateRepoStats(repo))
+
+    assert [(row.author, row.email, row.linesOfCode, row.commits) for row in rows] == [
+        ("Ada Lovelace", "ada@example.org", 3, 2)]
@@ -0,0 +1,156 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from git import GitCommandError, InvalidGitRepositoryError, NoSuchPathError, Repo
+
+REPO_WORKSPACE_DIR: str = os.getenv("REPO_WORKSPACE_DIR", os.path.join(tempfile.gettempdir(), "repo_workspaces"))
+# Clones are deleted, least recently used first, to keep them all under this
+REPO_WORKSPACE_QUOTA_MB: int = int(os.getenv("REPO_WORKSPACE_QUOTA_MB", "2048"))
+# Clones and fetches running at once in a worker
+REPO_MAX_CLONES: int = int(os.getenv("REPO_MAX_CLONES", "2"))
+# A clone that was never finished, e.g. the worker was killed, is removed after this long
+PARTIAL_CLONE_SECONDS: int = 60 * 60
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+
+class RepoWorkspaces:
+    """
+    Clones of the repositories we scan, kept in directory and shared by every gunicorn worker.
+
+    checkout() fetches into the clone from the last time a repository was asked for instead of
+    cloning it again. Clones have no working tree, everything is read from the object database.
+    A clone that fails part way is removed, and once they take more than quotaBytes the least
+    recently used ones are removed. Each clone has a lock file so a clone is never updated or
+    removed while someone is reading it.
+    """
+
+    def __init__(self, directory: str = REPO_WORKSPACE_DIR, quotaBytes: int = REPO_WORKSPACE_QUOTA_MB * 1024 * 1024,
+                 maxClones: int = REPO_MAX_CLONES):
+        self.directory = directory
+        self.quotaBytes = quotaBytes
+        self._clones = threading.BoundedSemaphore(maxClones)
+
+    def _path(self, repoUrl: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(repoUrl.encode()).hexdigest())
+
+    @contextmanager
+    def _locked(self, path: str, blocking: bool = True) -> Iterator[bool]:
+        with open(f"{path}.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextmanager
+    def checkout(self, repoUrl: str, commit: Optional[str] = None) -> Iterator[Repo]:
+        """A clone of repoUrl's default branch as it is on the remote now, or at commit when given, for the
+        duration of the with block."""
+        os.makedirs(self.directory, exist_ok=True)
+        path: str = self._path(repoUrl)
+        with self._locked(path):
+            repo: Repo = self._update(repoUrl, path)
+            if (commit): self._moveTo(repo, commit)
+            # The lock file's mtime is when the clone was last used
+            os.utime(f"{path}.lock")
+            try:
+                yield repo
+            finally:
+                repo.close()
+        self._enforceQuota()
+
+    def _update(self, repoUrl: str, path: str) -> Repo:
+        if os.path.isdir(path):
+            try:
+                repo: Repo = Repo(path)
+            except (InvalidGitRepositoryError, NoSuchPathError) as e:
+                logger.warning(f"The clone of {repoUrl} is broken, cloning it again: {e}")
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                with self._clones:
+                    # Follows force pushes and a renamed default branch too
+                    repo.git.fetch("--no-tags", "origin", "HEAD")
+                    repo.git.update_ref("HEAD", "FETCH_HEAD")
+                return repo
+        return self._clone(repoUrl, path)
+
+    def _moveTo(self, repo: Repo, commit: str) -> None:
+        try:
+            repo.git.cat_file("-e", f"{commit}^{{commit}}")
+        except GitCommandError:
+            # The default branch moved on since commit and no longer contains it, e.g. a force push
+            with self._clones:
+                repo.git.fetch("--no-tags", "origin", commit)
+        repo.git.update_ref("HEAD", commit)
+
+    def _clone(self, repoUrl: str, path: str) -> Repo:
+        self._enforceQuota()
+        partial: str = f"{path}.partial-{uuid.uuid4().hex}"
+        try:
+            with self._clones:
+                # WARNING: Possible command injection, testing needed!
+                # Only the default branch is scanned. Its whole history is needed for commit counts and hours
+                Repo.clone_from(repoUrl, partial, single_branch=True, no_tags=True, no_checkout=True).close()
+            os.replace(partial, path)
+        finally:
+            shutil.rmtree(partial, ignore_errors=True)
+        logger.info(f"Cloned {repoUrl} into {path}")
+        return Repo(path)
+
+    def _enforceQuota(self) -> None:
+        workspaces: List[Tuple[float, int, str]] = []
+        for name in os.listdir(self.directory):
+            path: str = os.path.join(self.directory, name)
+            try:
+                if ".partial-" in name:
+                    if time.time() - os.path.getmtime(path) > PARTIAL_CLONE_SECONDS:
+                        logger.info(f"Removing abandoned clone {path}")
+                        shutil.rmtree(path, ignore_errors=True)
+                elif os.path.isdir(path) and os.path.exists(f"{path}.lock"):
+                    workspaces.append((os.path.getmtime(f"{path}.lock"), _size(path), path))
+            except OSError:
+                # Removed by another worker while we were looking
+                continue
+
+        total: int = sum(size for _, size, _ in workspaces)
+        for _, size, path in sorted(workspaces):
+            if total <= self.quotaBytes:
+                break
+            with self._locked(path, blocking=False) as locked:
+                # In use, it will be considered again after the next checkout
+                if not locked:
+                    continue
+                logger.info(f"Removing clone {path} ({size // (1024 * 1024)} MB), clones are over quota")
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def _size(path: str) -> int:
+    total: int = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+repo_workspaces = RepoWorkspaces()
@@ -2,6 +2,8 @@ from flask import (
     Blueprint, request, jsonify
 )
 from werkzeug import exceptions
+import math
+from common.exceptions import RateLimitExceededError
 
 bp_name = 'exceptions'
 bp = Blueprint(bp_name, __name__)
@@ -21,3 +23,9 @@ def _handle_not_found_error(ex):
         return {"message": "Not Found"}, ex.code
     else:
         return ex
+
+
+@bp.app_errorhandler(RateLimitExceededError)
+def _handle_rate_limit_exceeded(ex):
+    retry_after = math.ceil(ex.retry_after) if ex.retry_after else 60
+    return {"message": ex.message}, 429, {"Retry-After": str(retry_after)}
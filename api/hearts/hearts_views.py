@@ -1,5 +1,6 @@
 from model.user import User
-from services import hearts_service
+from services import hearts_service, heart_awards_service
+from common.exceptions import InvalidInputError
 from common.utils import safe_get_env_var
 from common.auth import auth, auth_user
 
@@ -19,9 +20,11 @@ bp = Blueprint(bp_name, __name__, url_prefix=bp_url_prefix)
 @auth.require_user
 def get_hearts():         
     print("get_hearts")   
-    res = hearts_service.get_hearts_for_all_users()
-    print(f"res: {res}")
-    return {"hearts": res}
+    # Optional paging, e.g. ?limit=10 for the top 10
+    limit = request.args.get("limit", type=int)
+    offset = request.args.get("offset", default=0, type=int)
+    res = hearts_service.get_hearts_for_all_users(limit=limit, offset=offset)
+    return {"hearts": res, "total": hearts_service.count_hearts_for_all_users()}
 
 def getOrgId(req):
     # Get the org_id from the req
@@ -37,3 +40,38 @@ def save_hearts():
         return {"hearts": res}
     else:
         return "Error: Could not obtain user details for POST /hearts"
+
+
+# Give hearts to many people at once, e.g. after judging. Send JSON {"awards": [{"slackUsername", "amount", "reasons"}]}
+# or a CSV with a slackUsername,amount,reasons header (reasons separated by ;). Returns a job id to poll.
+@bp.route("/hearts/bulk", methods=["POST"])
+@auth.require_org_member_with_permission("heart.admin", req_to_org_id=getOrgId)
+def save_hearts_bulk():
+    if not (auth_user and auth_user.user_id):
+        return "Error: Could not obtain user details for POST /hearts/bulk"
+
+    try:
+        if request.mimetype == "text/csv":
+            awards = heart_awards_service.parse_heart_awards_csv(request.get_data(as_text=True))
+            options = request.args
+        else:
+            json = request.get_json(silent=True) or {}
+            awards = heart_awards_service.validate_heart_awards(json.get("awards"))
+            options = json
+    except InvalidInputError as e:
+        return {"error": e.message}, 400
+
+    res = heart_awards_service.start_bulk_heart_award(
+        auth_user.user_id, awards,
+        create_certificate_image=str(options.get("create_certificate_image", True)).lower() != "false",
+        generate_backround_image=str(options.get("generate_backround_image", False)).lower() == "true")
+    return res, 202
+
+
+@bp.route("/hearts/bulk/<job_id>", methods=["GET"])
+@auth.require_org_member_with_permission("heart.admin", req_to_org_id=getOrgId)
+def get_hearts_bulk(job_id):
+    res = heart_awards_service.get_bulk_heart_award(job_id)
+    if res is None:
+        return {"error": "Job not found"}, 404
+    return res
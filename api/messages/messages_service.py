@@ -1,5 +1,5 @@
 from common.utils import safe_get_env_var
-from common.utils.slack import send_slack_audit, create_slack_channel, send_slack, invite_user_to_channel, get_user_info
+from common.utils.slack import send_slack_audit, create_slack_channel, send_slack, invite_user_to_channel, invite_users_to_channel, get_user_info
 from common.utils.firebase import get_hackathon_by_event_id, upsert_news, upsert_praise, get_github_contributions_for_user,get_volunteer_from_db_by_event, get_user_by_user_id, get_recent_praises, get_praises_by_user_id
 from common.utils.openai_api import generate_and_save_image_to_cdn
 from common.utils.github import create_github_repo, get_all_repos, validate_github_username
@@ -22,14 +22,16 @@ import requests
 from common.utils.validators import validate_email, validate_url, validate_hackathon_data
 from common.exceptions import InvalidInputError
 
-from cachetools import cached, LRUCache, TTLCache
-from cachetools.keys import hashkey
 
-from ratelimit import limits
+from common.utils.rate_limit import limits
 from datetime import datetime, timedelta
 import os
 
 from db.db import fetch_user_by_user_id, get_user_doc_reference
+from common.utils.firestore_loader import DocumentLoader, flatten_references, ref_collection
+from common.utils.doc_cache import document_cache
+from common.utils.cache import dependency_cached, invalidate_documents, record_dependency, record_collection_dependency, clear_all
+from common.utils.outbox import enqueue, task
 import resend
 import random
 
@@ -66,9 +68,6 @@ def get_admin_message():
         "This is an admin message."
     )
 
-def hash_key(docid, doc=None, depth=0):
-    return hashkey(docid)
-
 def log_execution_time(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
@@ -81,86 +80,40 @@ def log_execution_time(func):
     return wrapper
 
 # Generically handle a DocumentSnapshot or a DocumentReference
-#@cached(cache=TTLCache(maxsize=1000, ttl=43200), key=hash_key)
-@cached(cache=LRUCache(maxsize=640*1024), key=hash_key)
+# Documents are cached per (collection, id) in document_cache, see common/utils/doc_cache.py
 def doc_to_json(docid=None, doc=None, depth=0):
-    # Log
-    logger.debug(f"doc_to_json start docid={docid} doc={doc}")
-        
     if not docid:
         logger.debug("docid is NoneType")
         return
     if not doc:
         logger.debug("doc is NoneType")
         return
-        
-    # Check if type is DocumentSnapshot
+
+    # Check if type is DocumentSnapshot - we already have fresh data so refresh the cache with it
     if isinstance(doc, firestore.DocumentSnapshot):
-        logger.debug("doc is DocumentSnapshot")
+        collection = ref_collection(doc.reference)
+        record_dependency(collection, docid)
         d_json = doc.to_dict()
-    # Check if type is DocumentReference
+    # Check if type is DocumentReference - only go to Firestore on a cache miss
     elif isinstance(doc, firestore.DocumentReference):
-        logger.debug("doc is DocumentReference")
-        d = doc.get()
-        d_json = d.to_dict()    
-    else:        
+        collection = ref_collection(doc)
+        record_dependency(collection, docid)
+        cached_json = document_cache.get(collection, docid)
+        if cached_json is not None:
+            return cached_json
+        d_json = doc.get().to_dict()
+    else:
         return doc
-    
+
     if d_json is None:
-        logger.warn(f"doc.to_dict() is NoneType | docid={docid} doc={doc}")
+        logger.warning(f"doc.to_dict() is NoneType | docid={docid} doc={doc}")
         return
 
-    # If any values in d_json is a list, add only the document id to the list for DocumentReference or DocumentSnapshot
-    for key, value in d_json.items():
-        if isinstance(value, list):
-            logger.debug(f"doc_to_json - key={key} value={value}")
-            for i, v in enumerate(value):
-                logger.debug(f"doc_to_json - i={i} v={v}")
-                if isinstance(v, firestore.DocumentReference):
-                    logger.debug(f"doc_to_json - v is DocumentReference")
-                    value[i] = v.id
-                elif isinstance(v, firestore.DocumentSnapshot):
-                    logger.debug(f"doc_to_json - v is DocumentSnapshot")
-                    value[i] = v.id
-                else:
-                    logger.debug(f"doc_to_json - v is not DocumentReference or DocumentSnapshot")
-                    value[i] = v
-            d_json[key] = value
-    
-            
-    
-    d_json["id"] = docid
-    return d_json
-
-
+    # Replace any DocumentReference or DocumentSnapshot (including inside lists) with only the document id
+    flatten_references(d_json)
 
-
-# handle DocumentReference or DocumentSnapshot and recursefuly call doc_to_json
-def doc_to_json_recursive(doc=None):
-    # Log
-    logger.debug(f"doc_to_json_recursive start doc={doc}")          
-    
-    if not doc:
-        logger.debug("doc is NoneType")
-        return
-        
-    docid = ""
-    # Check if type is DocumentSnapshot
-    if isinstance(doc, DocumentSnapshot):
-        logger.debug("doc is DocumentSnapshot")
-        d_json = doc_to_json(docid=doc.id, doc=doc)
-        docid = doc.id
-    # Check if type is DocumentReference
-    elif isinstance(doc, DocumentReference):
-        logger.debug("doc is DocumentReference")
-        d = doc.get()
-        docid = d.id
-        d_json = doc_to_json(docid=doc.id, doc=d)               
-    else:
-        logger.debug(f"Not DocumentSnapshot or DocumentReference, skipping - returning: {doc}")
-        return doc
-    
     d_json["id"] = docid
+    document_cache.set(collection, docid, d_json)
     return d_json
 
 
@@ -168,8 +121,8 @@ def get_db():
     #mock_db = MockFirestore()
     return firestore.client()
 
-@cached(cache=TTLCache(maxsize=100, ttl=600))
 @limits(calls=2000, period=ONE_MINUTE)
+@dependency_cached(maxsize=100, ttl=600)
 def get_single_hackathon_id(id):
     logger.debug(f"get_single_hackathon_id start id={id}")    
     db = get_db()      
@@ -186,8 +139,8 @@ def get_single_hackathon_id(id):
         return result
     return {}
 
-@cached(cache=TTLCache(maxsize=100, ttl=600))
 @limits(calls=2000, period=ONE_MINUTE)
+@dependency_cached(maxsize=100, ttl=600)
 def get_volunteer_by_event(event_id, volunteer_type):
     logger.debug(f"get {volunteer_type} start event_id={event_id}")   
 
@@ -205,23 +158,25 @@ def get_volunteer_by_event(event_id, volunteer_type):
         return results
 
 
-@cached(cache=TTLCache(maxsize=100, ttl=600))
 @limits(calls=2000, period=ONE_MINUTE)
+@dependency_cached(maxsize=100, ttl=600)
 def get_single_hackathon_event(hackathon_id):
     logger.debug(f"get_single_hackathon_event start hackathon_id={hackathon_id}")    
     result = get_hackathon_by_event_id(hackathon_id)
     
     if result is None:
+        # Looked up by event_id, so any hackathon being saved could be this one
+        record_collection_dependency("hackathons")
         logger.warning("get_single_hackathon_event end (no results)")
         return {}
     else:                  
-        if "nonprofits" in result:           
-            result["nonprofits"] = [doc_to_json(doc=npo, docid=npo.id) for npo in result["nonprofits"]]   
-        else:
+        record_dependency("hackathons", result["id"])
+        # Resolve all nonprofits and teams for the event with a single get_all
+        loader = DocumentLoader(get_db())
+        result = loader.load(result, expand=["nonprofits", "teams"])
+        if "nonprofits" not in result:
             result["nonprofits"] = []
-        if "teams" in result:
-            result["teams"] = [doc_to_json(doc=team, docid=team.id) for team in result["teams"]]        
-        else:
+        if "teams" not in result:
             result["teams"] = []
 
         logger.info(f"get_single_hackathon_event end (with result):{result}")
@@ -248,10 +203,14 @@ def get_single_npo(npo_id):
     return {}
 
 
+# Served from cache and refreshed in the background once a minute, saves evict it right away
 @limits(calls=200, period=ONE_MINUTE)
+@dependency_cached(maxsize=10, ttl=3600, refresh_after=60)
 def get_hackathon_list(is_current_only=None):
     logger.debug("Hackathon List Start")
     db = get_db()
+    # A new hackathon can show up in any of these queries
+    record_collection_dependency("hackathons")
     
     if is_current_only == "current":                
         today = datetime.now()        
@@ -278,31 +237,8 @@ def get_hackathon_list(is_current_only=None):
         return {[]}
     else:
         logger.debug("Found results, processing...")
-        results = []
-        for doc in docs:
-            logger.debug(f"Processing doc {doc.id}")
-            d = doc_to_json(doc.id, doc)            
-            # If any value from the keys is a DocumentReference or DocumentSnapshot, call doc_to_json
-            for key in d.keys():
-                logger.debug(f"Checking key {key}")
-                #print type of key
-                logger.debug(f"Type of key {type(d[key])}")
-                
-                # If type is list, iterate through list and call doc_to_json
-                if isinstance(d[key], list):
-                    logger.debug(f"Found list for key {key}...")
-                    # Process all items in list and convert with doc_to_json if they are DocumentReference or DocumentSnapshot
-                    for i in range(len(d[key])):
-                        logger.debug(f"Processing list item {i}: {d[key][i]}")
-                        d[key][i] = doc_to_json_recursive(d[key][i])
-                                                                        
-                # If type is DocumentReference or DocumentSnapshot, call doc_to_json
-                elif isinstance(d[key], DocumentReference) or isinstance(d[key], DocumentSnapshot):
-                    logger.debug(f"Found DocumentReference or DocumentSnapshot for key {key}...")
-                    d[key] = doc_to_json_recursive(d[key])
-                    
-                              
-            results.append(d)     
+        loader = DocumentLoader(db)
+        results = loader.load_all(list(docs))
 
     num_results = len(results)
     logger.debug(f"Found {num_results} results")
@@ -342,7 +278,7 @@ def get_teams_list(id=None):
             return { "teams": results }
 
 @limits(calls=2000, period=THIRTY_SECONDS)
-@cached(cache=TTLCache(maxsize=100, ttl=600), key=lambda id: id)
+@dependency_cached(maxsize=100, ttl=600, key=lambda id: id)
 @log_execution_time
 def get_team(id):
     if id is None:
@@ -350,6 +286,8 @@ def get_team(id):
         return {"team": {}}
 
     logger.debug(f"Fetching team with id={id}")
+    # Also covers caching a team that doesn't exist yet
+    record_dependency("teams", id)
     
     db = get_db()
     doc_ref = db.collection('teams').document(id)
@@ -371,29 +309,72 @@ def get_team(id):
     finally:
         logger.debug(f"get_team operation completed for id={id}")
 
+MAX_TEAMS_PER_BATCH = 100
+
+@limits(calls=2000, period=THIRTY_SECONDS)
+@log_execution_time
 def get_teams_batch(json):
-    # Handle json["team_ids"] will have a list of teamids
+    # json["team_ids"] is a list of team ids, json["expand_users"] optionally replaces user ids with the users
+    if not isinstance(json, dict):
+        return {"error": "Expected a JSON object with team_ids"}, 400
+    team_ids = json.get("team_ids")
+    if not isinstance(team_ids, list):
+        return {"error": "team_ids must be a list of team ids"}, 400
+    if len(team_ids) > MAX_TEAMS_PER_BATCH:
+        return {"error": f"At most {MAX_TEAMS_PER_BATCH} team ids can be requested at once"}, 400
+
+    team_ids = list(dict.fromkeys(t for t in team_ids if isinstance(t, str) and t))
+    expand_users = json.get("expand_users", False) is True
+    logger.debug(f"get_teams_batch team_ids={team_ids} expand_users={expand_users}")
 
-    if "team_ids" not in json:
-        logger.info(json["team_ids"])
-        # TODO: Return for a batch of team ids to speed up the frontend
+    db = get_db()
+    loader = DocumentLoader(db)
+
+    # Only the teams get_team doesn't already have cached are read, with a single get_all
+    def load_teams(missing_ids):
+        snapshots = loader.get_many([db.collection('teams').document(team_id) for team_id in missing_ids])
+        loaded = {}
+        for team_id, snapshot in zip(missing_ids, snapshots):
+            # Same as get_team, missing teams are cached as {}
+            team = doc_to_json(docid=snapshot.id, doc=snapshot) if snapshot is not None else {}
+            loaded[team_id] = (team, {("teams", team_id)})
+        return loaded
+
+    teams = get_team.get_many(team_ids, load_teams)
+    teams = {team_id: team for team_id, team in teams.items() if team}
+
+    if expand_users:
+        user_ids = list(dict.fromkeys(u for team in teams.values() for u in team.get("users", [])))
+        users = {}
+        for snapshot in loader.get_many([db.collection('users').document(user_id) for user_id in user_ids]):
+            if snapshot is not None:
+                users[snapshot.id] = public_user_fields(snapshot)
+
+        # The cached teams are shared, expand copies of them
+        teams = {
+            team_id: {**team, "users": [users[u] for u in team.get("users", []) if u in users]}
+            for team_id, team in teams.items()
+        }
 
+    logger.debug(f"get_teams_batch found {len(teams)} of {len(team_ids)} teams")
+    return {"teams": teams}
 
-      
 
+
+# Served from cache and refreshed in the background once a minute, saves evict it right away
 @limits(calls=20, period=ONE_MINUTE)
+@dependency_cached(maxsize=10, ttl=3600, refresh_after=60)
 def get_npo_list(word_length=30):
     logger.debug("NPO List Start")
     db = get_db()  
+    record_collection_dependency("nonprofits")
     # steam() gets all records
     docs = db.collection('nonprofits').order_by( "rank" ).stream()
     if docs is None:
         return {[]}
     else:                
-        results = []
-        for doc in docs:
-            logger.debug(f"Processing doc {doc.id} {doc}")
-            results.append(doc_to_json_recursive(doc=doc))
+        loader = DocumentLoader(db)
+        results = loader.load_all(list(docs))
            
     # log result
     logger.debug(f"Found {len(results)} results {results}")
@@ -494,14 +475,10 @@ def save_team(propel_user_id, json):
     logger.info(f"Creating slack channel {slack_channel}")
     create_slack_channel(slack_channel)
 
-    logger.info(f"Inviting user {slack_user_id} to slack channel {slack_channel}")
-    invite_user_to_channel(slack_user_id, slack_channel)
-    
-    # Add all Slack admins too  
+    # Invite the creator and all Slack admins too, in one call
     slack_admins = ["UC31XTRT5", "UCQKX6LPR", "U035023T81Z", "UC31XTRT5", "UC2JW3T3K", "UPD90QV17", "U05PYC0LMHR"]
-    for admin in slack_admins:
-        logger.info(f"Inviting admin {admin} to slack channel {slack_channel}")
-        invite_user_to_channel(admin, slack_channel)
+    logger.info(f"Inviting user {slack_user_id} and admins {slack_admins} to slack channel {slack_channel}")
+    invite_users_to_channel([slack_user_id] + slack_admins, slack_channel)
 
     # Send a slack message to the team channel
     slack_message = f'''
@@ -583,9 +560,9 @@ Let's make a difference! :muscle: :heart:
         "teams" : new_teams
     }, merge=True)
 
-    # Clear the cache
-    logger.info(f"Clearing cache for event_id={hackathon_db_id} problem_statement_id={problem_statement_id} user_doc.id={user_doc.id} doc_id={doc_id}")
-    clear_cache()
+    # Evict only what read the documents we just wrote
+    logger.info(f"Invalidating cache for event_id={hackathon_db_id} problem_statement_id={problem_statement_id} user_doc.id={user_doc.id} doc_id={doc_id}")
+    invalidate_documents(("teams", doc_id), ("users", user_doc.id), ("hackathons", hackathon_db_id))
 
     # get the team from get_teams_list
     team = get_teams_list(doc_id)
@@ -665,10 +642,8 @@ def join_team(propel_user_id, json):
         logger.error(f"Error in join_team: {str(e)}")
         return Message(f"Error: {str(e)}")
 
-    # Clear caches
-    get_team.cache_clear()
-    get_user_by_id_old.cache_clear()
-    doc_to_json.cache_clear()
+    # Evict only what read the team and the user
+    invalidate_documents(("teams", team_id), ("users", userid))
 
     logger.debug("Join Team End")
     return Message(message)
@@ -734,10 +709,8 @@ def unjoin_team(propel_user_id, json):
         logger.error(f"Error in unjoin_team: {str(e)}")
         return Message(f"Error: {str(e)}")
 
-    # Clear caches
-    get_team.cache_clear()
-    get_user_by_id_old.cache_clear()
-    doc_to_json.cache_clear()
+    # Evict only what read the team and the user
+    invalidate_documents(("teams", team_id), ("users", userid))
 
     logger.debug("Unjoin Team End")
     return Message(message)
@@ -754,10 +727,9 @@ def update_npo_application( application_id, json, propel_id):
                          message="Updating", payload=doc_dict)
         doc.update(json)
     
-    # Clear cache for get_npo_applications
-    logger.info(f"Clearing cache for application_id={application_id}")    
+    logger.info(f"Invalidating cache for application_id={application_id}")    
 
-    clear_cache()
+    invalidate_documents(("project_applications", application_id))
 
     return Message(
         "Updated NPO Application"
@@ -935,8 +907,7 @@ def save_npo(json):
         logger.info(f"NPO Save - Successfully saved nonprofit: {new_npo_ref.id}")
         send_slack_audit(action="save_npo", message="Saved successfully", payload={"id": new_npo_ref.id})
 
-        # Clear cache
-        clear_cache()
+        invalidate_documents(("nonprofits", new_npo_ref.id))
 
         return Message(f"Saved NPO with ID: {new_npo_ref.id}")
 
@@ -948,9 +919,8 @@ def save_npo(json):
         return Message("An unexpected error occurred while saving the NPO", status="error")
 
 def clear_cache():
-    doc_to_json.cache_clear()
-    get_single_hackathon_event.cache_clear()
-    get_single_hackathon_id.cache_clear()
+    # Prefer invalidate_documents() for the documents that were written, this empties everything
+    clear_all()
     
 
 @limits(calls=100, period=ONE_MINUTE)
@@ -962,6 +932,7 @@ def remove_npo(json):
     if doc:
         send_slack_audit(action="remove_npo", message="Removing", payload=doc.get().to_dict())
         doc.delete()
+        invalidate_documents(("nonprofits", doc_id))
 
     # TODO: Add a way to track what has been deleted
     # Either by calling Slack or by using another DB/updating the DB with a hidden=True flag, etc.
@@ -1000,7 +971,7 @@ def link_problem_statements_to_events(json):
             "events": eventObsList
         });
         
-    clear_cache()
+    invalidate_documents(*[("problem_statements", problemId) for problemId in data])
 
     return Message(
         "Updated Problem Statement to Event Associations"
@@ -1065,8 +1036,7 @@ def update_npo(json):
         logger.debug("NPO Edit - Update successful")
         send_slack_audit(action="update_npo", message="Update successful", payload=update_data)
 
-        # Clear cache
-        clear_cache()
+        invalidate_documents(("nonprofits", doc_id))
 
         return Message("Updated NPO")
     else:
@@ -1268,11 +1238,8 @@ def save_hackathon(json_data, propel_id):
         transaction = db.transaction()
         update_hackathon(transaction)
 
-        # Clear cache for get_single_hackathon_event
-        get_single_hackathon_event.cache_clear()
-
-        # Clear cache for get_hackathon_list
-        doc_to_json.cache_clear()
+        # Only the saved hackathon document changed
+        invalidate_documents(("hackathons", doc_id))
 
 
         logger.info(f"Hackathon {'updated' if is_update else 'created'} successfully. ID: {doc_id}")
@@ -1354,7 +1321,7 @@ def save_praise(json):
     return Message("Saved praise")
 
 
-@cached(cache=TTLCache(maxsize=100, ttl=600))
+@dependency_cached(maxsize=100, ttl=600)
 def get_all_praises():    
     # Get the praises about user with user_id
     results = get_recent_praises()
@@ -1376,7 +1343,7 @@ def get_all_praises():
     logger.info(f"Here are the 20 most recently written praises: {results}")
     return Message(results)    
 
-@cached(cache=TTLCache(maxsize=100, ttl=600))
+@dependency_cached(maxsize=100, ttl=600)
 def get_praises_about_user(user_id):
     
     # Get the praises about user with user_id
@@ -1438,13 +1405,8 @@ async def save_lead(json):
         slack_message = f"New lead! Name:`{json['name']}` Email:`{json['email']}`"
         send_slack(slack_message, "ohack-dev-leads")
 
-        success_send_email = send_welcome_email( json["name"], json["email"] )
-        if success_send_email:
-            logger.info(f"Sent welcome email to {json['email']}")
-            # Update db to add when email was sent
-            collection.document(insert_res[1].id).update({
-                "welcome_email_sent": datetime.now().isoformat()
-            })
+        # welcome_email_sent is set on the lead once the email has actually gone out
+        send_welcome_email(json["name"], json["email"], lead_id=insert_res[1].id)
         return True
 
 # Create an event loop and run the save_lead function asynchronously
@@ -1489,16 +1451,14 @@ def send_welcome_emails():
         logger.info(f"Sending welcome email to '{lead_dict['name']}' {email} for {lead.id}")
 
         if send_email:
-            success_send_email = send_welcome_email(lead_dict["name"], email)
-            if success_send_email:
-                logger.info(f"Sent welcome email to {email}")
-                # Update db to add when email was sent
-                lead.reference.update({
-                    "welcome_email_sent": datetime.now().isoformat()
-                })
+            send_welcome_email(lead_dict["name"], email, lead_id=lead.id)
         emails.add(email)
 
-def send_nonprofit_welcome_email(organization_name, contact_name, email):    
+def send_nonprofit_welcome_email(organization_name, contact_name, email):
+    enqueue("email.nonprofit_welcome", organization_name=organization_name, contact_name=contact_name, email=email)
+
+@task("email.nonprofit_welcome")
+def deliver_nonprofit_welcome_email(organization_name, contact_name, email):    
     resend.api_key = os.getenv("RESEND_WELCOME_EMAIL_KEY")
 
     subject = "Welcome to Opportunity Hack: Tech Solutions for Your Nonprofit!"
@@ -1584,7 +1544,11 @@ def send_nonprofit_welcome_email(organization_name, contact_name, email):
     logger.info(f"Sent nonprofit application email to {email}")
     return True
 
-def send_welcome_email(name, email):    
+def send_welcome_email(name, email, lead_id=None):
+    enqueue("email.welcome", name=name, email=email, lead_id=lead_id)
+
+@task("email.welcome")
+def deliver_welcome_email(name, email, lead_id=None):    
     resend.api_key = os.getenv("RESEND_WELCOME_EMAIL_KEY")
 
     subject = "Welcome to Opportunity Hack: Code for Good!"
@@ -1655,10 +1619,20 @@ def send_welcome_email(name, email):
     email = resend.Emails.SendParams(params)
     resend.Emails.send(email)
     print(email)
+
+    if lead_id is not None:
+        logger.info(f"Sent welcome email to {params['to']}")
+        # Update db to add when email was sent. The email is out, so this must not fail the task: a retry would send it again
+        try:
+            get_db().collection('leads').document(lead_id).update({
+                "welcome_email_sent": datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Sent welcome email to lead {lead_id} but could not record it: {e}")
     return True
 
 
-@cached(cache=TTLCache(maxsize=100, ttl=32600), key=lambda news_limit, news_id: f"{news_limit}-{news_id}")
+@dependency_cached(maxsize=100, ttl=32600, key=lambda news_limit, news_id: f"{news_limit}-{news_id}")
 def get_news(news_limit=3, news_id=None):
     logger.debug("Get News")
     db = get_db()  # this connects to our Firestore database
@@ -1733,7 +1707,7 @@ def save_helping_status_old(propel_user_id, json):
         "helping": helping_list
     })
 
-    clear_cache()
+    invalidate_documents(("problem_statements", problem_statement_id))
     
 
     send_slack_audit(action="helping", message=user_id, payload=to_add)
@@ -1793,7 +1767,7 @@ def link_problem_statements_to_events_old(json):
             "events": eventObsList
         });
         
-    clear_cache()
+    invalidate_documents(*[("problem_statements", problemId) for problemId in data])
 
     return Message(
         "Updated Problem Statement to Event Associations"
@@ -1804,10 +1778,6 @@ def save_problem_statement_old(json):
     db = get_db()  # this connects to our Firestore database
     logger.debug("Problem Statement Save")
 
-    logger.debug("Clearing cache")    
-    clear_cache()
-    logger.debug("Done Clearing cache")
-
 
     send_slack_audit(action="save_problem_statement",
                      message="Saving", payload=json)
@@ -1834,6 +1804,7 @@ def save_problem_statement_old(json):
     })
 
     logger.debug(f"Insert Result: {insert_res}")
+    invalidate_documents(("problem_statements", doc_id))
 
     return Message(
         "Saved Problem Statement"
@@ -1844,7 +1815,7 @@ def get_problem_statement_from_id_old(problem_id):
     doc = db.collection('problem_statements').document(problem_id)
     return doc
 
-@cached(cache=TTLCache(maxsize=100, ttl=600))
+@dependency_cached(maxsize=100, ttl=600)
 def get_single_problem_statement_old(project_id):
     logger.debug(f"get_single_problem_statement start project_id={project_id}")    
     db = get_db()      
@@ -1877,8 +1848,8 @@ def get_problem_statement_list_old():
     logger.debug(results)        
     return { "problem_statements": results }
 
-@cached(cache=TTLCache(maxsize=100, ttl=10))
 @limits(calls=100, period=ONE_MINUTE)
+@dependency_cached(maxsize=100, ttl=10)
 def get_github_profile(github_username):
     logger.debug(f"Getting Github Profile for {github_username}")
 
@@ -1890,8 +1861,8 @@ def get_github_profile(github_username):
 # -------------------- User functions to be deleted ---------------------------------------- #
 
 # 10 minute cache for 100 objects LRU
-@cached(cache=TTLCache(maxsize=100, ttl=600))
 @limits(calls=100, period=ONE_MINUTE)
+@dependency_cached(maxsize=100, ttl=600)
 def get_profile_metadata_old(propel_id):
     logger.debug("Profile Metadata")
 
@@ -1945,39 +1916,28 @@ def get_history_old(db_id):
     db = get_db()  # this connects to our Firestore database
     collection = db.collection('users')
     doc = collection.document(db_id)
-    doc_get = doc.get()
-    res = doc_get.to_dict()
 
-    _hackathons=[]
-    if "hackathons" in res:
-        for h in res["hackathons"]:
-            rec = h.get().to_dict()
-            nonprofits = []
-            problem_statements = []
-
-            for n in rec["nonprofits"]:
-                npo_doc = n.get()
-                npo_id = npo_doc.id
-                npo = n.get().to_dict()
-                npo["id"] = npo_id
-
-                if npo and "problem_statements" in npo:
-                    # This is duplicate date as we should already have this
-                    del npo["problem_statements"]
-                nonprofits.append(npo)
-
-
-            _hackathons.append({
-                "nonprofits": nonprofits,                
-                "links": rec["links"],
-                "location": rec["location"],
-                "start_date": rec["start_date"]
-            })
+    # Resolve hackathons, their nonprofits and badges breadth-first with one get_all per level
+    loader = DocumentLoader(db)
+    res = loader.load(doc, expand=["hackathons.nonprofits", "badges"])
 
-    _badges=[]
-    if "badges" in res:
-        for h in res["badges"]:
-            _badges.append(h.get().to_dict())
+    _hackathons=[]
+    for rec in res.get("hackathons", []):
+        nonprofits = []
+        for npo in rec.get("nonprofits", []):
+            if "problem_statements" in npo:
+                # This is duplicate date as we should already have this
+                del npo["problem_statements"]
+            nonprofits.append(npo)
+
+        _hackathons.append({
+            "nonprofits": nonprofits,
+            "links": rec["links"],
+            "location": rec["location"],
+            "start_date": rec["start_date"]
+        })
+
+    _badges = res.get("badges", [])
 
     result = {
         "id": doc.id,
@@ -2098,7 +2058,7 @@ def save_profile_metadata_old(propel_id, json):
 
     # Clear cache for get_profile_metadata
     get_profile_metadata_old.cache_clear()
-    get_user_by_id_old.cache_clear()
+    invalidate_documents(("users", user.id))
 
     return Message(
         "Saved Profile Metadata"
@@ -2106,9 +2066,25 @@ def save_profile_metadata_old(propel_id, json):
 
 
 
-@cached(cache=TTLCache(maxsize=100, ttl=600), key=lambda id: id)
+PUBLIC_USER_FIELDS = ["name", "profile_image", "user_id", "nickname", "github"]
+
+def public_user_fields(doc):
+    res = {}
+    for field in PUBLIC_USER_FIELDS:
+        try:
+            value = doc.get(field)
+            if value is not None:
+                res[field] = value
+        except KeyError:
+            logger.info(f"Field '{field}' not found for user {doc.id}")
+
+    res["id"] = doc.id
+    return res
+
+@dependency_cached(maxsize=100, ttl=600, key=lambda id: id)
 def get_user_by_id_old(id):
     logger.debug(f"Attempting to get user by ID: {id}")
+    record_dependency("users", id)
     db = get_db()
     doc_ref = db.collection('users').document(id)
 
@@ -2118,17 +2094,7 @@ def get_user_by_id_old(id):
             logger.warning(f"User with ID {id} not found")
             return {}
 
-        fields = ["name", "profile_image", "user_id", "nickname", "github"]
-        res = {}
-        for field in fields:
-            try:
-                value = doc.get(field)
-                if value is not None:
-                    res[field] = value
-            except KeyError:
-                logger.info(f"Field '{field}' not found for user {id}")
-
-        res["id"] = doc.id
+        res = public_user_fields(doc)
         logger.debug(f"Successfully retrieved user data: {res}")
         return res
 
@@ -2183,6 +2149,10 @@ def save_feedback(propel_user_id, json):
     return Message("Feedback saved successfully")
 
 def notify_feedback_receiver(feedback_receiver_id):
+    enqueue("feedback.notify_receiver", feedback_receiver_id=feedback_receiver_id)
+
+@task("feedback.notify_receiver")
+def deliver_feedback_notification(feedback_receiver_id):
     db = get_db()
     user_doc = db.collection('users').document(feedback_receiver_id).get()
     if user_doc.exists:
@@ -2202,8 +2172,8 @@ def notify_feedback_receiver(feedback_receiver_id):
     else:
         logger.warning(f"User with ID {feedback_receiver_id} not found")
 
-@cached(cache=TTLCache(maxsize=100, ttl=600))
 @limits(calls=100, period=ONE_MINUTE)
+@dependency_cached(maxsize=100, ttl=600)
 def get_user_feedback(propel_user_id):
     logger.info(f"Getting feedback for propel_user_id: {propel_user_id}")    
     db = get_db()
@@ -0,0 +1,55 @@
+from flask import Flask
+from api.messages import messages_service
+from api.messages.messages_views import bp
+from common.utils.cache import clear_all
+from common.utils.firebase import get_db
+import mockfirestore
+import pytest
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db = get_db()
+    db.reset()
+    clear_all()
+    # messages_service connects to Firestore itself, use the in-memory one the tests run against
+    monkeypatch.setattr(messages_service, "get_db", lambda: db)
+    monkeypatch.setattr(messages_service.firestore, "DocumentSnapshot", mockfirestore.DocumentSnapshot)
+    monkeypatch.setattr(messages_service.firestore, "DocumentReference", mockfirestore.DocumentReference)
+    db.collection("teams").document("t1").set({"name": "Rocket", "users": ["u1", "u2"]})
+    db.collection("teams").document("t2").set({"name": "Jets", "users": []})
+    db.collection("users").document("u1").set({"name": "Ada", "user_id": "U1", "email_address": "ada@example.org"})
+
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    return app.test_client()
+
+
+@pytest.mark.parametrize("body", [
+    ["t1"],
+    "t1",
+    {"team_ids": "t1"},
+    {"team_ids": [f"t{i}" for i in range(messages_service.MAX_TEAMS_PER_BATCH + 1)]},
+])
+def test_batch_teams_rejects_bad_requests(client, body):
+    response = client.post("/api/messages/teams/batch", json=body)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_batch_teams_returns_the_teams_that_exist(client):
+    response = client.post("/api/messages/teams/batch", json={"team_ids": ["t1", "t2", "missing", "t1"]})
+    assert response.status_code == 200
+    teams = response.get_json()["teams"]
+    assert sorted(teams) == ["t1", "t2"]
+    assert teams["t1"]["users"] == ["u1", "u2"]
+
+
+def test_batch_teams_expands_users_to_their_public_fields(client):
+    response = client.post("/api/messages/teams/batch", json={"team_ids": ["t1"], "expand_users": True})
+    # u2 doesn't exist and is left out, email addresses aren't public
+    assert response.get_json()["teams"]["t1"]["users"] == [{"id": "u1", "name": "Ada", "user_id": "U1"}]
+
+    # The cached team is left as it was
+    response = client.post("/api/messages/teams/batch", json={"team_ids": ["t1"]})
+    assert response.get_json()["teams"]["t1"]["users"] == ["u1", "u2"]
@@ -1,5 +1,5 @@
 import logging
-from ratelimit import limits
+from common.utils.rate_limit import limits
 
 from api.messages.messages_service import (get_db, ONE_MINUTE)
 
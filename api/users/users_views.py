@@ -35,6 +35,15 @@ def save_profile():
         return None
 
 
+# Forget the cached Slack identity for the user, the frontend calls this when logging out
+@bp.route("/logout", methods=["POST"])
+@auth.require_user
+def logout():
+    if auth_user and auth_user.user_id:
+        users_service.invalidate_slack_identity(auth_user.user_id)
+    return {"success": True}
+
+
 # Get user profile by user id
 @bp.route("/<id>/profile", methods=["GET"])
 def get_profile_by_db_id(id):
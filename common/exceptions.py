@@ -74,7 +74,8 @@ class AuthorizationError(OHackBaseException):
 
 class RateLimitExceededError(OHackBaseException):
     """Exception raised when API rate limit is exceeded."""
-    def __init__(self, message="API rate limit exceeded"):
+    def __init__(self, message="API rate limit exceeded", retry_after=None):
+        self.retry_after = retry_after
         super().__init__(message)
 
 class ExternalServiceError(OHackBaseException):
@@ -0,0 +1,499 @@
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from cachetools import TLRUCache
+from cachetools.keys import hashkey
+from common.exceptions import RateLimitExceededError
+from common.utils.doc_cache import document_cache
+from common.utils.shared_cache import get_shared_cache
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+# Used as the document id for reads that depend on a whole collection (e.g. a where() query)
+ANY_DOCUMENT = "*"
+
+# How many recently invalidated documents to remember for detecting reads that raced a write
+INVALIDATION_LOG_SIZE = 10000
+
+# How often (seconds) to check for invalidations published by other workers
+SHARED_CACHE_POLL_INTERVAL = float(os.getenv("SHARED_CACHE_POLL_INTERVAL", 0.5))
+
+# How long (seconds) a caller waits on someone else's in-flight call before making its own
+SINGLE_FLIGHT_TIMEOUT = 30
+
+# Dependency sets of every cached read currently running in this context, outermost first
+_active_reads = contextvars.ContextVar("cache_active_reads", default=())
+
+_lock = threading.RLock()
+_caches = {}
+# (namespace, key) of stale-while-revalidate entries being refreshed in the background
+_refreshing = set()
+_sequence = 0
+_invalidation_log = OrderedDict()
+_invalidation_log_floor = 0
+
+# Called with the documents of every invalidation, local or from another worker, and None for a clear_all
+_invalidation_listeners = []
+
+_poll_lock = threading.Lock()
+_polled_backend = None
+_last_event_seq = None
+_last_poll = 0
+
+
+def add_invalidation_listener(listener):
+    """
+    Call listener(documents) with the (collection, doc_id) documents of every invalidation in this process,
+    including the ones other workers publish, and listener(None) when everything is cleared. For in-memory
+    structures that update themselves from a write instead of being evicted like a cached read.
+    """
+    _invalidation_listeners.append(listener)
+
+
+def _notify_listeners(documents):
+    for listener in _invalidation_listeners:
+        try:
+            listener(documents)
+        except Exception as e:
+            logger.warning(f"Invalidation listener {listener} failed: {e}")
+
+
+def record_dependency(collection, doc_id):
+    """
+    Record that the cached reads currently running depend on collection/doc_id, so writing that
+    document evicts them. Does nothing when called outside a cached read.
+    """
+    reads = _active_reads.get()
+    for deps in reads:
+        deps.add((collection, doc_id))
+
+
+def record_collection_dependency(collection):
+    """Record that the cached reads currently running depend on every document in collection."""
+    record_dependency(collection, ANY_DOCUMENT)
+
+
+def _record_all(deps):
+    for deps_in_progress in _active_reads.get():
+        deps_in_progress.update(deps)
+
+
+def _invalidated_since(sequence, deps):
+    if sequence < _invalidation_log_floor:
+        # We no longer know what was written since this read started, assume the worst
+        return True
+    return any(_invalidation_log.get(dep, 0) > sequence for dep in deps)
+
+
+def _tracked_call(func, args, kwargs):
+    """Call func, returning its result and the dependencies it recorded."""
+    deps = set()
+    token = _active_reads.set(_active_reads.get() + (deps,))
+    try:
+        value = func(*args, **kwargs)
+    finally:
+        _active_reads.reset(token)
+    return value, deps
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers that ask for a key while it is in flight
+    wait for that call and get its result (or its exception) instead of repeating the work.
+
+    A RateLimitExceededError is the leader's own, not the key's: callers that waited on it make
+    the call themselves, against their own limit.
+    """
+
+    def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                if isinstance(call.error, RateLimitExceededError):
+                    return self.do(key, fn)
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            logger.warning(f"SingleFlight: gave up waiting on {key} after {self.timeout}s, calling it again")
+            return fn()
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def single_flight(key=hashkey, timeout=SINGLE_FLIGHT_TIMEOUT):
+    """
+    Coalesce concurrent calls with the same arguments into one. Put it under a caching decorator
+    so a burst of misses for the same key costs one backend call; @dependency_cached already does
+    this itself. Dependencies recorded by the call are passed to every waiting caller.
+    """
+    def decorator(func):
+        flight = SingleFlight(timeout)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            value, deps = flight.do(key(*args, **kwargs), lambda: _tracked_call(func, args, kwargs))
+            _record_all(deps)
+            return value
+
+        wrapper.flight = flight
+        return wrapper
+    return decorator
+
+
+def _shared(operation, *args, default=None):
+    # The shared tier is an optimization, never fail a request because of it
+    try:
+        return getattr(get_shared_cache(), operation)(*args)
+    except Exception as e:
+        logger.warning(f"Shared cache {operation} failed: {e}")
+        return default
+
+
+class DependencyTrackingCache:
+    """
+    TTL cache that remembers which Firestore documents each entry was built from, so a write can
+    evict only the entries that read the written document.
+
+    Entries keep the expiry time they were created with, including ones copied from the shared
+    cache, so an entry never outlives its TTL by being passed between workers.
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.ttl = ttl
+        self._cache = TLRUCache(maxsize=maxsize, ttu=lambda _key, entry, _now: entry[1], timer=time.time)
+        self._deps_by_key = {}
+        self._keys_by_dep = {}
+
+    def get(self, key):
+        """Return (value, deps, expires) or None on a miss."""
+        try:
+            value, expires = self._cache[key]
+        except KeyError:
+            return None
+        return value, self._deps_by_key.get(key, frozenset()), expires
+
+    def set(self, key, value, deps, expires):
+        self._forget(key)
+        self._cache[key] = (value, expires)
+        self._deps_by_key[key] = frozenset(deps)
+        for dep in deps:
+            self._keys_by_dep.setdefault(dep, set()).add(key)
+
+        # Entries the TTLCache expired or evicted on its own are still in the index, prune them
+        if len(self._deps_by_key) > 2 * self._cache.maxsize:
+            for stale_key in [k for k in self._deps_by_key if k not in self._cache]:
+                self._forget(stale_key)
+
+    def invalidate(self, deps):
+        keys = set()
+        for dep in deps:
+            keys.update(self._keys_by_dep.get(dep, ()))
+        for key in keys:
+            self._cache.pop(key, None)
+            self._forget(key)
+        return len(keys)
+
+    def clear(self):
+        self._cache.clear()
+        self._deps_by_key.clear()
+        self._keys_by_dep.clear()
+
+    def _forget(self, key):
+        for dep in self._deps_by_key.pop(key, ()):
+            keys = self._keys_by_dep.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._keys_by_dep[dep]
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def dependency_cached(maxsize=100, ttl=600, key=hashkey, refresh_after=None):
+    """
+    Drop-in replacement for @cached(cache=TTLCache(...)) whose entries are evicted by
+    invalidate_documents() for the documents they read, instead of needing a cache_clear().
+
+    Dependencies are recorded by record_dependency() (doc_to_json and DocumentLoader do this) while
+    the wrapped function runs. Cached calls made from inside another cached call pass their
+    dependencies up to it, including when they are answered from cache.
+
+    Misses in the per-process cache fall back to the shared cache (common/utils/shared_cache.py),
+    so a result computed by one gunicorn worker is reused by the others. Invalidations and
+    cache_clear() reach every worker.
+
+    With refresh_after (seconds, less than ttl) entries older than refresh_after are still returned
+    straight away, and refreshed in a background thread (stale-while-revalidate). Only entries
+    older than ttl, or invalidated ones, make the caller wait.
+
+    Concurrent misses for the same key in a worker are coalesced (see SingleFlight), so an expiring
+    entry during a spike is recomputed once rather than once per request.
+    """
+    if refresh_after is not None and refresh_after >= ttl:
+        raise ValueError("refresh_after must be less than ttl")
+
+    def decorator(func):
+        namespace = f"{func.__module__}.{func.__qualname__}"
+        cache = DependencyTrackingCache(namespace, maxsize, ttl)
+        flight = SingleFlight()
+        with _lock:
+            _caches[namespace] = cache
+
+        def needs_refresh(expires):
+            return refresh_after is not None and time.time() > expires - ttl + refresh_after
+
+        def compute(k, args, kwargs):
+            value, deps = flight.do(k, lambda: compute_and_store(k, args, kwargs))
+            # The caller that did the work already has these, the ones that waited need them too
+            _record_all(deps)
+            return value
+
+        def compute_and_store(k, args, kwargs):
+            with _lock:
+                sequence = _sequence
+            value, deps = _tracked_call(func, args, kwargs)
+            # Pick up writes other workers made while we were reading
+            seen_seq = poll_shared_events(force=True)
+            store(k, value, deps, sequence, seen_seq)
+            return value, deps
+
+        def store(k, value, deps, sequence, seen_seq):
+            expires = time.time() + ttl
+            with _lock:
+                # Don't cache what we read if one of its documents was written while we were reading
+                raced = _invalidated_since(sequence, deps)
+                if not raced:
+                    cache.set(k, value, deps, expires)
+            if not raced:
+                _shared("set", namespace, k, value, deps, expires, seen_seq)
+            else:
+                logger.debug(f"{namespace}: not caching {k}, a dependency was written during the read")
+
+        def lookup(k):
+            with _lock:
+                entry = cache.get(k)
+                sequence = _sequence
+            if entry is None:
+                entry = _shared("get", namespace, k)
+                if entry is not None:
+                    with _lock:
+                        if not _invalidated_since(sequence, entry[1]):
+                            cache.set(k, *entry)
+            return entry
+
+        def refresh(k, args, kwargs, expires):
+            # Another worker may have refreshed it already
+            shared_entry = _shared("get", namespace, k)
+            if shared_entry is not None and shared_entry[2] > expires and not needs_refresh(shared_entry[2]):
+                value, deps, shared_expires = shared_entry
+                with _lock:
+                    cache.set(k, value, deps, shared_expires)
+                return
+            compute(k, args, kwargs)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            poll_shared_events()
+            entry = lookup(k)
+            if entry is None:
+                return compute(k, args, kwargs)
+
+            value, deps, expires = entry
+            _record_all(deps)
+            if needs_refresh(expires):
+                _refresh_in_background(namespace, k, lambda: refresh(k, args, kwargs, expires))
+            return value
+
+        def get_many(ids, load_missing):
+            """
+            Batch version of calling the function once per id, for functions that take a single
+            argument. Cached ids are answered from cache, load_missing(missing_ids) is called once
+            for the rest and must return {id: (value, deps)}. What it returns is cached as if each
+            id had been called on its own. Returns {id: value}.
+            """
+            poll_shared_events()
+            results = {}
+            missing = []
+            for id in ids:
+                entry = lookup(key(id))
+                if entry is None:
+                    missing.append(id)
+                else:
+                    results[id] = entry[0]
+                    _record_all(entry[1])
+
+            if len(missing) > 0:
+                with _lock:
+                    sequence = _sequence
+                loaded = load_missing(missing)
+                seen_seq = poll_shared_events(force=True)
+                for id, (value, deps) in loaded.items():
+                    store(key(id), value, deps, sequence, seen_seq)
+                    _record_all(deps)
+                    results[id] = value
+            return results
+
+        wrapper.cache = cache
+        wrapper.cache_clear = _cache_clear_for(namespace)
+        wrapper.get_many = get_many
+        return wrapper
+    return decorator
+
+
+def _refresh_in_background(namespace, k, refresh):
+    with _lock:
+        if (namespace, k) in _refreshing:
+            return
+        _refreshing.add((namespace, k))
+
+    def run():
+        try:
+            refresh()
+        except Exception as e:
+            # The stale entry keeps being served until it expires or the next refresh works
+            logger.warning(f"{namespace}: background refresh of {k} failed: {e}")
+        finally:
+            with _lock:
+                _refreshing.discard((namespace, k))
+
+    # New threads start with an empty context, so the refresh records its own dependencies
+    threading.Thread(target=run, name=f"refresh {namespace}", daemon=True).start()
+
+
+def _cache_clear_for(namespace):
+    def cache_clear():
+        _clear_locally(namespace)
+        _shared("clear", namespace)
+    return cache_clear
+
+
+def _clear_locally(namespace=None):
+    global _sequence, _invalidation_log_floor
+
+    with _lock:
+        # Reads that were in flight during the clear must not be cached
+        _sequence += 1
+        _invalidation_log_floor = _sequence
+        if namespace is None:
+            for cache in _caches.values():
+                cache.clear()
+        elif namespace in _caches:
+            _caches[namespace].clear()
+    if namespace is None:
+        document_cache.clear()
+        _notify_listeners(None)
+
+
+def poll_shared_events(force=False):
+    """
+    Apply invalidations and clears published by other workers. Runs at most every
+    SHARED_CACHE_POLL_INTERVAL seconds unless forced. Returns the last event seq seen.
+    """
+    global _polled_backend, _last_event_seq, _last_poll
+
+    backend = get_shared_cache()
+    now = time.time()
+    if not force and backend is _polled_backend and now - _last_poll < SHARED_CACHE_POLL_INTERVAL:
+        return _last_event_seq
+
+    with _poll_lock:
+        _last_poll = now
+        if backend is not _polled_backend:
+            _polled_backend = backend
+            # Nothing is cached in this process yet, so earlier events don't matter
+            _last_event_seq = _shared("latest_seq", default=0)
+            return _last_event_seq
+        events, _last_event_seq = _shared("poll", _last_event_seq, default=([], _last_event_seq))
+        seen_seq = _last_event_seq
+
+    for kind, payload in events:
+        if kind == "invalidate":
+            _invalidate_locally([tuple(document) for document in payload["documents"]])
+        elif kind == "clear":
+            _clear_locally(payload["namespace"])
+    return seen_seq
+
+
+def invalidate_documents(*documents):
+    """
+    Evict every cached read that depends on any of documents, given as (collection, doc_id) tuples,
+    along with the documents themselves from document_cache, in every worker. Call after the write
+    has happened.
+    """
+    documents = [(collection, doc_id) for collection, doc_id in documents if doc_id is not None]
+    deps, evicted = _invalidate_locally(documents)
+    _shared("invalidate", deps, documents)
+
+    logger.debug(f"Invalidated {sorted(deps)}, evicted {evicted} cached reads")
+    return evicted
+
+
+def _invalidate_locally(documents):
+    global _sequence, _invalidation_log_floor
+
+    deps = set()
+    for collection, doc_id in documents:
+        deps.add((collection, doc_id))
+        deps.add((collection, ANY_DOCUMENT))
+
+    evicted = 0
+    with _lock:
+        _sequence += 1
+        for dep in deps:
+            _invalidation_log[dep] = _sequence
+            _invalidation_log.move_to_end(dep)
+        while len(_invalidation_log) > INVALIDATION_LOG_SIZE:
+            _, dropped_sequence = _invalidation_log.popitem(last=False)
+            _invalidation_log_floor = max(_invalidation_log_floor, dropped_sequence)
+
+        for cache in _caches.values():
+            evicted += cache.invalidate(deps)
+
+    for collection, doc_id in documents:
+        if doc_id != ANY_DOCUMENT:
+            document_cache.invalidate(collection, doc_id)
+    _notify_listeners(documents)
+
+    return deps, evicted
+
+
+def clear_all():
+    """Empty every dependency tracked cache and the document cache, in every worker."""
+    _clear_locally()
+    _shared("clear")
@@ -0,0 +1,107 @@
+import copy
+import os
+import sys
+import threading
+from cachetools import LRUCache
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+# Default to 32MB of cached documents per worker
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+def estimate_size(value):
+    """Rough deep size in bytes of a JSON-like value (dicts, lists, strings, numbers)."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k) + estimate_size(v)
+    elif isinstance(value, (list, tuple, set)):
+        for v in value:
+            size += estimate_size(v)
+    return size
+
+
+class _EvictionCountingLRUCache(LRUCache):
+    def __init__(self, maxsize, getsizeof=None):
+        super().__init__(maxsize, getsizeof=getsizeof)
+        self.evictions = 0
+
+    def popitem(self):
+        # cachetools only calls popitem to make room, so every call is an eviction
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+
+class DocumentCache:
+    """
+    LRU cache of Firestore documents (as JSON dicts) keyed by (collection, id).
+
+    The cache is bounded by the estimated size of the cached documents rather than by the
+    number of entries, so memory use per worker stays predictable no matter how large the
+    documents are.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self._lock = threading.RLock()
+        self._cache = _EvictionCountingLRUCache(maxsize=max_bytes, getsizeof=self._entry_size)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_size(value):
+        return estimate_size(value)
+
+    def get(self, collection, doc_id):
+        with self._lock:
+            value = self._cache.get((collection, doc_id))
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Callers change the result, nested history/team lists included, don't let that change what is cached
+            return copy.deepcopy(value)
+
+    def set(self, collection, doc_id, value):
+        if value is None:
+            return
+        with self._lock:
+            try:
+                self._cache[(collection, doc_id)] = copy.deepcopy(value)
+            except ValueError:
+                # Bigger than the whole cache, just don't cache it
+                logger.warning(f"DocumentCache: {collection}/{doc_id} is too large to cache")
+
+    def invalidate(self, collection, doc_id):
+        with self._lock:
+            return self._cache.pop((collection, doc_id), None) is not None
+
+    def invalidate_collection(self, collection):
+        with self._lock:
+            keys = [key for key in self._cache.keys() if key[0] == collection]
+            for key in keys:
+                del self._cache[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self._cache.evictions,
+                "entries": len(self._cache),
+                "bytes": self._cache.currsize,
+                "max_bytes": self._cache.maxsize,
+            }
+
+
+document_cache = DocumentCache(max_bytes=int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)))
@@ -0,0 +1,19 @@
+import os
+import uuid
+from contextlib import contextmanager
+
+
+@contextmanager
+def replace_when_written(path):
+    """
+    Yield a temporary path next to path to write the file to, and rename it to path once the block
+    finishes. Readers, in this worker or another, see either the old file or the whole new one, never
+    half of it. The temporary file is removed if the block raises.
+    """
+    partial = f"{path}.{uuid.uuid4().hex}.partial"
+    try:
+        yield partial
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
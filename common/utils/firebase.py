@@ -5,7 +5,11 @@ import json
 from mockfirestore import MockFirestore
 import datetime
 import re
+import copy
 from google.cloud.firestore import FieldFilter
+from common.utils.cache import invalidate_documents
+from common.utils.firestore_loader import ref_path
+from db.firestore import FirestoreDatabaseInterface
 
 
 cert_env = json.loads(safe_get_env_var("FIREBASE_CERT_CONFIG"))
@@ -69,28 +73,41 @@ def get_user_by_id(id):
     adict["id"] = doc.id
     return adict
 
+_user_interface = None
+
+
+def get_user_interface():
+    """
+    The Firestore database interface, for its index of users by Slack id and email address. It is the
+    same one db.db uses, so users it inserts and updates are indexed here too.
+    """
+    global _user_interface
+    if _user_interface is None:
+        from db.db import db as database
+        _user_interface = database if isinstance(database, FirestoreDatabaseInterface) else FirestoreDatabaseInterface()
+    return _user_interface
+
+
 def get_user_by_user_id(user_id):
-    SLACK_PREFIX = "oauth2|slack|T1Q7936BH-"
-    slack_user_id = f"{SLACK_PREFIX}{user_id}"
-    # log slack_user_id
-    logger.info(f"Looking up user {slack_user_id}")
-    
-    db = get_db()  # this connects to our Firestore database
-    docs = db.collection('users').where("user_id", "==", slack_user_id).stream()
+    # log user_id
+    logger.info(f"Looking up user {user_id}")
 
-    for doc in docs:
-        adict = doc.to_dict()
-        adict["id"] = doc.id
-        return adict
+    db = get_db()  # this connects to our Firestore database
+    doc = get_user_interface().fetch_user_by_user_id_raw(db, user_id)
+    if doc is None:
+        return None
+    adict = doc.to_dict()
+    adict["id"] = doc.id
+    return adict
 
 def get_user_by_email(email_address):
     db = get_db()  # this connects to our Firestore database
-    docs = db.collection('users').where("email_address", "==", email_address).stream()
-
-    for doc in docs:
-        adict = doc.to_dict()
-        adict["id"] = doc.id
-        return adict
+    doc = get_user_interface().fetch_user_by_email_raw(db, email_address)
+    if doc is None:
+        return None
+    adict = doc.to_dict()
+    adict["id"] = doc.id
+    return adict
 
 
 def get_github_contributions_for_user(login):
@@ -256,7 +273,7 @@ def add_user_by_email_to_team(email_address, team_name):
         raise Exception(f"Team {team_name} does not exist")
 
     # Get user
-    user = db.collection("users").where("email_address", "==", email_address).get()
+    user = get_user_interface().fetch_user_by_email_raw(db, email_address)
 
     if not user:
         logger.error(f"**ERROR User {email_address} does not exist")
@@ -302,8 +319,7 @@ def add_user_by_slack_id_to_team(user_id, team_name):
         raise Exception(f"Team {team_name} does not exist")
 
     # Get user
-    user = db.collection("users").where("user_id", "==", user_id).get()
-    user = user[0]
+    user = get_user_interface().fetch_user_by_user_id_raw(db, user_id)
     
     if not user:
         logger.error(f"**ERROR User {user_id} does not exist")
@@ -870,96 +886,200 @@ def add_certificate(user_id, certificate):
     db.collection("users").document(user_id).set({"history": user_history}, merge=True)    
    
 
+# Which part of a user's history each heart reason is counted in
+HEART_REASONS = {
+    # 4 things in "how"
+    "code_reliability": "how",
+    "customer_driven_innovation_and_design_thinking": "how",
+    "iterations_of_code_pushed_to_production": "how",
+    "standups_completed": "how",
+    # 8 things in "what"
+    "code_quality": "what",
+    "design_architecture": "what",
+    "documentation": "what",
+    "observability": "what",
+    "productionalized_projects": "what",
+    "requirements_gathering": "what",
+    "unit_test_coverage": "what",
+    "unit_test_writing": "what",
+    "judge": "what",
+    "mentor": "what",
+}
+
+# Firestore allows 500 writes per commit
+MAX_WRITES_PER_COMMIT = 500
+# Each user is two: their document and their leaderboard entry
+MAX_USERS_PER_HEART_AWARD = MAX_WRITES_PER_COMMIT // 2
+# A worker rebuilding the leaderboard keeps others from starting a rebuild for this long
+HEARTS_LEADERBOARD_REBUILD_SECONDS = 10*60
+
+
 def add_hearts_for_user(user_id, hearts, reason):
+    award_hearts(user_id, hearts, [reason])
+
+
+def award_hearts(user_id, hearts, reasons):
+    """Give user_id hearts for each of reasons in a single write."""
+    award_hearts_to_users([(user_id, hearts, reasons)])
+
+
+def award_hearts_to_users(awards):
+    """
+    Apply a list of (user_id, hearts, reasons) awards, MAX_USERS_PER_HEART_AWARD users per commit.
+
+    Counters are bumped with server-side increments so concurrent awards can't overwrite each other.
+    If any user in a commit doesn't exist nothing in that commit is written, commits before it stay.
+    """
+    increments = {}
+    for user_id, hearts, reasons in awards:
+        logger.info(f"Adding {hearts} hearts to user {user_id} for reasons {reasons}")
+        user_increments = increments.setdefault(user_id, {})
+        for reason in reasons:
+            if reason not in HEART_REASONS:
+                raise Exception(f"Invalid reason: {reason}")
+            key = (HEART_REASONS[reason], reason)
+            user_increments[key] = user_increments.get(key, 0) + hearts
+
     db = get_db()  # this connects to our Firestore database
-    logger.info(f"Adding {hearts} hearts to user {user_id} for reason {reason}")
+    user_ids = list(increments)
+    for start in range(0, len(user_ids), MAX_USERS_PER_HEART_AWARD):
+        chunk = user_ids[start:start + MAX_USERS_PER_HEART_AWARD]
+        _commit_heart_awards(db, {user_id: increments[user_id] for user_id in chunk})
+        # Right away, so a later chunk failing doesn't leave these cached without their hearts
+        invalidate_documents(*[(HEARTS_LEADERBOARD_ENTRY, user_id) for user_id in chunk],
+                             *[("users", user_id) for user_id in chunk])
+
+
+def _commit_heart_awards(db, increments):
+    user_refs = {user_id: db.collection("users").document(user_id) for user_id in increments}
+    leaderboard_ref = db.collection(HEARTS_LEADERBOARD[0]).document(HEARTS_LEADERBOARD[1])
+
+    @firestore.transactional
+    def commit(transaction):
+        # Read operations
+        snapshots = {ref_path(snapshot.reference): snapshot
+                     for snapshot in transaction.get_all(list(user_refs.values())) if snapshot.exists}
+        users = {user_id: snapshots[ref_path(ref)] for user_id, ref in user_refs.items() if ref_path(ref) in snapshots}
+
+        # Write operations
+        for user_id, counters in increments.items():
+            if user_id not in users:
+                logger.error(f"**ERROR User {user_id} does not exist")
+                raise Exception(f"User {user_id} does not exist")
+
+            transaction.update(user_refs[user_id], {
+                f"history.{category}.{reason}": firestore.Increment(amount) for (category, reason), amount in counters.items()
+            })
+
+            # Written even while the leaderboard isn't built, a rebuild never replaces an entry that exists
+            # The entry is computed from what we read, the transaction retries if the user changed since
+            user = users[user_id].to_dict()
+            history = copy.deepcopy(user.get("history", {}))
+            for (category, reason), amount in counters.items():
+                history.setdefault(category, {})
+                history[category][reason] = history[category].get(reason, 0) + amount
+            transaction.set(leaderboard_ref.collection(HEARTS_LEADERBOARD_ENTRIES).document(user_id),
+                            hearts_leaderboard_entry(user.get("name", ""), history))
+
+    commit(db.transaction())
+
+
+# Every user's heart totals, one document each under this one, so the leaderboard doesn't have to read
+# every user and an award only writes the entries of the users it gives hearts to. This one says whether the
+# entries have been built from every user yet, and who is building them
+HEARTS_LEADERBOARD = ("leaderboards", "hearts")
+HEARTS_LEADERBOARD_ENTRIES = "entries"
+# Collection the entries are invalidated under, (HEARTS_LEADERBOARD_ENTRY, user_id)
+HEARTS_LEADERBOARD_ENTRY = "/".join([*HEARTS_LEADERBOARD, HEARTS_LEADERBOARD_ENTRIES])
+
+
+def hearts_leaderboard_entry(name, history):
+    # Result should have slackUsername, totalHearts, heartTypes (how or what) and heartCount
+    # Count the total hearts
+    total_hearts = 0
+    for key in history:
+        if "certificates" in key:
+            continue
+
+        for subkey in history[key]:
+            total_hearts += history[key][subkey]
+
+    return {
+        "slackUsername": name,
+        "totalHearts": total_hearts,
+        "heartTypes": list(history.keys()),
+        "history": history
+    }
 
-    # Get history from user    
-    user = db.collection("users").document(user_id).get()
 
-    if not user.exists:
-        logger.error(f"**ERROR User {user_id} does not exist")
-        raise Exception(f"User {user_id} does not exist")
-    
-    user_history = user.to_dict()["history"]
-    
-    # 4 things in "how"
-    if "how" not in user_history:
-        user_history["how"] = {}
-    if "code_reliability" not in user_history["how"]:
-        user_history["how"]["code_reliability"] = 0
-    if "customer_driven_innovation_and_design_thinking" not in user_history["how"]:
-        user_history["how"]["customer_driven_innovation_and_design_thinking"] = 0
-    if "iterations_of_code_pushed_to_production" not in user_history["how"]:
-        user_history["how"]["iterations_of_code_pushed_to_production"] = 0
-    if "standups_completed" not in user_history["how"]:
-        user_history["how"]["standups_completed"] = 0    
-    
-    
-    # 8 things in "what"
-    if "what" not in user_history:
-        user_history["what"] = {}                                
-    if "code_quality" not in user_history["what"]:
-        user_history["what"]["code_quality"] = 0
-    if "design_architecture" not in user_history["what"]:
-        user_history["what"]["design_architecture"] = 0
-    if "documentation" not in user_history["what"]:
-        user_history["what"]["documentation"] = 0
-    if "observability" not in user_history["what"]:
-        user_history["what"]["observability"] = 0
-    if "productionalized_projects" not in user_history["what"]:
-        user_history["what"]["productionalized_projects"] = 0
-    if "requirements_gathering" not in user_history["what"]:
-        user_history["what"]["requirements_gathering"] = 0
-    if "unit_test_coverage" not in user_history["what"]:
-        user_history["what"]["unit_test_coverage"] = 0
-    if "unit_test_writing" not in user_history["what"]:
-        user_history["what"]["unit_test_writing"] = 0
-    if "judge" not in user_history["what"]:
-        user_history["what"]["judge"] = 0
-    if "mentor" not in user_history["what"]:
-        user_history["what"]["mentor"] = 0
-        
-        
+def get_hearts_leaderboard_entries(unbuilt=False):
+    """User id -> hearts_leaderboard_entry for everyone with hearts, or None if it was never built. With unbuilt,
+    the entries there are so far instead of None."""
+    db = get_db()
+    leaderboard_ref = db.collection(HEARTS_LEADERBOARD[0]).document(HEARTS_LEADERBOARD[1])
+    leaderboard = leaderboard_ref.get()
+    if not unbuilt and not (leaderboard.exists and leaderboard.to_dict().get("built")):
+        return None
+    return {doc.id: doc.to_dict() for doc in leaderboard_ref.collection(HEARTS_LEADERBOARD_ENTRIES).stream()}
 
-    # TODO: We should be using enums instead of static strings
-    #  Enums allow us to centralize our strings and make it easier to refactor
-    
-    # 4 things in "how"
-    if reason == "code_reliability":
-        user_history["how"]["code_reliability"] += hearts
-    elif reason == "customer_driven_innovation_and_design_thinking":
-        user_history["how"]["customer_driven_innovation_and_design_thinking"] += hearts
-    elif reason == "iterations_of_code_pushed_to_production":
-        user_history["how"]["iterations_of_code_pushed_to_production"] += hearts
-    elif reason == "standups_completed":
-        user_history["how"]["standups_completed"] += hearts
-    # 8 things in "what"
-    elif reason == "code_quality":
-        user_history["what"]["code_quality"] += hearts
-    elif reason == "design_architecture":
-        user_history["what"]["design_architecture"] += hearts
-    elif reason == "documentation":
-        user_history["what"]["documentation"] += hearts
-    elif reason == "observability":
-        user_history["what"]["observability"] += hearts
-    elif reason == "productionalized_projects":
-        user_history["what"]["productionalized_projects"] += hearts
-    elif reason == "requirements_gathering":
-        user_history["what"]["requirements_gathering"] += hearts
-    elif reason == "unit_test_coverage":
-        user_history["what"]["unit_test_coverage"] += hearts
-    elif reason == "unit_test_writing":
-        user_history["what"]["unit_test_writing"] += hearts
-    elif reason == "judge":
-        user_history["what"]["judge"] += hearts
-    elif reason == "mentor":
-        user_history["what"]["mentor"] += hearts
-    else:
-        raise Exception(f"Invalid reason: {reason}")                
 
-    # Update user history
-    db.collection("users").document(user_id).set({"history": user_history}, merge=True)
+def get_hearts_leaderboard_entries_by_user_id(user_ids):
+    """User id -> hearts_leaderboard_entry for each of user_ids, None for those without one."""
+    db = get_db()
+    entries_ref = db.collection(HEARTS_LEADERBOARD[0]).document(HEARTS_LEADERBOARD[1]).collection(HEARTS_LEADERBOARD_ENTRIES)
+    entries = dict.fromkeys(user_ids)
+    for doc in db.get_all([entries_ref.document(user_id) for user_id in user_ids]):
+        if doc.exists:
+            entries[doc.id] = doc.to_dict()
+    return entries
+
+
+def start_hearts_leaderboard_rebuild():
+    """
+    Take the lease on rebuilding the leaderboard for HEARTS_LEADERBOARD_REBUILD_SECONDS. False if it is built
+    already or another worker holds the lease.
+    """
+    db = get_db()
+    leaderboard_ref = db.collection(HEARTS_LEADERBOARD[0]).document(HEARTS_LEADERBOARD[1])
+
+    @firestore.transactional
+    def lease(transaction):
+        leaderboard = next(iter(transaction.get_all([leaderboard_ref])), None)
+        fields = leaderboard.to_dict() if leaderboard is not None and leaderboard.exists else {}
+        now = datetime.datetime.now().timestamp()
+        if fields.get("built") or fields.get("rebuilding_until", 0) > now:
+            return False
+        transaction.set(leaderboard_ref, {"rebuilding_until": now + HEARTS_LEADERBOARD_REBUILD_SECONDS}, merge=True)
+        return True
+
+    return lease(db.transaction())
+
+
+def save_hearts_leaderboard(entries):
+    """
+    Write the entries of users that don't have one yet, MAX_WRITES_PER_COMMIT per commit, then mark the leaderboard
+    built. Entries that exist were written by awards made since entries was read, or by an earlier rebuild, and are
+    kept. Call after start_hearts_leaderboard_rebuild() returned True.
+    """
+    db = get_db()
+    leaderboard_ref = db.collection(HEARTS_LEADERBOARD[0]).document(HEARTS_LEADERBOARD[1])
+    entries_ref = leaderboard_ref.collection(HEARTS_LEADERBOARD_ENTRIES)
+
+    @firestore.transactional
+    def create_missing(transaction, chunk):
+        refs = [entries_ref.document(user_id) for user_id in chunk]
+        # Read in the transaction, so an award writing one of these entries meanwhile makes it retry
+        existing = {ref_path(snapshot.reference) for snapshot in transaction.get_all(refs) if snapshot.exists}
+        for user_id, ref in zip(chunk, refs):
+            if ref_path(ref) not in existing:
+                transaction.set(ref, entries[user_id])
+
+    user_ids = list(entries)
+    for start in range(0, len(user_ids), MAX_WRITES_PER_COMMIT):
+        create_missing(db.transaction(), user_ids[start:start + MAX_WRITES_PER_COMMIT])
+
+    leaderboard_ref.set({"built": datetime.datetime.now().isoformat(), "rebuilding_until": 0}, merge=True)
+    invalidate_documents(HEARTS_LEADERBOARD)
 
 
 # Get all project_applications
@@ -0,0 +1,189 @@
+from firebase_admin import firestore
+from mockfirestore.document import DocumentReference as MockDocumentReference, DocumentSnapshot as MockDocumentSnapshot
+from common.utils.cache import record_dependency
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+# mockfirestore is used when ENVIRONMENT=test, so treat its types the same as the real ones
+REFERENCE_TYPES = (firestore.DocumentReference, MockDocumentReference)
+SNAPSHOT_TYPES = (firestore.DocumentSnapshot, MockDocumentSnapshot)
+
+
+def ref_path(ref):
+    # mockfirestore references don't have .path
+    if hasattr(ref, "path"):
+        return ref.path
+    return "/".join(ref._path)
+
+
+def ref_collection(ref):
+    # The collection id is the second to last part of the document path
+    return ref_path(ref).split("/")[-2]
+
+
+def parse_expand_spec(expand):
+    """
+    Turn ["nonprofits.problem_statements", "teams.users", "teams"] into a tree:
+    {"nonprofits": {"problem_statements": {}}, "teams": {"users": {}}}
+    """
+    tree = {}
+    for path in expand:
+        node = tree
+        for field in path.split("."):
+            node = node.setdefault(field, {})
+    return tree
+
+
+def flatten_references(d, keep=()):
+    """
+    Replace DocumentReference/DocumentSnapshot values (and list items) with their document id,
+    except for the fields in keep which are left as-is so they can be expanded later.
+    """
+    for key, value in d.items():
+        if key in keep:
+            continue
+        if isinstance(value, list):
+            d[key] = [v.id if isinstance(v, REFERENCE_TYPES + SNAPSHOT_TYPES) else v for v in value]
+        elif isinstance(value, REFERENCE_TYPES + SNAPSHOT_TYPES):
+            d[key] = value.id
+    return d
+
+
+class DocumentLoader:
+    """
+    Loads a document graph breadth-first, resolving every reference at the same depth with a
+    single get_all round trip.
+
+    The loader keeps an identity map of everything it has fetched, so a document referenced by
+    several parents (e.g. a user that is on two teams) is only read once. Create one per request,
+    it never expires what it has already loaded.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._identity_map = {}
+        self.round_trips = 0
+
+    def get_many(self, refs):
+        """Return snapshots for refs in the same order, None for documents that don't exist."""
+        missing = {}
+        for ref in refs:
+            path = ref_path(ref)
+            record_dependency(ref_collection(ref), ref.id)
+            if path not in self._identity_map and path not in missing:
+                missing[path] = ref
+
+        if len(missing) > 0:
+            self.round_trips += 1
+            for snapshot in self.db.get_all(list(missing.values())):
+                self.remember(snapshot)
+            # Anything get_all didn't return doesn't exist
+            for path in missing:
+                self._identity_map.setdefault(path, None)
+            logger.debug(f"DocumentLoader fetched {len(missing)} documents")
+
+        return [self._identity_map[ref_path(ref)] for ref in refs]
+
+    def remember(self, snapshot):
+        path = ref_path(snapshot.reference)
+        record_dependency(ref_collection(snapshot.reference), snapshot.id)
+        self._identity_map[path] = snapshot if snapshot.exists else None
+
+    def load(self, root, expand=()):
+        results = self.load_all([root], expand=expand)
+        return results[0] if len(results) > 0 else None
+
+    def load_all(self, roots, expand=()):
+        """
+        Convert roots (DocumentSnapshot, DocumentReference or an already fetched dict with an "id")
+        into JSON dicts, expanding the references named in expand.
+
+        Expanded fields hold the referenced documents as dicts, everything else that is a reference
+        is replaced with the referenced document id. Missing documents are dropped.
+        """
+        spec = parse_expand_spec(expand)
+
+        snapshots = []
+        to_fetch = []
+        for root in roots:
+            if isinstance(root, REFERENCE_TYPES):
+                to_fetch.append(root)
+            elif isinstance(root, SNAPSHOT_TYPES):
+                self.remember(root)
+        self.get_many(to_fetch)
+
+        nodes = []
+        for root in roots:
+            if isinstance(root, dict):
+                node = self._to_node(dict(root), spec)
+            else:
+                snapshot = self._identity_map.get(ref_path(root.reference if isinstance(root, SNAPSHOT_TYPES) else root))
+                if snapshot is None:
+                    continue
+                node = self._snapshot_to_node(snapshot, spec)
+            nodes.append(node)
+
+        pending = [(node, spec) for node in nodes]
+        while len(pending) > 0:
+            pending = self._expand_level(pending)
+
+        return nodes
+
+    def _expand_level(self, pending):
+        refs = []
+        for node, spec in pending:
+            for field in spec:
+                refs.extend(self._references_in(node.get(field)))
+        self.get_many(refs)
+
+        next_pending = []
+        for node, spec in pending:
+            for field, child_spec in spec.items():
+                value = node.get(field)
+                if isinstance(value, list):
+                    children = []
+                    for v in value:
+                        child = self._resolve(v, child_spec)
+                        if child is not None:
+                            children.append(child)
+                            next_pending.append((child, child_spec))
+                    node[field] = children
+                elif value is not None:
+                    child = self._resolve(value, child_spec)
+                    node[field] = child
+                    if child is not None:
+                        next_pending.append((child, child_spec))
+
+        return [(node, spec) for node, spec in next_pending if len(spec) > 0]
+
+    def _resolve(self, value, spec):
+        if isinstance(value, REFERENCE_TYPES):
+            snapshot = self._identity_map.get(ref_path(value))
+            if snapshot is None:
+                logger.warning(f"DocumentLoader could not resolve {ref_path(value)}, skipping")
+                return None
+            return self._snapshot_to_node(snapshot, spec)
+        if isinstance(value, SNAPSHOT_TYPES):
+            return self._snapshot_to_node(value, spec)
+        return value
+
+    def _references_in(self, value):
+        if isinstance(value, list):
+            return [v for v in value if isinstance(v, REFERENCE_TYPES)]
+        if isinstance(value, REFERENCE_TYPES):
+            return [value]
+        return []
+
+    def _snapshot_to_node(self, snapshot, spec):
+        d = snapshot.to_dict() or {}
+        # Each parent gets its own copy so expanding one doesn't change another
+        node = self._to_node(dict(d), spec)
+        node["id"] = snapshot.id
+        return node
+
+    def _to_node(self, d, spec):
+        return flatten_references(d, keep=spec.keys())
@@ -0,0 +1,250 @@
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+# Retries back off exponentially from OUTBOX_BACKOFF_SECONDS up to OUTBOX_MAX_BACKOFF_SECONDS
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", "2"))
+MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "15")) * 60
+# How long an idle worker sleeps before looking for due retries
+POLL_INTERVAL_SECONDS = 1
+# A job still marked running after this long belonged to a worker that died, it is picked up again
+STALE_RUNNING_SECONDS = 10 * 60
+
+
+class PermanentError(Exception):
+    """Raised by a task when retrying can't help, e.g. the Slack channel doesn't exist."""
+
+
+class Outbox:
+    """
+    Durable queue of side effects (Slack messages, emails) stored in a SQLite file.
+
+    Jobs are JSON kwargs for a task registered with @task. Workers claim one job at a time inside
+    a write transaction so each is handled by one thread of one process, delete it once the task
+    returns, and reschedule it with exponential backoff when it raises. After MAX_ATTEMPTS (or a
+    PermanentError) the job is kept with status 'failed' for someone to look at.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        c = self._connection()
+        c.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT NOT NULL, args TEXT NOT NULL,
+            status TEXT NOT NULL, attempts INTEGER NOT NULL, next_attempt REAL NOT NULL,
+            locked_at REAL, last_error TEXT, created REAL NOT NULL)""")
+        c.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_attempt)")
+
+    def _connection(self):
+        local = self._local
+        # Connections must not be shared with the process we were forked from
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            local.connection.execute("PRAGMA journal_mode=WAL")
+            local.pid = os.getpid()
+        return local.connection
+
+    def put(self, task_name, kwargs):
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (task, args, status, attempts, next_attempt, created) VALUES (?, ?, 'pending', 0, ?, ?)",
+            (task_name, json.dumps(kwargs), now, now))
+        return cursor.lastrowid
+
+    def claim(self, task_names):
+        """Mark the oldest due job for one of task_names as running and return (id, task, kwargs, attempts)."""
+        if len(task_names) == 0:
+            return None
+        now = time.time()
+        placeholders = ",".join("?" * len(task_names))
+        c = self._connection()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute(
+                f"""SELECT id, task, args, attempts FROM jobs
+                    WHERE task IN ({placeholders}) AND (
+                        (status = 'pending' AND next_attempt <= ?) OR (status = 'running' AND locked_at < ?))
+                    ORDER BY next_attempt, id LIMIT 1""",
+                (*task_names, now, now - STALE_RUNNING_SECONDS)).fetchone()
+            if row is not None:
+                c.execute("UPDATE jobs SET status = 'running', locked_at = ? WHERE id = ?", (now, row[0]))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]), row[3]
+
+    def complete(self, job_id):
+        self._connection().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def retry(self, job_id, attempts, error):
+        delay = min(BACKOFF_SECONDS * (2 ** (attempts - 1)), MAX_BACKOFF_SECONDS)
+        # Jitter so jobs that failed together (e.g. Slack was down) don't all retry at once
+        delay = delay * random.uniform(0.5, 1.0)
+        self._connection().execute(
+            "UPDATE jobs SET status = 'pending', attempts = ?, next_attempt = ?, locked_at = NULL, last_error = ? WHERE id = ?",
+            (attempts, time.time() + delay, error, job_id))
+        return delay
+
+    def fail(self, job_id, attempts, error):
+        self._connection().execute(
+            "UPDATE jobs SET status = 'failed', attempts = ?, locked_at = NULL, last_error = ? WHERE id = ?",
+            (attempts, error, job_id))
+
+    def counts(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+
+_tasks = {}
+
+
+def task(name):
+    """Register the decorated function as the handler for outbox jobs called name."""
+    def decorator(func):
+        _tasks[name] = func
+        return func
+    return decorator
+
+
+def default_path():
+    # Not /dev/shm like the shared cache: queued jobs should survive a reboot where the disk does
+    return os.path.join(tempfile.gettempdir(), "ohack-outbox.sqlite3")
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+_wakeup = threading.Event()
+# The pid workers were started in, they don't survive a fork so a forked worker starts its own
+_workers_pid = None
+_worker_count = 0
+
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox(os.getenv("OUTBOX_PATH", default_path()))
+    return _outbox
+
+
+def set_outbox(outbox):
+    """Swap the outbox, e.g. for tests. Returns the previous one."""
+    global _outbox
+    with _outbox_lock:
+        previous = _outbox
+        _outbox = outbox
+    return previous
+
+
+def enqueue(task_name, **kwargs):
+    """
+    Queue task_name(**kwargs) to run on a background worker and return right away. kwargs must be JSON
+    serializable.
+
+    Processes that never called start_workers() (scripts, tests) have nobody to drain the queue, so
+    there the task runs inline, as it did before the outbox existed.
+    """
+    if task_name not in _tasks:
+        raise ValueError(f"Unknown outbox task {task_name}")
+
+    if _workers_pid is None:
+        _run_inline(task_name, kwargs)
+        return None
+
+    _ensure_workers()
+    try:
+        job_id = get_outbox().put(task_name, kwargs)
+    except sqlite3.Error as e:
+        # Better late than never: if the queue is unusable deliver on the request thread
+        logger.error(f"Outbox: could not queue {task_name}, running it inline: {e}")
+        _run_inline(task_name, kwargs)
+        return None
+    _wakeup.set()
+    return job_id
+
+
+def _run_inline(task_name, kwargs):
+    try:
+        _tasks[task_name](**kwargs)
+    except Exception as e:
+        logger.error(f"Outbox: {task_name} failed: {e}")
+
+
+def run_pending(limit=None):
+    """Run due jobs on the calling thread until none are left (or limit were run). Returns how many ran."""
+    outbox = get_outbox()
+    ran = 0
+    while limit is None or ran < limit:
+        job = outbox.claim(list(_tasks))
+        if job is None:
+            break
+        _run_job(outbox, *job)
+        ran += 1
+    return ran
+
+
+def _run_job(outbox, job_id, task_name, kwargs, attempts):
+    attempts += 1
+    try:
+        _tasks[task_name](**kwargs)
+    except PermanentError as e:
+        logger.error(f"Outbox: {task_name} job {job_id} failed permanently: {e}")
+        outbox.fail(job_id, attempts, str(e))
+        return
+    except Exception as e:
+        if attempts >= MAX_ATTEMPTS:
+            logger.error(f"Outbox: {task_name} job {job_id} failed {attempts} times, giving up: {e}")
+            outbox.fail(job_id, attempts, str(e))
+        else:
+            delay = outbox.retry(job_id, attempts, str(e))
+            logger.warning(f"Outbox: {task_name} job {job_id} failed (attempt {attempts}), retrying in {delay:.0f}s: {e}")
+        return
+    outbox.complete(job_id)
+
+
+def _work():
+    while True:
+        try:
+            ran = run_pending(limit=1)
+        except Exception as e:
+            logger.error(f"Outbox: worker error: {e}")
+            ran = 0
+        if ran == 0:
+            _wakeup.wait(POLL_INTERVAL_SECONDS)
+            _wakeup.clear()
+
+
+def _ensure_workers():
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _outbox_lock:
+        if _workers_pid == os.getpid():
+            return
+        for i in range(_worker_count):
+            threading.Thread(target=_work, name=f"outbox-{i}", daemon=True).start()
+        _workers_pid = os.getpid()
+
+
+def start_workers(count=None):
+    """Start the background threads that drain the outbox in this process (OUTBOX_WORKERS, default 2)."""
+    global _worker_count
+    if _workers_pid is not None:
+        return
+    _worker_count = count if count is not None else int(os.getenv("OUTBOX_WORKERS", "2"))
+    _ensure_workers()
@@ -0,0 +1,222 @@
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context, request
+from common.exceptions import RateLimitExceededError
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+
+class TokenBucket:
+    """
+    In-process token bucket: rate tokens per second refill up to capacity, acquire() blocks until one
+    is available. Safe to share between threads, e.g. a pool of workers calling the same API.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hand out nothing for seconds, e.g. when the API answered with a Retry-After."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+# Rows for idle clients are swept every this many checks
+PRUNE_EVERY_N_CALLS = 1000
+
+
+class RateLimitBackend:
+    """
+    Token buckets shared by every gunicorn worker on the host, so a limit means the same thing however
+    many workers are running.
+    """
+
+    def try_acquire(self, key, rate, capacity):
+        """Take a token from the bucket called key. Returns 0 if we got one, otherwise seconds until one is due."""
+        return 0
+
+
+class NullRateLimitBackend(RateLimitBackend):
+    """Disables rate limiting."""
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Buckets in this process only, for development or when the SQLite file can't be opened."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def try_acquire(self, key, rate, capacity):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, retry_after = _take(tokens, updated, now, rate, capacity)
+            self._buckets[key] = (tokens, now)
+        return retry_after
+
+
+class SQLiteRateLimitBackend(RateLimitBackend):
+    """RateLimitBackend stored in a SQLite file, by default on /dev/shm (tmpfs) next to the shared cache."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _connection(self):
+        local = self._local
+        # Connections must not be shared with the process we were forked from
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            local.connection.execute("PRAGMA journal_mode=WAL")
+            local.connection.execute("PRAGMA synchronous=OFF")
+            local.pid = os.getpid()
+        return local.connection
+
+    def try_acquire(self, key, rate, capacity):
+        now = time.time()
+        c = self._connection()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens, retry_after = _take(tokens, updated, now, rate, capacity)
+            c.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+        self._calls += 1
+        if self._calls % PRUNE_EVERY_N_CALLS == 0:
+            # Buckets nobody touched for an hour are full again, the same as not having a row
+            c.execute("DELETE FROM buckets WHERE updated < ?", (now - 60 * 60,))
+        return retry_after
+
+
+def _take(tokens, updated, now, rate, capacity):
+    tokens = min(capacity, tokens + max(0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+def create_rate_limit_backend():
+    """Build the backend from RATE_LIMIT_BACKEND (sqlite, memory or none) and RATE_LIMIT_PATH."""
+    backend = os.getenv("RATE_LIMIT_BACKEND", "sqlite")
+    if backend == "none":
+        return NullRateLimitBackend()
+    if backend == "memory":
+        return MemoryRateLimitBackend()
+    if backend == "sqlite":
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        path = os.getenv("RATE_LIMIT_PATH", os.path.join(directory, "ohack-rate-limit.sqlite3"))
+        try:
+            return SQLiteRateLimitBackend(path)
+        except sqlite3.Error as e:
+            logger.error(f"Could not open rate limit buckets at {path}, limiting per worker only: {e}")
+            return MemoryRateLimitBackend()
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {backend}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_rate_limit_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_rate_limit_backend()
+    return _backend
+
+
+def set_rate_limit_backend(backend):
+    """Swap the backend, e.g. for tests. Returns the previous one."""
+    global _backend
+    with _backend_lock:
+        previous = _backend
+        _backend = backend
+    return previous
+
+
+def client_identity():
+    """Who is calling: the signed in Propel user if there is one, otherwise the client's IP."""
+    if not has_request_context():
+        # Background refreshes, scripts, outbox workers
+        return "internal"
+    user = getattr(g, "propelauth_current_user", None)
+    user_id = getattr(user, "user_id", None)
+    if user_id:
+        return f"user:{user_id}"
+    # Heroku's router appends the address it saw, anything before it came from the client
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for:
+        return f"ip:{forwarded_for.split(',')[-1].strip()}"
+    return f"ip:{request.remote_addr}"
+
+
+def limits(calls, period):
+    """
+    Allow each client calls calls to the decorated function every period seconds, counted across all
+    workers, and raise RateLimitExceededError (a 429 with Retry-After) past that.
+
+    A drop-in for ratelimit.limits, which counted every client together and per worker. Put it under
+    @dependency_cached so only calls that reach Firestore are counted.
+    """
+    rate = calls / period
+
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            endpoint = request.endpoint if has_request_context() else None
+            key = f"{client_identity()}|{endpoint}|{name}"
+            try:
+                retry_after = get_rate_limit_backend().try_acquire(key, rate, calls)
+            except sqlite3.Error as e:
+                # Don't turn a broken limiter into an outage
+                logger.error(f"Rate limiter unavailable, allowing {name}: {e}")
+                retry_after = 0
+            if retry_after > 0:
+                logger.warning(f"Rate limited {key}, retry in {retry_after:.1f}s")
+                raise RateLimitExceededError(f"Too many requests, try again in {math.ceil(retry_after)} seconds",
+                                             retry_after=retry_after)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
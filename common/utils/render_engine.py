@@ -0,0 +1,188 @@
+import multiprocessing
+import multiprocessing.forkserver
+import os
+import pickle
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+# Processes drawing and encoding images, 0 renders on the upload threads instead
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(os.cpu_count() or 1)))
+# Threads uploading finished images, these mostly wait on the network
+RENDER_UPLOAD_THREADS = int(os.getenv("RENDER_UPLOAD_THREADS", "8"))
+
+# Times a render is sent to the render processes when they die under it, e.g. killed out of memory
+RENDER_ATTEMPTS = 2
+
+# Set in the render processes, see in_render_process()
+_render_process = False
+
+
+def in_render_process():
+    """True in a RenderEngine worker process, which must leave work like refilling shared caches to its parent."""
+    return _render_process
+
+
+def _start_render_process(warmers):
+    global _render_process
+    _render_process = True
+    for warm in warmers:
+        try:
+            warm()
+        except Exception as e:
+            # Whatever it is gets loaded by the first render that needs it instead
+            logger.error(f"Could not warm {warm.__name__} in render process {os.getpid()}: {e}")
+
+
+class RenderEngine:
+    """
+    Renders images in a pool of worker processes, so several certificates are drawn and PNG encoded
+    at once instead of taking turns on the GIL, and publishes them (upload, Firestore) on a pool of
+    threads as each render finishes.
+
+    Render functions must be module level and take and return picklable values. Workers are started
+    from a fork server rather than forked from the gunicorn worker, which by then runs threads (outbox,
+    cache refreshes, Slack, gRPC) whose locks a fork could copy mid-use. Modules registered with
+    preload() are imported once in the fork server, and functions registered with
+    warm_in_render_processes() run in every worker as it starts.
+    """
+
+    def __init__(self, processes=RENDER_PROCESSES, upload_threads=RENDER_UPLOAD_THREADS):
+        self.processes = processes
+        self.upload_threads = upload_threads
+        self._lock = threading.Lock()
+        self._pid = None
+        self._process_pool = None
+        self._upload_pool = None
+        self._preload = set()
+        self._warmers = []
+
+    def preload(self, module):
+        """
+        Import module in the fork server, so render processes start with it instead of each importing it
+        for their first render. Only counts if registered before the render processes first start.
+        """
+        with self._lock:
+            self._preload.add(module)
+
+    def warm_in_render_processes(self, warm):
+        """Call warm(), a module level function, in every render process as it starts. Its module is preloaded."""
+        # Sent to the fork server, fail here rather than in every render process
+        pickle.dumps(warm)
+        with self._lock:
+            self._warmers.append(warm)
+            self._preload.add(warm.__module__)
+
+    def start(self):
+        """
+        Start the fork server now rather than on the first render, e.g. from a gunicorn post_fork hook. Call it
+        once the modules registering preloads and warmers are imported.
+        """
+        process_pool, _ = self._pools()
+        if process_pool is not None:
+            multiprocessing.forkserver.ensure_running()
+
+    def _pools(self):
+        with self._lock:
+            # Pools can't be shared with the process we were forked from, and are still that process's to shut down
+            if self._pid != os.getpid():
+                self._process_pool = self._new_process_pool() if self.processes > 0 else None
+                self._upload_pool = ThreadPoolExecutor(max_workers=self.upload_threads, thread_name_prefix="render upload")
+                self._pid = os.getpid()
+            return self._process_pool, self._upload_pool
+
+    def _new_process_pool(self):
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(sorted(self._preload))
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                   initializer=_start_render_process, initargs=(tuple(self._warmers),))
+
+    def _replace(self, broken):
+        with self._lock:
+            if self._process_pool is broken and self._pid == os.getpid():
+                # A worker was killed, e.g. out of memory
+                logger.error("Render processes died, starting new ones")
+                broken.shutdown(wait=False)
+                self._process_pool = self._new_process_pool()
+
+    def _submit_render(self, render, *args, **kwargs):
+        result = Future()
+        self._attempt(result, RENDER_ATTEMPTS, render, args, kwargs)
+        return result
+
+    def _attempt(self, result, attempts, render, args, kwargs):
+        process_pool, upload_pool = self._pools()
+        if process_pool is None:
+            submitted = upload_pool.submit(render, *args, **kwargs)
+        else:
+            try:
+                submitted = process_pool.submit(render, *args, **kwargs)
+            except BrokenProcessPool as e:
+                submitted = Future()
+                submitted.set_exception(e)
+        submitted.add_done_callback(
+            lambda done: self._settle(result, done, process_pool, attempts, render, args, kwargs))
+
+    def _settle(self, result, done, process_pool, attempts, render, args, kwargs):
+        try:
+            result.set_result(done.result())
+        except BrokenProcessPool as e:
+            if process_pool is None:
+                result.set_exception(e)
+                return
+            # Whether it broke before or while this render ran, try it again on new processes
+            self._replace(process_pool)
+            if attempts > 1:
+                logger.warning(f"Render processes died during {render.__name__}, rendering it again")
+                self._attempt(result, attempts - 1, render, args, kwargs)
+            else:
+                result.set_exception(e)
+        except BaseException as e:
+            result.set_exception(e)
+
+    def render(self, render, *args, **kwargs):
+        """Run render(*args, **kwargs) in a worker process and return what it returned."""
+        return self._submit_render(render, *args, **kwargs).result()
+
+    def map(self, render, publish, items):
+        """
+        Call render(item) for every item in the worker processes and publish(item, rendered) on the upload
+        threads as soon as that item's render is done. Returns what publish returned, in the order of items,
+        and raises the first error in that order once everything has finished.
+        """
+        _, upload_pool = self._pools()
+        published = []
+        for item in items:
+            result = Future()
+            self._submit_render(render, item).add_done_callback(
+                lambda rendered, item=item, result=result: self._publish(upload_pool, publish, item, rendered, result))
+            published.append(result)
+
+        results = []
+        error = None
+        for future in published:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    @staticmethod
+    def _publish(upload_pool, publish, item, rendered, result):
+        def run():
+            try:
+                result.set_result(publish(item, rendered.result()))
+            except Exception as e:
+                result.set_exception(e)
+        upload_pool.submit(run)
+
+
+render_engine = RenderEngine()
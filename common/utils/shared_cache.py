@@ -0,0 +1,263 @@
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+# How long invalidation events are kept for workers that haven't polled yet
+EVENT_RETENTION_SECONDS = 60 * 60
+# Expired entries are swept every this many writes
+PRUNE_EVERY_N_SETS = 200
+
+
+def _encode_key(key):
+    # hashkey() tuples repr the same way in every worker for the str/int arguments we cache on
+    return repr(tuple(key)) if isinstance(key, tuple) else repr(key)
+
+
+def _encode_dep(dep):
+    return json.dumps(list(dep))
+
+
+class SharedCacheBackend:
+    """
+    Second level cache shared by every gunicorn worker on the host, sitting behind the per-process
+    caches in common/utils/cache.py.
+
+    Entries are stored with the documents they depend on (see record_dependency) so invalidating a
+    document removes them for everyone. Invalidations and clears are also published as events,
+    which each worker polls to evict its own in-process copies.
+    """
+
+    def get(self, namespace, key):
+        """Return (value, deps, expires) or None on a miss."""
+        return None
+
+    def set(self, namespace, key, value, deps, expires, seen_seq=None):
+        """Store value unless events newer than seen_seq were published, it may be stale then."""
+        pass
+
+    def invalidate(self, deps, documents):
+        pass
+
+    def clear(self, namespace=None):
+        pass
+
+    def poll(self, after_seq):
+        """Return (events published by other processes after after_seq, latest seq)."""
+        return [], after_seq
+
+    def latest_seq(self):
+        return 0
+
+
+class NullSharedCache(SharedCacheBackend):
+    """Disables the shared tier, every worker only has its own in-process cache."""
+
+
+class SQLiteSharedCache(SharedCacheBackend):
+    """
+    SharedCacheBackend stored in a SQLite file, by default on /dev/shm (tmpfs) so it never touches
+    the disk. Safe to use from several threads and forked worker processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._origin_lock = threading.Lock()
+        self._origin = None
+        self._origin_pid = None
+        self._sets = 0
+        self._create_tables()
+
+    @property
+    def origin(self):
+        # Identifies this process in the events it publishes, shared by all its threads. A forked
+        # worker gets its own
+        with self._origin_lock:
+            if self._origin_pid != os.getpid():
+                self._origin_pid = os.getpid()
+                self._origin = f"{os.getpid()}-{uuid.uuid4().hex}"
+            return self._origin
+
+    def _connection(self):
+        local = self._local
+        # Connections must not be shared with the process we were forked from
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            local.connection.execute("PRAGMA journal_mode=WAL")
+            local.connection.execute("PRAGMA synchronous=OFF")
+            local.pid = os.getpid()
+        return local.connection
+
+    def _create_tables(self):
+        c = self._connection()
+        c.execute("""CREATE TABLE IF NOT EXISTS entries (
+            namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, deps TEXT NOT NULL,
+            expires REAL NOT NULL, PRIMARY KEY (namespace, key))""")
+        c.execute("""CREATE TABLE IF NOT EXISTS entry_deps (
+            namespace TEXT NOT NULL, key TEXT NOT NULL, dep TEXT NOT NULL)""")
+        c.execute("CREATE INDEX IF NOT EXISTS entry_deps_dep ON entry_deps (dep)")
+        c.execute("CREATE INDEX IF NOT EXISTS entry_deps_entry ON entry_deps (namespace, key)")
+        c.execute("""CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, kind TEXT NOT NULL,
+            payload TEXT NOT NULL, created REAL NOT NULL)""")
+
+    def get(self, namespace, key):
+        row = self._connection().execute(
+            "SELECT value, deps, expires FROM entries WHERE namespace = ? AND key = ? AND expires > ?",
+            (namespace, _encode_key(key), time.time())).fetchone()
+        if row is None:
+            return None
+        try:
+            value = pickle.loads(row[0])
+        except Exception as e:
+            # e.g. pickled by an older deploy
+            logger.warning(f"SQLiteSharedCache: could not load {namespace} {key}: {e}")
+            return None
+        deps = frozenset(tuple(dep) for dep in json.loads(row[1]))
+        return value, deps, row[2]
+
+    def set(self, namespace, key, value, deps, expires, seen_seq=None):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.debug(f"SQLiteSharedCache: {namespace} result can't be pickled, keeping it local: {e}")
+            return
+
+        encoded_key = _encode_key(key)
+        c = self._connection()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if seen_seq is not None:
+                latest = c.execute("SELECT MAX(seq) FROM events").fetchone()[0] or 0
+                if latest > seen_seq:
+                    # Another worker invalidated something since we polled, what we read may be stale
+                    c.execute("ROLLBACK")
+                    return
+            c.execute("DELETE FROM entry_deps WHERE namespace = ? AND key = ?", (namespace, encoded_key))
+            c.execute("INSERT OR REPLACE INTO entries (namespace, key, value, deps, expires) VALUES (?, ?, ?, ?, ?)",
+                      (namespace, encoded_key, blob, json.dumps([list(dep) for dep in deps]), expires))
+            c.executemany("INSERT INTO entry_deps (namespace, key, dep) VALUES (?, ?, ?)",
+                          [(namespace, encoded_key, _encode_dep(dep)) for dep in deps])
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+        self._sets += 1
+        if self._sets % PRUNE_EVERY_N_SETS == 0:
+            self._prune()
+
+    def invalidate(self, deps, documents):
+        encoded = [_encode_dep(dep) for dep in deps]
+        c = self._connection()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            for dep in encoded:
+                c.execute("""DELETE FROM entries WHERE (namespace, key) IN
+                    (SELECT namespace, key FROM entry_deps WHERE dep = ?)""", (dep,))
+                c.execute("""DELETE FROM entry_deps WHERE (namespace, key) IN
+                    (SELECT namespace, key FROM entry_deps WHERE dep = ?)""", (dep,))
+            self._publish(c, "invalidate", {"documents": [list(d) for d in documents]})
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+    def clear(self, namespace=None):
+        c = self._connection()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if namespace is None:
+                c.execute("DELETE FROM entries")
+                c.execute("DELETE FROM entry_deps")
+            else:
+                c.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+                c.execute("DELETE FROM entry_deps WHERE namespace = ?", (namespace,))
+            self._publish(c, "clear", {"namespace": namespace})
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+    def poll(self, after_seq):
+        rows = self._connection().execute(
+            "SELECT seq, origin, kind, payload FROM events WHERE seq > ? ORDER BY seq", (after_seq,)).fetchall()
+        if len(rows) == 0:
+            return [], after_seq
+        events = [(kind, json.loads(payload)) for seq, origin, kind, payload in rows if origin != self.origin]
+        return events, rows[-1][0]
+
+    def latest_seq(self):
+        row = self._connection().execute("SELECT MAX(seq) FROM events").fetchone()
+        return row[0] or 0
+
+    def _publish(self, c, kind, payload):
+        c.execute("INSERT INTO events (origin, kind, payload, created) VALUES (?, ?, ?, ?)",
+                  (self.origin, kind, json.dumps(payload), time.time()))
+
+    def _prune(self):
+        now = time.time()
+        c = self._connection()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("""DELETE FROM entry_deps WHERE (namespace, key) IN
+                (SELECT namespace, key FROM entries WHERE expires <= ?)""", (now,))
+            c.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+            c.execute("DELETE FROM events WHERE created < ?", (now - EVENT_RETENTION_SECONDS,))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+
+def default_path():
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "ohack-shared-cache.sqlite3")
+
+
+def create_shared_cache():
+    """Build the backend from SHARED_CACHE_BACKEND (sqlite or none) and SHARED_CACHE_PATH."""
+    backend = os.getenv("SHARED_CACHE_BACKEND", "sqlite")
+    if backend == "none":
+        return NullSharedCache()
+    if backend == "sqlite":
+        path = os.getenv("SHARED_CACHE_PATH", default_path())
+        try:
+            return SQLiteSharedCache(path)
+        except sqlite3.Error as e:
+            logger.error(f"Could not open shared cache at {path}, caching per worker only: {e}")
+            return NullSharedCache()
+    raise ValueError(f"Unknown SHARED_CACHE_BACKEND {backend}")
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = create_shared_cache()
+    return _shared_cache
+
+
+def set_shared_cache(backend):
+    """Swap the backend, e.g. for tests. Returns the previous one."""
+    global _shared_cache
+    with _shared_cache_lock:
+        previous = _shared_cache
+        _shared_cache = backend
+    return previous
@@ -1,7 +1,12 @@
 import requests
 from . import safe_get_env_var
 import datetime, json
-from ratelimiter import RateLimiter
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from slack_sdk import WebClient
 from slack_sdk.models.blocks import SectionBlock
 from slack_sdk.errors import SlackApiError
@@ -9,6 +14,8 @@ from dotenv import load_dotenv
 from requests.exceptions import ConnectionError
 from cachetools import TTLCache, cached
 from ratelimit import limits, sleep_and_retry
+from .outbox import enqueue, task, PermanentError
+from .rate_limit import TokenBucket
 
 load_dotenv()
 
@@ -28,62 +35,110 @@ def send_slack_audit(action="", message="", payload=None):
         logger.warning("SLACK_URL not set, returning")
         return
 
-    json = {
-        "text": f"[{action}] {message}"
-    }
-
+    text = f"[{action}] {message}"
     if payload:
-        json = {
-            "text": f"[{action}] {message}\n{payload}"
-        }
+        # Formatted now, payloads can hold DocumentReferences and other things that aren't JSON
+        text = f"[{action}] {message}\n{payload}"
 
-    try: 
-        requests.post(json=json, url=SLACK_URL)
-    except ConnectionError:
-        pass #Eat this error. The request from the frontend should not fail if we can't contact slack
+    enqueue("slack.audit", text=text)
 
 
-@RateLimiter(max_calls=40, period=60)
-def presence(user_id=None):
-    if user_id is None:
-        return
-    client = get_client()
-    return client.users_getPresence(user=user_id)
+@task("slack.audit")
+def deliver_slack_audit(text):
+    # Raising lets the outbox retry, the request that triggered the audit has already returned
+    response = requests.post(json={"text": text}, url=SLACK_URL, timeout=10)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise ConnectionError(f"Slack webhook returned {response.status_code}")
+    if response.status_code >= 400:
+        raise PermanentError(f"Slack webhook returned {response.status_code}: {response.text}")
 
-@RateLimiter(max_calls=20, period=60)
-def userlist():
-    client = get_client()
-    return client.users_list()
 
+# users.getPresence is a Tier 3 method (50+ calls a minute)
+PRESENCE_CALLS_PER_MINUTE = int(os.getenv("SLACK_PRESENCE_CALLS_PER_MINUTE", "50"))
+PRESENCE_WORKERS = 8
+# A scan right after another one reuses what it saw
+PRESENCE_TTL = 60
+PRESENCE_RETRIES = 3
 
-def get_active_users():
-    aresult = []
-    counter = 0
-    for member in userlist()["members"]:
+
+class PresenceScanner:
+    """
+    Looks up the presence of every human member of the workspace.
+
+    Members come from a paginated users_list with deleted users and bots dropped before any presence
+    call. Lookups run on a small thread pool that shares one token bucket, so we stay under Slack's
+    limit without waiting on each call's round trip, and results are yielded as they arrive.
+    """
+
+    def __init__(self, calls_per_minute=PRESENCE_CALLS_PER_MINUTE, workers=PRESENCE_WORKERS, ttl=PRESENCE_TTL):
+        self.workers = workers
+        self.bucket = TokenBucket(rate=calls_per_minute / 60, capacity=workers)
+        self.cache = TTLCache(maxsize=20000, ttl=ttl)
+        self._cache_lock = threading.Lock()
+
+    def scan(self, members=None):
+        """Yield (member, presence) for every active human member, presence is None if Slack wouldn't say."""
+        client = get_client()
+        members = (m for m in (members if members is not None else list_members(client)) if is_active_human(m))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for member in members:
+                # Don't read the whole member list ahead of the lookups
+                if len(pending) >= self.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(executor.submit(self._lookup, client, member))
+            for future in as_completed(pending):
+                yield future.result()
+
+    def _lookup(self, client, member):
+        user_id = member["id"]
+        with self._cache_lock:
+            cached_presence = self.cache.get(user_id)
+        if cached_presence is not None:
+            return member, cached_presence
+
+        for attempt in range(PRESENCE_RETRIES):
+            self.bucket.acquire()
+            try:
+                result = client.users_getPresence(user=user_id)["presence"]
+            except SlackApiError as e:
+                if e.response.status_code == 429:
+                    retry_after = int(e.response.headers.get("Retry-After", 30))
+                    logger.warning(f"Rate limited by users.getPresence, pausing {retry_after}s")
+                    self.bucket.pause(retry_after)
+                    continue
+                logger.error(f"Error fetching presence for {user_id}: {e}")
+                return member, None
+            with self._cache_lock:
+                self.cache[user_id] = result
+            return member, result
+        return member, None
+
+
+def is_active_human(member):
+    return not member.get("deleted", False) and not member.get("is_bot", False) and member["id"] != "USLACKBOT"
+
+
+presence_scanner = PresenceScanner()
+
+
+def iter_active_users():
+    """Yield a line for each member that is online right now, as the presence scan finds them."""
+    for member, here in presence_scanner.scan():
+        if here is None or here == "away":
+            continue
         # get updated time in seconds and print as date
         updated = datetime.datetime.fromtimestamp(
             member["updated"]).strftime('%Y-%m-%d %H:%M:%S')
-
-        # Print the 5th member raw details
-        here = False        
-        #print(json.dumps(member, indent=4, sort_keys=True))              
-
-        deleted = True if ("deleted" in member and member["deleted"]) else False            
-        if not deleted:            
-            here = presence(user_id=member["id"])["presence"] != "away"
-        
-        
-        is_email_confirmed = member["is_email_confirmed"] if "is_email_confirmed" in member else ""
-        display_name = member["profile"]["display_name_normalized"] if "display_name" in member["profile"] else ""
         real_name = member["profile"]["real_name_normalized"] if "real_name" in member["profile"] else ""
+        yield f"@{real_name} | {member['name']} ({member['id']}) - {updated}"
 
-        # If last updated in the last 30 days, add to list
-        #if (datetime.datetime.now() - datetime.datetime.fromtimestamp(member["updated"])).days < 30:
-        if(here):
-            aresult.append(f"@{real_name} | {member['name']} ({member['id']}) - {updated}")
-        
-    print(len(aresult))        
 
+def get_active_users():
+    aresult = list(iter_active_users())
+    print(len(aresult))
     return aresult
 
 
@@ -109,39 +164,167 @@ def get_client():
     return client
 
 
+# Re-list every channel in the workspace this often
+CHANNEL_DIRECTORY_TTL = 60*60
+# A name we don't know about (e.g. created in Slack since the last listing) re-lists at most this often
+CHANNEL_DIRECTORY_MISS_REFRESH = 5*60
+
+
+class ChannelDirectory:
+    """
+    Channel name -> id for every channel in the workspace. Archived channels are listed too, since their
+    names can't be reused, but get() doesn't return them.
+
+    Listed with full cursor pagination, refreshed every CHANNEL_DIRECTORY_TTL seconds and updated in
+    place when we create a channel, so looking up a channel doesn't cost a conversations_list call.
+    """
+
+    def __init__(self, ttl=CHANNEL_DIRECTORY_TTL, miss_refresh=CHANNEL_DIRECTORY_MISS_REFRESH):
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        # Guards the fields below, never held while calling Slack
+        self._lock = threading.Lock()
+        # One listing at a time, lookups that need it wait for it and use what it found
+        self._refreshing = threading.Lock()
+        self._ids = {}
+        self._archived = set()
+        self._loaded_at = None
+        # Channels added while a listing is running, which it may have missed
+        self._added = None
+
+    def get(self, channel_name):
+        with self._lock:
+            if self._loaded_at is not None and time.time() - self._loaded_at <= self.ttl:
+                channel_id = self._ids.get(channel_name)
+                if channel_id is not None or time.time() - self._loaded_at <= self.miss_refresh:
+                    return None if channel_name in self._archived else channel_id
+            loaded_at = self._loaded_at
+
+        with self._refreshing:
+            with self._lock:
+                # Listed by someone else while we waited
+                refreshed = self._loaded_at != loaded_at
+            if not refreshed:
+                self._refresh()
+        with self._lock:
+            return None if channel_name in self._archived else self._ids.get(channel_name)
+
+    def is_archived(self, channel_name):
+        """True if channel_name belongs to an archived channel, as of the last listing."""
+        self.get(channel_name)
+        with self._lock:
+            return channel_name in self._archived
+
+    def add(self, channel_name, channel_id):
+        with self._lock:
+            self._ids[channel_name] = channel_id
+            self._archived.discard(channel_name)
+            if self._added is not None:
+                self._added[channel_name] = channel_id
+
+    def clear(self):
+        with self._lock:
+            self._ids = {}
+            self._archived = set()
+            self._loaded_at = None
+
+    def _refresh(self):
+        with self._lock:
+            self._added = {}
+        try:
+            ids, archived, pages = self._list()
+        except SlackApiError as e:
+            with self._lock:
+                self._added = None
+                if self._loaded_at is None:
+                    raise
+                # Keep using what we have rather than failing every lookup, try again after the next TTL
+                logger.error(f"Could not refresh slack channels, keeping the previous list: {e}")
+                self._loaded_at = time.time()
+            return
+
+        with self._lock:
+            ids.update(self._added)
+            self._ids = ids
+            self._archived = archived - set(self._added)
+            self._added = None
+            self._loaded_at = time.time()
+        logger.info(f"Loaded {len(ids)} slack channels in {pages} pages")
+
+    def _list(self):
+        client = get_client()
+        ids = {}
+        archived = set()
+        cursor = None
+        pages = 0
+        while True:
+            result = client.conversations_list(exclude_archived=False, limit=1000, cursor=cursor)
+            pages += 1
+            for c in result["channels"]:
+                ids[c["name"]] = c["id"]
+                if c.get("is_archived"):
+                    archived.add(c["name"])
+            cursor = result.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+        return ids, archived, pages
+
+
+channel_directory = ChannelDirectory()
+
+
 def get_channel_id_from_channel_name(channel_name):
-    # Get channel name
-    client = get_client()
-    result = client.conversations_list(exclude_archived=True, limit=1000)
+    # Slack channel names are always lowercase, anything else is an id (e.g. a user id for a DM)
+    if not channel_name or channel_name != channel_name.lower():
+        return None
 
     logger.info(f"Looking for slack channel {channel_name}...")
-    for c in result["channels"]:
-        if c["name"] == channel_name:
-            logger.info(f"Found Channel! {channel_name}")
-            return c["id"]
-    return None
+    channel_id = channel_directory.get(channel_name)
+    if channel_id is not None:
+        logger.info(f"Found Channel! {channel_name}")
+    return channel_id
 
 
+# conversations_invite accepts at most this many users per call
+MAX_USERS_PER_INVITE = 1000
+
 def invite_user_to_channel(user_id, channel_name):
-    logger.debug("invite_user_to_channel start")
+    invite_users_to_channel([user_id], channel_name)
+
+
+def invite_users_to_channel(user_ids, channel_name):
+    """
+    Invite several users to a channel: the channel is looked up once, the bot joins it once and
+    the users are invited with one conversations_invite per MAX_USERS_PER_INVITE users.
+    """
+    logger.debug("invite_users_to_channel start")
     client = get_client()
     channel_id = get_channel_id_from_channel_name(channel_name)
     logger.info(f"Channel ID: {channel_id}")
 
-    # If user_id has a - in it, use split to get the last part
-    if "-" in user_id:
-        user_id = user_id.split("-")[1]        
+    # If user_id has a - in it (oauth2|slack|T1Q7936BH-U041117EYTQ), use split to get the last part
+    slack_ids = list(dict.fromkeys(u.split("-")[1] if "-" in u else u for u in user_ids if u))
+    if len(slack_ids) == 0:
+        return
 
     try:
         client.conversations_join(channel=channel_id)
-        result = client.conversations_invite(channel=channel_id, users=user_id)        
     except Exception as e:
-        logger.error(
-            "Caught exception - this might be okay if the user is already in the channel.")
-        #log error
+        logger.error(f"Caught exception joining {channel_name}")
         logger.error(e)
 
-    logger.debug("invite_user_to_channel end")
+    for i in range(0, len(slack_ids), MAX_USERS_PER_INVITE):
+        chunk = slack_ids[i:i + MAX_USERS_PER_INVITE]
+        try:
+            # force invites the valid users even when some are invalid or already in the channel
+            client.conversations_invite(channel=channel_id, users=",".join(chunk), force=True)
+        except Exception as e:
+            logger.error(
+                "Caught exception - this might be okay if the users are already in the channel.")
+            #log error
+            logger.error(e)
+
+    logger.debug("invite_users_to_channel end")
 
 def create_slack_channel(channel_name):
     logger.debug("create_slack_channel start")
@@ -152,11 +335,24 @@ def create_slack_channel(channel_name):
     if channel_id is not None:
         logger.info(f"Channel {channel_name} already exists with id {channel_id}")
         return channel_id
+    if channel_directory.is_archived(channel_name):
+        # Slack doesn't free the names of archived channels
+        logger.error(f"Channel {channel_name} is archived, unarchive it in Slack or use another name")
+        return None
 
     try:
         result = client.conversations_create(name=channel_name)
         logger.info(f"Created channel {channel_name} with id {result['channel']['id']}")
+        # The next send_slack/invite_user_to_channel for it shouldn't have to re-list the workspace
+        channel_directory.add(channel_name, result["channel"]["id"])
         return result["channel"]["id"]
+    except SlackApiError as e:
+        if e.response["error"] == "name_taken":
+            # e.g. a private channel the bot can't see, or archived since the last listing
+            logger.error(f"Channel {channel_name} already exists but isn't one we can use")
+        else:
+            logger.error("Caught exception")
+            logger.error(e)
     except Exception as e:
         logger.error("Caught exception")
         logger.error(e)
@@ -164,6 +360,15 @@ def create_slack_channel(channel_name):
 
 
 def send_slack(message="", channel="", icon_emoji=None, username="Hackathon Bot"):
+    enqueue("slack.send", message=message, channel=channel, icon_emoji=icon_emoji, username=username)
+
+
+# Errors that will happen again however many times the message is retried
+PERMANENT_SLACK_ERRORS = {"channel_not_found", "not_in_channel", "is_archived", "msg_too_long",
+                          "no_text", "invalid_blocks", "user_not_found", "account_inactive"}
+
+@task("slack.send")
+def deliver_slack(message="", channel="", icon_emoji=None, username="Hackathon Bot"):
     client = get_client()
     channel_id = get_channel_id_from_channel_name(channel)
     logger.info(f"Got channel id {channel_id}")
@@ -189,8 +394,9 @@ def send_slack(message="", channel="", icon_emoji=None, username="Hackathon Bot"
         )
     except SlackApiError as e:
         logger.error(e.response["error"])
-        assert e.response["error"]
-
+        if e.response["error"] in PERMANENT_SLACK_ERRORS:
+            raise PermanentError(e.response["error"])
+        raise
 
 
 
@@ -209,6 +415,205 @@ def rate_limited_get_user_info(user_id):
         logger.error(f"Error fetching info for user {user_id}: {e}")
         return None
 
+USERS_LIST_PAGE_SIZE = 200
+
+def list_members(client=None):
+    """Every member of the workspace, following users_list cursors a page at a time."""
+    client = client or get_client()
+    cursor = None
+    while True:
+        result = users_list_page(client, cursor)
+        for member in result["members"]:
+            yield member
+        cursor = result.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            break
+
+# users.list is a Tier 2 method
+@sleep_and_retry
+@limits(calls=20, period=60)
+def users_list_page(client, cursor=None):
+    return client.users_list(limit=USERS_LIST_PAGE_SIZE, cursor=cursor)
+
+
+def profile_from_user(user_info):
+    return {
+        "id": user_info["id"],
+        "name": user_info["name"],
+        "real_name": user_info.get("real_name", ""),
+        "display_name": user_info["profile"].get("display_name", ""),
+        "email": user_info["profile"].get("email", ""),
+        "is_admin": user_info.get("is_admin", False),
+        "is_owner": user_info.get("is_owner", False),
+        "is_bot": user_info.get("is_bot", False),
+        "updated": user_info.get("updated", 0)
+    }
+
+
+# Profiles are re-listed in the background once the last full listing is older than this
+SLACK_PROFILE_TTL = 24*60*60
+# An id we don't know about re-lists the workspace at most this often, otherwise it's looked up alone
+SLACK_PROFILE_MISS_REFRESH = 10*60
+# An id users_info couldn't find isn't looked up again for this long
+SLACK_PROFILE_FAILED_LOOKUP_TTL = 5*60
+
+
+class SlackProfileCache:
+    """
+    Slack user id -> profile (see profile_from_user) for every member of the workspace.
+
+    Warmed with a paginated users_list (a couple of hundred users per call instead of one users_info
+    each) and saved to a SQLite file, so a restarted worker starts warm. Only a worker with nothing
+    saved waits for the first listing. After that profiles are re-listed in a background thread, when
+    they are older than ttl or an id we don't know about turns up, and served as they are meanwhile.
+    """
+
+    def __init__(self, path, ttl=SLACK_PROFILE_TTL, miss_refresh=SLACK_PROFILE_MISS_REFRESH,
+                 failed_lookup_ttl=SLACK_PROFILE_FAILED_LOOKUP_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        # Guards the profiles in memory, never held while calling Slack
+        self._lock = threading.Lock()
+        # One users_list listing at a time
+        self._warm_lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = None
+        self._warmed_at = None
+        self._warming = False
+        self._failed_lookups = TTLCache(maxsize=10000, ttl=failed_lookup_ttl)
+
+    def get_many(self, user_ids):
+        user_ids = set(user_ids)
+        with self._lock:
+            self._load()
+            cold = self._warmed_at is None
+        if cold:
+            # Nothing to serve yet, one listing is far cheaper than looking everyone up alone
+            with self._warm_lock:
+                if self._warmed_at is None:
+                    self._warm()
+
+        with self._lock:
+            now = time.time()
+            missing = user_ids - self._profiles.keys()
+            relist = len(missing) > 0 and now - self._warmed_at > self.miss_refresh
+            stale = now - self._warmed_at > self.ttl
+            missing = {user_id for user_id in missing if user_id not in self._failed_lookups}
+
+        if relist or stale:
+            self._warm_in_background()
+
+        # e.g. people from another workspace in a shared channel, they aren't in our users_list
+        for user_id in missing:
+            user_info = rate_limited_get_user_info(user_id)
+            if user_info:
+                self.add([profile_from_user(user_info)])
+            else:
+                with self._lock:
+                    self._failed_lookups[user_id] = True
+
+        profiles = self._profiles
+        return {user_id: profiles[user_id] for user_id in user_ids if user_id in profiles}
+
+    def add(self, profiles):
+        with self._lock:
+            self._load()
+            self._profiles = {**self._profiles, **{profile["id"]: profile for profile in profiles}}
+        self._save(profiles)
+
+    def warm(self):
+        with self._warm_lock:
+            self._warm()
+
+    def clear(self):
+        with self._lock:
+            self._profiles = None
+            self._warmed_at = None
+            self._failed_lookups.clear()
+
+    def _warm(self):
+        # Listing takes a while, requests keep being answered from the profiles we already have
+        try:
+            profiles = [profile_from_user(member) for member in list_members()]
+        except SlackApiError as e:
+            # Don't re-list on every miss while Slack is failing, single lookups still work
+            logger.error(f"Could not list slack users, keeping the previous profiles: {e}")
+            with self._lock:
+                self._warmed_at = time.time()
+            return
+
+        warmed_at = time.time()
+        with self._lock:
+            self._load()
+            self._profiles = {**self._profiles, **{profile["id"]: profile for profile in profiles}}
+            self._warmed_at = warmed_at
+            for profile in profiles:
+                self._failed_lookups.pop(profile["id"], None)
+        self._save(profiles, warmed_at=warmed_at)
+        logger.info(f"Loaded {len(profiles)} slack profiles")
+
+    def _warm_in_background(self):
+        with self._lock:
+            if self._warming:
+                return
+            self._warming = True
+
+        def run():
+            try:
+                self.warm()
+            finally:
+                with self._lock:
+                    self._warming = False
+        threading.Thread(target=run, name="slack profiles", daemon=True).start()
+
+    def _connection(self):
+        local = self._local
+        # Connections must not be shared with the process we were forked from
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            local.connection.execute("PRAGMA journal_mode=WAL")
+            local.connection.execute(
+                "CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, profile TEXT NOT NULL)")
+            local.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+            local.pid = os.getpid()
+        return local.connection
+
+    def _load(self):
+        if self._profiles is not None:
+            return
+        self._profiles = {}
+        try:
+            c = self._connection()
+            for user_id, profile in c.execute("SELECT user_id, profile FROM profiles"):
+                self._profiles[user_id] = json.loads(profile)
+            row = c.execute("SELECT value FROM meta WHERE key = 'warmed_at'").fetchone()
+            self._warmed_at = row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Could not read slack profiles from {self.path}: {e}")
+
+    def _save(self, profiles, warmed_at=None):
+        try:
+            c = self._connection()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                c.executemany("INSERT OR REPLACE INTO profiles (user_id, profile) VALUES (?, ?)",
+                              [(profile["id"], json.dumps(profile)) for profile in profiles])
+                if warmed_at is not None:
+                    c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('warmed_at', ?)", (warmed_at,))
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # Still cached in memory, the next worker to start just has to list the users again
+            logger.error(f"Could not save slack profiles to {self.path}: {e}")
+
+
+slack_profiles = SlackProfileCache(os.getenv(
+    "SLACK_PROFILE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "ohack-slack-profiles.sqlite3")))
+
+
 def get_user_info(user_ids):
     """
     Fetch user information for a list of Slack user IDs.
@@ -216,23 +621,4 @@ def get_user_info(user_ids):
     :param user_ids: List of Slack user IDs (e.g., ["U049S78NLCA", "U049S78NLCB"])
     :return: Dictionary of user information, keyed by user ID
     """
-    client = get_client()    
-
-    # Fetch user info for all unique slack_ids
-    users_info = {}
-    for user_id in user_ids:
-        user_info = rate_limited_get_user_info(user_id)
-        if user_info:
-            users_info[user_id] = {
-                "id": user_info["id"],
-                "name": user_info["name"],
-                "real_name": user_info.get("real_name", ""),
-                "display_name": user_info["profile"].get("display_name", ""),
-                "email": user_info["profile"].get("email", ""),
-                "is_admin": user_info.get("is_admin", False),
-                "is_owner": user_info.get("is_owner", False),
-                "is_bot": user_info.get("is_bot", False),
-                "updated": user_info.get("updated", 0)
-            }
-
-    return users_info
\ No newline at end of file
+    return slack_profiles.get_many(user_ids)
@@ -29,6 +29,10 @@ def fetch_user_by_db_id(id):
     u = db.fetch_user_by_db_id(id)
     return u
 
+def fetch_user_by_email(email_address):
+    u = db.fetch_user_by_email(email_address)
+    return u
+
 def upsert_profile_metadata(user: User):
     return db.upsert_profile_metadata(user)
 
@@ -10,6 +10,7 @@ from model.user import User
 from model.hackathon import Hackathon
 from model.nonprofit import Nonprofit
 from db.interface import DatabaseInterface
+from db.user_index import UserIndex
 import logging
 import uuid
 import logging
@@ -42,7 +43,35 @@ def convert_to_entity(doc: firestore.firestore.DocumentSnapshot, cls):
     d['id'] = doc.id
     return cls.deserialize(d)
 
+def fetch_all_by_id(db, refs):
+    """
+    Resolve a list of DocumentReferences with a single get_all round trip.
+
+    Duplicate references are only requested once. Returns a dict of doc id -> DocumentSnapshot,
+    missing documents are left out.
+    """
+    unique_refs = {}
+    for ref in refs:
+        if ref is not None and ref.id not in unique_refs:
+            unique_refs[ref.id] = ref
+
+    if len(unique_refs) == 0:
+        return {}
+
+    snapshots = {}
+    for snapshot in db.get_all(list(unique_refs.values())):
+        if snapshot.exists:
+            snapshots[snapshot.id] = snapshot
+
+    logger.debug(f"fetch_all_by_id requested {len(unique_refs)} refs, found {len(snapshots)}")
+    return snapshots
+
 class FirestoreDatabaseInterface(DatabaseInterface):
+    def __init__(self):
+        super().__init__()
+        # Saves a where() query on user_id/email_address for users this worker has already seen
+        self.user_index = UserIndex()
+
     def get_db(self):
         if safe_get_env_var("ENVIRONMENT") == "test":
             return mockfirestore
@@ -71,12 +100,54 @@ class FirestoreDatabaseInterface(DatabaseInterface):
         else:
             slack_user_id = f"{SLACK_PREFIX}{user_id}"
 
+        u = self._fetch_indexed_user(db, self.user_index.get_by_user_id(slack_user_id), "user_id", slack_user_id)
+        if u is not None:
+            return u
+
         u = None
         try:
             u, *rest = db.collection('users').where("user_id", "==", slack_user_id).stream()
         except ValueError:
             pass
+        self._index_user(u)
+        return u
+
+    def fetch_user_by_email(self, email_address):
+        db = self.get_db()
+        user = None
+        raw = self.fetch_user_by_email_raw(db, email_address)
+        if raw is not None:
+            user = convert_to_entity(raw, User)
+        return user
+
+    def fetch_user_by_email_raw(self, db, email_address):
+        u = self._fetch_indexed_user(db, self.user_index.get_by_email(email_address), "email_address", email_address)
+        if u is not None:
+            return u
+
+        u = None
+        try:
+            u, *rest = db.collection('users').where("email_address", "==", email_address).stream()
+        except ValueError:
+            pass
+        self._index_user(u)
         return u
+
+    def _fetch_indexed_user(self, db, db_id, field, value):
+        if db_id is None:
+            return None
+        u = db.collection('users').document(db_id).get()
+        if u.exists and (u.to_dict() or {}).get(field) == value:
+            return u
+        # Deleted or changed by another worker since we indexed it
+        logger.debug(f"User index entry {field}={value} -> {db_id} is stale, dropping it")
+        self.user_index.remove(db_id)
+        return None
+
+    def _index_user(self, u):
+        if u is not None and u.exists:
+            d = u.to_dict() or {}
+            self.user_index.add(u.id, d.get("user_id"), d.get("email_address"))
     
     def fetch_user_by_db_id_raw(self, db, id):
         u = db.collection('users').document(id).get()
@@ -101,6 +172,7 @@ class FirestoreDatabaseInterface(DatabaseInterface):
             ],
             "teams": []
         })
+        self.user_index.add(user.id, user.user_id, user.email_address)
         return user if insert_res is not None else None
     
     def update_user(self, user: User):
@@ -153,41 +225,56 @@ class FirestoreDatabaseInterface(DatabaseInterface):
                 user = User.deserialize(d)
 
                 if "hackathons" in d:
-                    #TODO: I think we use get_all here
-                    # https://cloud.google.com/python/docs/reference/firestore/latest/google.cloud.firestore_v1.client.Client#google_cloud_firestore_v1_client_Client_get_all
-                    for h in d["hackathons"]:
-                        h_doc = h.get()
-                        rec = h_doc.to_dict()
-                        rec['id'] = h_doc.id
-
-                        hackathon = Hackathon.deserialize(rec)
-                        user.hackathons.append(hackathon)
-
-                        #TODO: I think we use get_all here
-                        # https://cloud.google.com/python/docs/reference/firestore/latest/google.cloud.firestore_v1.client.Client#google_cloud_firestore_v1_client_Client_get_all
-                        for n in rec["nonprofits"]:
-                            
-                            npo_doc = n.get() #TODO: Deal with lazy-loading in db layer
-                            npo_id = npo_doc.id
-                            npo = n.get().to_dict()
-                            npo["id"] = npo_id
-                                            
-                            if npo and "problem_statements" in npo:
-                                # This is duplicate date as we should already have this
-                                del npo["problem_statements"]
-                            hackathon.nonprofits.append(npo)
-
-                        user.hackathons.append(hackathon)
+                    user.hackathons = self.resolve_user_hackathons(db, d["hackathons"])
 
                 #TODO:
                 # if "badges" in res:
                 #     for h in res["badges"]:
                 #         _badges.append(h.get().to_dict())
 
-                
+
 
         return user
 
+    def resolve_user_hackathons(self, db, hackathon_refs):
+        # Resolve one level of the reference graph at a time so that the number of round trips
+        # is bounded by the depth (hackathons -> nonprofits) and not by the number of references
+        # https://cloud.google.com/python/docs/reference/firestore/latest/google.cloud.firestore_v1.client.Client#google_cloud_firestore_v1_client_Client_get_all
+        hackathon_docs = fetch_all_by_id(db, hackathon_refs)
+
+        nonprofit_refs = []
+        for h_doc in hackathon_docs.values():
+            nonprofit_refs.extend(h_doc.to_dict().get("nonprofits", []))
+        nonprofit_docs = fetch_all_by_id(db, nonprofit_refs)
+
+        hackathons = []
+        for h in hackathon_refs:
+            h_doc = hackathon_docs.get(h.id) if h is not None else None
+            if h_doc is None:
+                logger.warning(f"Hackathon reference {h} could not be resolved, skipping")
+                continue
+
+            rec = h_doc.to_dict()
+            rec['id'] = h_doc.id
+            hackathon = Hackathon.deserialize(rec)
+            hackathon.nonprofits = []
+
+            for n in rec.get("nonprofits", []):
+                npo_doc = nonprofit_docs.get(n.id)
+                if npo_doc is None:
+                    continue
+
+                npo = npo_doc.to_dict()
+                npo["id"] = npo_doc.id
+                if "problem_statements" in npo:
+                    # This is duplicate date as we should already have this
+                    del npo["problem_statements"]
+                hackathon.nonprofits.append(npo)
+
+            hackathons.append(hackathon)
+
+        return hackathons
+
     def upsert_profile_metadata(self, user:User):
     
         db = self.get_db()  # this connects to our Firestore database
@@ -199,7 +286,7 @@ class FirestoreDatabaseInterface(DatabaseInterface):
     
 
     def finish_deleting_user(self, db, user, user_id):
-        if user is None:
+        if user is None or not user.exists:
             logger.error(f"**ERROR User {user_id} does not exist")
             raise Exception(f"User {user_id} does not exist")
 
@@ -212,7 +299,8 @@ class FirestoreDatabaseInterface(DatabaseInterface):
                 db.collection("teams").document(team.id).set({"users": team_users}, merge=True)
 
         # Delete user
-        db.collection("users").document(user_id).delete()
+        db.collection("users").document(user.id).delete()
+        self.user_index.remove(user.id)
 
     def delete_user_by_user_id(self, user_id):
         db = self.get_db()  # this connects to our Firestore database
@@ -220,20 +308,20 @@ class FirestoreDatabaseInterface(DatabaseInterface):
         
 
         # Get user
-        user = self.fetch_user_raw_by_user_id(db, user_id)
+        user = self.fetch_user_by_user_id_raw(db, user_id)
         self.finish_deleting_user(db, user, user_id)
 
-        return User.deserialize(user.to_dict())
+        return convert_to_entity(user, User)
 
     def delete_user_by_db_id(self, user_id):
         db = self.get_db()  # this connects to our Firestore database
         logger.info(f"Deleting user {user_id}")
 
         # Get user
-        user = self.fetch_user_raw_by_db_id(db, user_id)
+        user = self.fetch_user_by_db_id_raw(db, user_id)
         self.finish_deleting_user(db, user, user_id)
 
-        return User.deserialize(user.to_dict())
+        return convert_to_entity(user, User)
 
     def fetch_users(self):
         results = []
@@ -110,6 +110,15 @@ class InMemoryDatabaseInterface(DatabaseInterface):
             logger.debug(f'fetch_user_by_db_id error: {e}')
         return res
     
+    def fetch_user_by_email(self, email_address):
+        res = None
+        try:
+            temp = next(iter(self.users.where(email_address=email_address)), None)
+            res = User.deserialize(vars(temp)) if temp is not None else None
+        except KeyError as e:
+            logger.debug(f'fetch_user_by_email error: {e}')
+        return res
+
     #TODO: Kill with fire. Leaky abstraction
     def get_user_doc_reference(self, user_id):
         return None
@@ -0,0 +1,58 @@
+import threading
+
+
+class UserIndex:
+    """
+    In-process secondary index of users: Slack user_id -> db id and email address -> db id.
+
+    It is kept up to date by the database interface on insert, update and delete, but other
+    workers write users too, so a hit is only a hint: callers read the document by id and check it
+    still matches before trusting it, and call remove() when it doesn't.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_user_id = {}
+        self._by_email = {}
+        # db id -> (user_id, email), so a user's old keys can be dropped when they change
+        self._keys = {}
+
+    def get_by_user_id(self, user_id):
+        with self._lock:
+            return self._by_user_id.get(user_id)
+
+    def get_by_email(self, email):
+        if not email:
+            return None
+        with self._lock:
+            return self._by_email.get(email)
+
+    def add(self, db_id, user_id=None, email=None):
+        with self._lock:
+            self._remove(db_id)
+            if user_id:
+                self._by_user_id[user_id] = db_id
+            if email:
+                self._by_email[email] = db_id
+            self._keys[db_id] = (user_id, email)
+
+    def remove(self, db_id):
+        with self._lock:
+            self._remove(db_id)
+
+    def clear(self):
+        with self._lock:
+            self._by_user_id.clear()
+            self._by_email.clear()
+            self._keys.clear()
+
+    def _remove(self, db_id):
+        user_id, email = self._keys.pop(db_id, (None, None))
+        if user_id and self._by_user_id.get(user_id) == db_id:
+            del self._by_user_id[user_id]
+        if email and self._by_email.get(email) == db_id:
+            del self._by_email[email]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
@@ -2,6 +2,7 @@ import gunicorn.http.wsgi
 from functools import wraps
 
 from common.utils import safe_get_env_var
+from common.utils.shared_cache import get_shared_cache
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -18,3 +19,13 @@ def wrap_default_headers(func):
     return default_headers
 
 gunicorn.http.wsgi.Response.default_headers = wrap_default_headers(gunicorn.http.wsgi.Response.default_headers)
+
+def on_starting(server):
+    # The shared cache outlives worker restarts, don't serve entries pickled by the previous release
+    get_shared_cache().clear()
+
+def post_fork(server, worker):
+    # Start the render processes' fork server at boot, so the first certificate request doesn't wait on it.
+    # --preload has imported the app by now, so every module it preloads is registered
+    from common.utils.render_engine import render_engine
+    render_engine.start()
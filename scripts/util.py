@@ -12,7 +12,7 @@ logger.addHandler(logging.StreamHandler())
 # set log level
 logger.setLevel(logging.INFO)
 #
-from common.utils.slack import send_slack, get_active_users
+from common.utils.slack import send_slack, iter_active_users
 #TODO: Bunch of unused imports here
 from common.utils.firebase import get_hackathon_by_event_id, create_new_hackathon, add_reference_link_to_problem_statement, create_new_problem_statement, link_nonprofit_to_problem_statement, link_problem_statement_to_hackathon_event, get_nonprofit_by_id, add_image_to_nonprofit_by_nonprofit_id, add_image_to_nonprofit, add_nonprofit_to_hackathon, create_new_problem_statement, create_new_nonprofit, create_new_hackathon, link_nonprofit_to_problem_statement, link_problem_statement_to_hackathon_event, get_nonprofit_by_name, create_team, add_user_by_email_to_team, add_user_by_slack_id_to_team, add_team_to_hackathon, add_problem_statement_to_team, get_user_by_user_id, add_reference_link_to_problem_statement, get_user_by_email, create_user, add_user_to_team, delete_user_by_id, get_team_by_name, get_user_by_id, remove_user_from_team
 from common.utils.cdn import upload_to_cdn
@@ -130,7 +130,9 @@ elif args.action == "add_image_to_nonprofit":
 elif args.action == "send_slack":
     send_slack(channel=args.slack_channel, message=args.slack_message)
 elif args.action == "active_slack_users":
-    print("\n".join(get_active_users()))
+    # Printed as the scan finds them, it takes a while on a big workspace
+    for line in iter_active_users():
+        print(line, flush=True)
 elif args.action == "create_new_nonprofit":
     create_new_nonprofit(
         name=args.nonprofit_name, description=args.description, 
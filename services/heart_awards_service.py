@@ -0,0 +1,231 @@
+import csv
+import io
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from common.exceptions import InvalidInputError
+from common.utils.firebase import get_db, get_user_by_user_id, award_hearts_to_users, HEART_REASONS
+from common.utils.render_engine import render_engine
+from services import hearts_service
+
+# add logger
+import logging
+logger = logging.getLogger("myapp")
+# set log level
+logger.setLevel(logging.DEBUG)
+
+HEART_AWARD_JOBS = "heart_award_jobs"
+MAX_AWARDS_PER_JOB = 1000
+JOB_WORKERS = 8
+# How many awards can be in each stage at once. Rendering is CPU bound and its limit is the number of
+# render processes, the rest wait on the network
+STAGE_LIMITS = {"upload": 4, "db": 4, "slack": 2}
+# Hearts are written for this many users per commit as their certificates finish
+AWARD_BATCH_SIZE = 50
+# Progress is written to the job document at most this often
+PROGRESS_INTERVAL_SECONDS = 1
+
+
+def parse_heart_awards_csv(text):
+    """
+    Read awards from a CSV with a slackUsername, amount, reasons header. Several reasons are separated
+    by ; e.g. U012127EYAQ,1,code_quality;documentation
+    """
+    awards = []
+    for row in csv.DictReader(io.StringIO(text)):
+        awards.append({
+            "slackUsername": (row.get("slackUsername") or "").strip(),
+            "amount": row.get("amount"),
+            "reasons": [reason.strip() for reason in (row.get("reasons") or "").split(";") if reason.strip()],
+        })
+    return validate_heart_awards(awards)
+
+
+def validate_heart_awards(awards):
+    if not isinstance(awards, list) or len(awards) == 0:
+        raise InvalidInputError("awards must be a non-empty list")
+    if len(awards) > MAX_AWARDS_PER_JOB:
+        raise InvalidInputError(f"At most {MAX_AWARDS_PER_JOB} awards per job")
+
+    result = []
+    for i, award in enumerate(awards):
+        if not isinstance(award, dict) or not award.get("slackUsername"):
+            raise InvalidInputError(f"Award {i} is missing slackUsername")
+        try:
+            amount = float(award.get("amount"))
+        except (TypeError, ValueError):
+            raise InvalidInputError(f"Award {i} has an invalid amount")
+        # Hearts are given in whole numbers, or half a heart
+        if not (math.isfinite(amount) and amount > 0 and (amount.is_integer() or amount == 0.5)):
+            raise InvalidInputError(f"Award {i} must be a whole number of hearts or 0.5")
+        if amount.is_integer():
+            amount = int(amount)
+        reasons = award.get("reasons")
+        if not isinstance(reasons, list) or len(reasons) == 0:
+            raise InvalidInputError(f"Award {i} needs at least 1 reason")
+        invalid = [reason for reason in reasons if reason not in HEART_REASONS]
+        if invalid:
+            raise InvalidInputError(f"Award {i} has invalid reasons: {invalid}")
+        result.append({"slackUsername": award["slackUsername"], "amount": amount, "reasons": reasons})
+    return result
+
+
+class BulkHeartAwardJob:
+    """
+    Gives hearts to a list of people, e.g. everyone after judging, the way give_hearts_to_user does for one.
+
+    Each award is looked up, gets its certificate rendered in the render processes and uploaded on a
+    shared pool with STAGE_LIMITS capping each stage, and is written in AWARD_BATCH_SIZE batches of
+    Increment updates before being announced on Slack. Progress is kept in the heart_award_jobs document for polling.
+    The job runs in the worker that accepted it, if that worker restarts the job stays 'running'.
+    """
+
+    def __init__(self, awards, created_by=None, create_certificate_image=True, generate_backround_image=False, job_id=None):
+        self.id = job_id or uuid.uuid1().hex
+        self.awards = awards
+        self.created_by = created_by
+        self.create_certificate_image = create_certificate_image
+        self.generate_backround_image = generate_backround_image
+        self.stages = {name: threading.Semaphore(limit) for name, limit in STAGE_LIMITS.items()}
+        self._lock = threading.Lock()
+        self._progress = {"processed": 0, "succeeded": 0, "failed": 0, "errors": []}
+        self._written_at = 0
+
+    @property
+    def ref(self):
+        return get_db().collection(HEART_AWARD_JOBS).document(self.id)
+
+    def start(self):
+        self.ref.set({
+            "status": "queued",
+            "total": len(self.awards),
+            "processed": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "errors": [],
+            "created_by": self.created_by,
+            "created": datetime.now().isoformat(),
+            "updated": datetime.now().isoformat(),
+        })
+        threading.Thread(target=self.run, name=f"hearts job {self.id}", daemon=True).start()
+        return self.id
+
+    def run(self):
+        logger.info(f"Starting bulk heart award job {self.id} for {len(self.awards)} awards")
+        self._write({"status": "running"})
+        background_path = hearts_service.BACKUP_BACKGROUND_LOC
+        generated_background = None
+        try:
+            if self.create_certificate_image and self.generate_backround_image:
+                # One OpenAI background for the whole job instead of one per certificate
+                generated_background = os.path.join(tempfile.gettempdir(), f"heart_award_background_{self.id}.png")
+                hearts_service.generate_background_image(generated_background)
+                background_path = generated_background
+
+            ready = []
+            with ThreadPoolExecutor(max_workers=JOB_WORKERS) as executor:
+                futures = {executor.submit(self._prepare, award, background_path): award for award in self.awards}
+                for future in as_completed(futures):
+                    award = futures[future]
+                    try:
+                        ready.append(future.result())
+                    except Exception as e:
+                        self._record(award, error=e)
+                    if len(ready) >= AWARD_BATCH_SIZE:
+                        self._award(ready)
+                        ready = []
+            if ready:
+                self._award(ready)
+        except Exception as e:
+            logger.error(f"Bulk heart award job {self.id} failed: {e}")
+            self._write({"status": "failed", "error": str(e)}, force=True)
+            return
+        finally:
+            if generated_background is not None and os.path.exists(generated_background):
+                os.remove(generated_background)
+
+        self._write({"status": "done"}, force=True)
+        logger.info(f"Finished bulk heart award job {self.id}: {self._progress['succeeded']} succeeded, {self._progress['failed']} failed")
+
+    def _prepare(self, award, background_path):
+        slack_user_id = award["slackUsername"]
+        with self.stages["db"]:
+            user = get_user_by_user_id(slack_user_id)
+        if user is None or "id" not in user:
+            raise Exception(f"User with slack id {slack_user_id} not found")
+
+        certificate_text = ""
+        if self.create_certificate_image:
+            filename = render_engine.render(hearts_service.render_certificate_image,
+                                            user["name"], award["reasons"], award["amount"], background_path=background_path)
+            try:
+                with self.stages["upload"]:
+                    hearts_service.upload_to_cdn("certificates", filename)
+                with self.stages["db"]:
+                    hearts_service.add_certificate(user_id=user["id"], certificate=filename)
+            finally:
+                os.remove(filename)
+            certificate_text = f"\nCertificate: {hearts_service.CDN_SERVER}/certificates/{filename}"
+
+        return award, user["id"], certificate_text
+
+    def _award(self, ready):
+        try:
+            with self.stages["db"]:
+                award_hearts_to_users([(user_id, award["amount"], award["reasons"]) for award, user_id, _ in ready])
+        except Exception as e:
+            for award, _, _ in ready:
+                self._record(award, error=e)
+            return
+
+        for award, _, certificate_text in ready:
+            try:
+                with self.stages["slack"]:
+                    hearts_service.announce_hearts(award["slackUsername"], award["amount"], award["reasons"], certificate_text)
+            except Exception as e:
+                # The hearts were given, only the announcement is missing
+                logger.error(f"Could not announce hearts for {award['slackUsername']}: {e}")
+            self._record(award)
+
+    def _record(self, award, error=None):
+        with self._lock:
+            self._progress["processed"] += 1
+            if error is None:
+                self._progress["succeeded"] += 1
+            else:
+                logger.error(f"Bulk heart award job {self.id}: {award['slackUsername']} failed: {error}")
+                self._progress["failed"] += 1
+                self._progress["errors"].append({"slackUsername": award["slackUsername"], "error": str(error)})
+        self._write()
+
+    def _write(self, fields=None, force=False):
+        with self._lock:
+            now = time.time()
+            if not force and fields is None and now - self._written_at < PROGRESS_INTERVAL_SECONDS:
+                return
+            self._written_at = now
+            update = dict(self._progress, errors=list(self._progress["errors"]), updated=datetime.now().isoformat())
+        update.update(fields or {})
+        self.ref.set(update, merge=True)
+
+
+def start_bulk_heart_award(created_by, awards, create_certificate_image=True, generate_backround_image=False):
+    job = BulkHeartAwardJob(awards, created_by=created_by, create_certificate_image=create_certificate_image,
+                            generate_backround_image=generate_backround_image)
+    job.start()
+    return {"job_id": job.id, "status": "queued", "total": len(awards)}
+
+
+def get_bulk_heart_award(job_id):
+    doc = get_db().collection(HEART_AWARD_JOBS).document(job_id).get()
+    if not doc.exists:
+        return None
+    result = doc.to_dict()
+    result["job_id"] = doc.id
+    return result
@@ -1,6 +1,6 @@
 from datetime import datetime
 import os
-from ratelimit import limits
+from common.utils.rate_limit import limits
 import requests
 from db.db import delete_nonprofit, fetch_npo, fetch_npos, insert_nonprofit, update_nonprofit
 from model.nonprofit import Nonprofit
@@ -1,5 +1,5 @@
 from datetime import datetime
-from ratelimit import limits
+from common.utils.rate_limit import limits
 from common.utils.slack import invite_user_to_channel, send_slack, send_slack_audit
 from model.problem_statement import ProblemStatement
 from model.user import User
@@ -1,14 +1,14 @@
 from datetime import datetime
 import os
-from ratelimit import limits
+import time
+from common.utils.rate_limit import limits
 import requests
 from common.utils.slack import send_slack_audit
 from model.user import User
 from db.db import delete_user_by_db_id, delete_user_by_user_id, fetch_user_by_user_id, fetch_user_by_db_id, fetch_users, insert_user, update_user, get_user_profile_by_db_id, upsert_profile_metadata
 import logging
 import pytz
-from cachetools import cached, LRUCache, TTLCache
-from cachetools.keys import hashkey
+from common.utils.cache import dependency_cached, invalidate_documents, record_dependency
 from common.log import get_log_level
 
 logger = logging.getLogger("myapp")
@@ -20,9 +20,29 @@ ONE_MINUTE = 1*60
 #TODO: get last part of this from env
 USER_ID_PREFIX = "oauth2|slack|T1Q7936BH-" #the followed by UXXXXX for slack
 
+# Propel id -> Slack identity, so authenticated calls don't each pay the Propel and Slack round trips
+SLACK_IDENTITY_TTL = 15*60
+# Stop using an identity this long before the Slack token it came from expires
+SLACK_TOKEN_EXPIRY_MARGIN = 60
+# Not a Firestore collection, cached identities depend on (SLACK_IDENTITY, propel_id) so logout can evict them
+SLACK_IDENTITY = "slack_identity"
+
+class UncachedSlackIdentity(Exception):
+    # Raised out of the cached lookup so a result that must not be kept is never stored
+    def __init__(self, slack_user):
+        super().__init__()
+        self.slack_user = slack_user
+
 def clear_cache():        
     get_profile_metadata.cache_clear()
 
+def invalidate_slack_identity(propel_id=None):
+    # Call on logout, or with no propel_id to forget everyone. Reaches every worker
+    if propel_id is None:
+        fetch_slack_identity.cache_clear()
+    else:
+        invalidate_documents((SLACK_IDENTITY, propel_id))
+
 def finish_saving_insert(
         user_id=None,
         email=None,
@@ -132,6 +152,21 @@ def get_user_from_propel_user_id(propel_id):
     return get_user_from_slack_id(user_id)
 
 def get_slack_user_from_propel_user_id(propel_id):
+    try:
+        slack_user, expires = fetch_slack_identity(propel_id)
+        if expires <= time.time():
+            # Cached from a Slack token that has expired since
+            invalidate_slack_identity(propel_id)
+            slack_user, expires = fetch_slack_identity(propel_id)
+    except UncachedSlackIdentity as e:
+        return e.slack_user
+    # Callers are free to change what they get back
+    return dict(slack_user)
+
+@dependency_cached(maxsize=5000, ttl=SLACK_IDENTITY_TTL)
+def fetch_slack_identity(propel_id):
+    record_dependency(SLACK_IDENTITY, propel_id)
+
     #TODO: Do we want to be using os.getenv here?
 
     url = f"{os.getenv('PROPEL_AUTH_URL')}/api/backend/v1/user/{propel_id}/oauth_token"
@@ -147,7 +182,17 @@ def get_slack_user_from_propel_user_id(propel_id):
     logger.debug(f"Propel RESP JSON: {json}")
     
     slack_token = json['slack']['access_token']
-    return get_slack_user_from_token(slack_token)
+    slack_user = get_slack_user_from_token(slack_token)
+
+    # Only successful lookups are cached, and never past the token's own expiry
+    expires = time.time() + SLACK_IDENTITY_TTL
+    token_expires = json['slack'].get('expires_at_seconds')
+    if token_expires:
+        expires = min(expires, token_expires - SLACK_TOKEN_EXPIRY_MARGIN)
+    if slack_user is None or expires <= time.time():
+        raise UncachedSlackIdentity(slack_user)
+
+    return slack_user, expires
 
 def get_propel_user_details_by_id(propel_id):    
     slack_user = get_slack_user_from_propel_user_id(propel_id)    
@@ -187,8 +232,8 @@ def get_profile_by_db_id(id):
     return res    
     
 # 10 minute cache for 100 objects LRU
-@cached(cache=TTLCache(maxsize=100, ttl=600))
 @limits(calls=100, period=ONE_MINUTE)
+@dependency_cached(maxsize=100, ttl=600)
 def get_profile_metadata(propel_id):
     logger.debug("Profile Metadata")
     
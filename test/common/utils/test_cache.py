@@ -0,0 +1,306 @@
+import threading
+import time
+import pytest
+from common.exceptions import RateLimitExceededError
+from common.utils.cache import dependency_cached, invalidate_documents, record_dependency, record_collection_dependency, poll_shared_events, SingleFlight
+from common.utils.shared_cache import SQLiteSharedCache, NullSharedCache, set_shared_cache
+
+
+@pytest.fixture(autouse=True)
+def shared_cache(tmp_path):
+    backend = SQLiteSharedCache(str(tmp_path / "cache.sqlite3"))
+    previous = set_shared_cache(backend)
+    yield backend
+    set_shared_cache(previous)
+
+
+def test_invalidates_only_dependent_entries():
+    calls = []
+
+    @dependency_cached()
+    def get_team(team_id):
+        calls.append(team_id)
+        record_dependency("teams", team_id)
+        return {"id": team_id}
+
+    get_team("t1")
+    get_team("t2")
+    get_team("t1")
+    assert calls == ["t1", "t2"]
+
+    assert invalidate_documents(("teams", "t1")) == 1
+    get_team("t1")
+    get_team("t2")
+    assert calls == ["t1", "t2", "t1"]
+
+
+def test_nested_reads_pass_dependencies_up():
+    @dependency_cached()
+    def get_user(user_id):
+        record_dependency("users", user_id)
+        return {"id": user_id}
+
+    outer_calls = []
+
+    @dependency_cached()
+    def get_team_with_users(team_id):
+        outer_calls.append(team_id)
+        record_dependency("teams", team_id)
+        return {"id": team_id, "users": [get_user("u1")]}
+
+    # u1 is already cached when the outer read runs, its dependency must still be recorded
+    get_user("u1")
+    get_team_with_users("t1")
+    invalidate_documents(("users", "u1"))
+    get_team_with_users("t1")
+    assert outer_calls == ["t1", "t1"]
+
+
+def test_collection_dependency():
+    calls = []
+
+    @dependency_cached()
+    def find_hackathon(event_id):
+        calls.append(event_id)
+        record_collection_dependency("hackathons")
+        return {}
+
+    find_hackathon("2024_fall")
+    invalidate_documents(("teams", "t1"))
+    find_hackathon("2024_fall")
+    assert calls == ["2024_fall"]
+
+    invalidate_documents(("hackathons", "new"))
+    find_hackathon("2024_fall")
+    assert calls == ["2024_fall", "2024_fall"]
+
+
+def test_read_racing_a_write_is_not_cached():
+    calls = []
+
+    @dependency_cached()
+    def get_team(team_id):
+        calls.append(team_id)
+        record_dependency("teams", team_id)
+        # The team is written after we read it but before we return
+        invalidate_documents(("teams", team_id))
+        return {"id": team_id}
+
+    get_team("t1")
+    get_team("t1")
+    assert calls == ["t1", "t1"]
+
+
+def test_other_workers_reuse_shared_entries(shared_cache):
+    calls = []
+
+    @dependency_cached()
+    def get_team(team_id):
+        calls.append(team_id)
+        record_dependency("teams", team_id)
+        return {"id": team_id}
+
+    get_team("t1")
+    # Another worker starts with an empty in-process cache
+    get_team.cache.clear()
+    assert get_team("t1") == {"id": "t1"}
+    assert calls == ["t1"]
+
+    invalidate_documents(("teams", "t1"))
+    get_team.cache.clear()
+    get_team("t1")
+    assert calls == ["t1", "t1"]
+
+
+def test_invalidations_reach_other_workers(shared_cache):
+    calls = []
+
+    @dependency_cached()
+    def get_team(team_id):
+        calls.append(team_id)
+        record_dependency("teams", team_id)
+        return {"id": team_id}
+
+    get_team("t1")
+    poll_shared_events(force=True)
+
+    # Another worker writes the team
+    other_worker = SQLiteSharedCache(shared_cache.path)
+    other_worker.invalidate({("teams", "t1"), ("teams", "*")}, [("teams", "t1")])
+
+    poll_shared_events(force=True)
+    get_team("t1")
+    assert calls == ["t1", "t1"]
+
+
+def test_own_events_are_skipped_from_every_thread(shared_cache):
+    thread = threading.Thread(target=shared_cache.invalidate, args=({("teams", "t1")}, [("teams", "t1")]))
+    thread.start()
+    thread.join()
+    events, _ = shared_cache.poll(0)
+    assert events == []
+
+
+def test_works_without_shared_cache():
+    set_shared_cache(NullSharedCache())
+    calls = []
+
+    @dependency_cached()
+    def get_team(team_id):
+        calls.append(team_id)
+        return {"id": team_id}
+
+    get_team("t1")
+    get_team("t1")
+    assert calls == ["t1"]
+
+
+def test_stale_while_revalidate(monkeypatch):
+    calls = []
+
+    @dependency_cached(ttl=600, refresh_after=60)
+    def get_npo_list():
+        calls.append(len(calls))
+        record_collection_dependency("nonprofits")
+        return {"version": len(calls)}
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert get_npo_list() == {"version": 1}
+
+    # Past the soft TTL the old payload is served while a background thread refreshes it
+    now += 120
+    assert get_npo_list() == {"version": 1}
+    for thread in threading.enumerate():
+        if thread.name.startswith("refresh "):
+            thread.join()
+    assert get_npo_list() == {"version": 2}
+    assert len(calls) == 2
+
+    # Writes still evict right away
+    invalidate_documents(("nonprofits", "npo1"))
+    assert get_npo_list() == {"version": 3}
+
+
+def test_concurrent_misses_are_coalesced():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    @dependency_cached()
+    def get_single_hackathon_event(event_id):
+        calls.append(event_id)
+        started.set()
+        release.wait(5)
+        record_dependency("hackathons", "h1")
+        return {"id": "h1"}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get_single_hackathon_event("2024_fall"))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Give the other callers time to start waiting on the first one
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ["2024_fall"]
+    assert results == [{"id": "h1"}] * 5
+
+
+def test_single_flight_shares_errors():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    def call():
+        try:
+            flight.do("key", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    first = threading.Thread(target=call)
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=call)
+    second.start()
+    time.sleep(0.1)
+    release.set()
+    first.join()
+    second.join()
+
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+
+
+def test_single_flight_does_not_share_rate_limit_errors():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def limited():
+        calls.append(threading.current_thread().name)
+        if len(calls) == 1:
+            started.set()
+            release.wait(5)
+            raise RateLimitExceededError()
+        return "ok"
+
+    def call():
+        try:
+            results.append(flight.do("key", limited))
+        except RateLimitExceededError as e:
+            results.append(e)
+
+    first = threading.Thread(target=call)
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=call)
+    second.start()
+    time.sleep(0.1)
+    release.set()
+    first.join()
+    second.join()
+
+    # The caller that waited made its own call instead of getting the leader's rate limit error
+    assert len(calls) == 2
+    assert isinstance(results[0], RateLimitExceededError)
+    assert results[1] == "ok"
+
+
+def test_get_many_fills_and_uses_the_per_key_cache():
+    calls = []
+
+    @dependency_cached(key=lambda id: id)
+    def get_team(id):
+        calls.append(id)
+        record_dependency("teams", id)
+        return {"id": id}
+
+    loads = []
+
+    def load_teams(missing_ids):
+        loads.append(missing_ids)
+        return {id: ({"id": id}, {("teams", id)}) for id in missing_ids}
+
+    get_team("t1")
+    assert get_team.get_many(["t1", "t2", "t3"], load_teams) == {"t1": {"id": "t1"}, "t2": {"id": "t2"}, "t3": {"id": "t3"}}
+    assert loads == [["t2", "t3"]]
+
+    # Batch loaded teams are cached for single calls, and invalidated like them
+    get_team("t2")
+    assert calls == ["t1"]
+    invalidate_documents(("teams", "t2"))
+    get_team("t2")
+    assert calls == ["t1", "t2"]
@@ -0,0 +1,66 @@
+from common.utils.doc_cache import DocumentCache, estimate_size
+
+
+def test_keys_include_collection():
+    cache = DocumentCache()
+    cache.set("teams", "abc", {"name": "team"})
+    cache.set("users", "abc", {"name": "user"})
+
+    assert cache.get("teams", "abc")["name"] == "team"
+    assert cache.get("users", "abc")["name"] == "user"
+
+
+def test_counters_and_invalidation():
+    cache = DocumentCache()
+    cache.set("teams", "t1", {"name": "one"})
+    cache.set("teams", "t2", {"name": "two"})
+
+    assert cache.get("teams", "t1") is not None
+    assert cache.get("teams", "missing") is None
+    assert cache.invalidate("teams", "t1")
+    assert cache.get("teams", "t1") is None
+    assert cache.get("teams", "t2") is not None
+
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["entries"] == 1
+
+
+def test_bounded_by_bytes():
+    doc = {"description": "x" * 1000}
+    cache = DocumentCache(max_bytes=estimate_size(doc) * 3)
+    for i in range(10):
+        cache.set("nonprofits", str(i), doc)
+
+    stats = cache.stats()
+    assert stats["entries"] == 3
+    assert stats["evictions"] == 7
+    assert stats["bytes"] <= stats["max_bytes"]
+    # Least recently used entries are evicted first
+    assert cache.get("nonprofits", "9") is not None
+    assert cache.get("nonprofits", "0") is None
+
+
+def test_too_large_documents_are_not_cached():
+    cache = DocumentCache(max_bytes=100)
+    cache.set("nonprofits", "big", {"description": "x" * 1000})
+    assert cache.get("nonprofits", "big") is None
+
+
+def test_returned_documents_are_copies():
+    cache = DocumentCache()
+    cache.set("teams", "t1", {"name": "one"})
+    cache.get("teams", "t1")["name"] = "changed"
+    assert cache.get("teams", "t1")["name"] == "one"
+
+
+def test_nested_values_are_copied_too():
+    cache = DocumentCache()
+    team = {"users": ["u1"], "history": {"how": {"code_quality": 1}}}
+    cache.set("teams", "t1", team)
+    team["users"].append("u2")
+    cached = cache.get("teams", "t1")
+    cached["users"].append("u3")
+    cached["history"]["how"]["code_quality"] = 5
+    assert cache.get("teams", "t1") == {"users": ["u1"], "history": {"how": {"code_quality": 1}}}
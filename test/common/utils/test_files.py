@@ -0,0 +1,30 @@
+import os
+import pytest
+from common.utils.files import replace_when_written
+
+
+def test_the_file_appears_whole_once_written(tmp_path):
+    path = str(tmp_path / "stats.json")
+    with open(path, "w") as f:
+        f.write("old")
+
+    with replace_when_written(path) as partial:
+        with open(partial, "w") as f:
+            f.write("new")
+        with open(path) as f:
+            assert f.read() == "old"
+
+    with open(path) as f:
+        assert f.read() == "new"
+    assert os.listdir(tmp_path) == ["stats.json"]
+
+
+def test_nothing_is_left_behind_when_writing_fails(tmp_path):
+    path = str(tmp_path / "background.png")
+    with pytest.raises(OSError):
+        with replace_when_written(path) as partial:
+            with open(partial, "w") as f:
+                f.write("half")
+            raise OSError("download interrupted")
+
+    assert os.listdir(tmp_path) == []
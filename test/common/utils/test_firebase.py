@@ -44,4 +44,58 @@ def test_add_hearts_customer_driven_innovation_and_design_thinking_for_user():
     add_hearts_for_user("test", 1, "customer_driven_innovation_and_design_thinking")
     
     assert db.collection("users").document("test").get().to_dict()[
-        "history"]["how"]["customer_driven_innovation_and_design_thinking"] == 2
\ No newline at end of file
+        "history"]["how"]["customer_driven_innovation_and_design_thinking"] == 2
+
+def test_award_hearts_to_users_in_one_commit():
+    db = get_db()
+    db.collection("users").document("u1").set({"name": "Ada", "history": {"how": {"code_reliability": 1}}})
+    db.collection("users").document("u2").set({"name": "Grace"})
+
+    award_hearts_to_users([
+        ("u1", 1, ["code_reliability", "judge"]),
+        ("u2", 0.5, ["mentor"]),
+        ("u1", 2, ["code_reliability"]),
+    ])
+
+    assert db.collection("users").document("u1").get().to_dict()["history"] == {
+        "how": {"code_reliability": 4}, "what": {"judge": 1}}
+    assert db.collection("users").document("u2").get().to_dict()["history"] == {"what": {"mentor": 0.5}}
+
+
+def test_award_hearts_writes_nothing_if_a_user_is_missing():
+    db = get_db()
+    db.collection("users").document("u1").set({"name": "Ada", "history": {}})
+
+    with pytest.raises(Exception):
+        award_hearts_to_users([("u1", 1, ["judge"]), ("missing", 1, ["judge"])])
+    assert db.collection("users").document("u1").get().to_dict()["history"] == {}
+
+
+def test_committed_heart_awards_are_invalidated_when_a_later_commit_fails(monkeypatch):
+    db = get_db()
+    db.collection("users").document("u1").set({"name": "Ada", "history": {}})
+    invalidated = []
+    monkeypatch.setattr("common.utils.firebase.MAX_USERS_PER_HEART_AWARD", 1)
+    monkeypatch.setattr("common.utils.firebase.invalidate_documents", lambda *documents: invalidated.extend(documents))
+
+    with pytest.raises(Exception):
+        award_hearts_to_users([("u1", 1, ["judge"]), ("missing", 1, ["judge"])])
+    assert db.collection("users").document("u1").get().to_dict()["history"] == {"what": {"judge": 1}}
+    assert ("users", "u1") in invalidated
+
+
+def test_user_lookups_use_the_user_index(monkeypatch):
+    db = get_db()
+    db.reset()
+    db.collection("users").document("u1").set({"user_id": "oauth2|slack|T1Q7936BH-U1", "email_address": "ada@example.org", "name": "Ada"})
+
+    assert get_user_by_user_id("U1")["id"] == "u1"
+    assert get_user_by_email("ada@example.org")["id"] == "u1"
+
+    queries = []
+    where = db.collection("users").__class__.where
+    monkeypatch.setattr(db.collection("users").__class__, "where", lambda self, *args: queries.append(args) or where(self, *args))
+    assert get_user_by_user_id("U1")["name"] == "Ada"
+    assert get_user_by_email("ada@example.org")["name"] == "Ada"
+    assert get_user_by_user_id("U404") is None
+    assert len(queries) == 1
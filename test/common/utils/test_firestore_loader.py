@@ -0,0 +1,61 @@
+from mockfirestore import MockFirestore
+import pytest
+
+from common.utils.firestore_loader import DocumentLoader, parse_expand_spec
+
+
+@pytest.fixture
+def db():
+    db = MockFirestore()
+    db.collection("users").document("u1").set({"name": "Ada"})
+    db.collection("users").document("u2").set({"name": "Grace"})
+    users = db.collection("users")
+    db.collection("teams").document("t1").set({"name": "Team 1", "users": [users.document("u1"), users.document("u2")]})
+    db.collection("teams").document("t2").set({"name": "Team 2", "users": [users.document("u1")]})
+    teams = db.collection("teams")
+    db.collection("nonprofits").document("n1").set({"name": "NPO"})
+    db.collection("hackathons").document("h1").set({
+        "title": "Hack",
+        "teams": [teams.document("t1"), teams.document("t2"), teams.document("missing")],
+        "nonprofits": [db.collection("nonprofits").document("n1")],
+    })
+    return db
+
+
+def test_parse_expand_spec():
+    assert parse_expand_spec(["nonprofits.problem_statements", "teams", "teams.users"]) == {
+        "nonprofits": {"problem_statements": {}},
+        "teams": {"users": {}},
+    }
+
+
+def test_load_expands_breadth_first_with_one_round_trip_per_level(db):
+    loader = DocumentLoader(db)
+    hackathon = loader.load(db.collection("hackathons").document("h1"), expand=["teams.users", "nonprofits"])
+
+    # hackathon, then teams + nonprofits, then users
+    assert loader.round_trips == 3
+    assert hackathon["id"] == "h1"
+    assert [t["id"] for t in hackathon["teams"]] == ["t1", "t2"]
+    assert [u["name"] for u in hackathon["teams"][0]["users"]] == ["Ada", "Grace"]
+    assert hackathon["teams"][1]["users"][0]["name"] == "Ada"
+    assert hackathon["nonprofits"][0]["name"] == "NPO"
+
+
+def test_unexpanded_references_become_ids(db):
+    loader = DocumentLoader(db)
+    hackathon = loader.load(db.collection("hackathons").document("h1"))
+
+    assert hackathon["teams"] == ["t1", "t2", "missing"]
+    assert hackathon["nonprofits"] == ["n1"]
+
+
+def test_identity_map_reuses_fetched_documents(db):
+    loader = DocumentLoader(db)
+    loader.load(db.collection("teams").document("t1"), expand=["users"])
+    round_trips = loader.round_trips
+
+    team = loader.load(db.collection("teams").document("t1"), expand=["users"])
+
+    assert loader.round_trips == round_trips
+    assert len(team["users"]) == 2
@@ -0,0 +1,93 @@
+import time
+import pytest
+from common.utils import outbox
+from common.utils.outbox import Outbox, PermanentError, task, enqueue, run_pending, set_outbox
+
+calls = []
+
+
+@task("test.record")
+def record(value):
+    calls.append(value)
+
+
+@task("test.flaky")
+def flaky(value):
+    calls.append(value)
+    if len(calls) < 3:
+        raise ConnectionError("slack is down")
+
+
+@task("test.broken")
+def broken():
+    calls.append("broken")
+    raise PermanentError("channel_not_found")
+
+
+@pytest.fixture(autouse=True)
+def queue(tmp_path, monkeypatch):
+    calls.clear()
+    box = Outbox(str(tmp_path / "outbox.sqlite3"))
+    previous = set_outbox(box)
+    # Queue jobs without starting real worker threads, the tests drain them with run_pending()
+    monkeypatch.setattr(outbox, "_workers_pid", -1)
+    monkeypatch.setattr(outbox, "_ensure_workers", lambda: None)
+    yield box
+    set_outbox(previous)
+
+
+def test_enqueue_returns_before_running():
+    enqueue("test.record", value="hello")
+    assert calls == []
+    assert run_pending() == 1
+    assert calls == ["hello"]
+    assert run_pending() == 0
+
+
+def test_failed_jobs_are_retried_with_backoff(queue, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    enqueue("test.flaky", value="x")
+
+    run_pending()
+    assert calls == ["x"]
+    # Not due again until the backoff has passed
+    assert run_pending() == 0
+
+    now += 60
+    run_pending()
+    now += 60
+    run_pending()
+    assert calls == ["x", "x", "x"]
+    assert queue.counts() == {}
+
+
+def test_permanent_errors_are_not_retried(queue):
+    enqueue("test.broken")
+    run_pending()
+    assert calls == ["broken"]
+    assert queue.counts() == {"failed": 1}
+
+
+def test_gives_up_after_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(outbox, "MAX_ATTEMPTS", 1)
+    enqueue("test.flaky", value="x")
+    run_pending()
+    assert queue.counts() == {"failed": 1}
+
+
+def test_jobs_of_a_dead_worker_are_picked_up_again(queue, monkeypatch):
+    enqueue("test.record", value="hello")
+    assert queue.claim(["test.record"]) is not None
+    assert run_pending() == 0
+
+    now = time.time() + outbox.STALE_RUNNING_SECONDS + 1
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert run_pending() == 1
+    assert calls == ["hello"]
+
+
+def test_runs_inline_without_workers(monkeypatch):
+    monkeypatch.setattr(outbox, "_workers_pid", None)
+    enqueue("test.record", value="hello")
+    assert calls == ["hello"]
@@ -0,0 +1,46 @@
+import pytest
+from flask import Flask
+from common.exceptions import RateLimitExceededError
+from common.utils.rate_limit import limits, MemoryRateLimitBackend, SQLiteRateLimitBackend, set_rate_limit_backend
+
+app = Flask(__name__)
+
+
+@pytest.fixture(params=["memory", "sqlite"], autouse=True)
+def backend(request, tmp_path):
+    backend = MemoryRateLimitBackend() if request.param == "memory" else SQLiteRateLimitBackend(str(tmp_path / "rate.sqlite3"))
+    previous = set_rate_limit_backend(backend)
+    yield backend
+    set_rate_limit_backend(previous)
+
+
+@limits(calls=2, period=60)
+def get_npo_list():
+    return {"nonprofits": []}
+
+
+def call_as(ip):
+    with app.test_request_context("/api/messages/npos", headers={"X-Forwarded-For": f"1.2.3.4, {ip}"}):
+        return get_npo_list()
+
+
+def test_raises_with_retry_after_past_the_limit():
+    call_as("10.0.0.1")
+    call_as("10.0.0.1")
+    with pytest.raises(RateLimitExceededError) as e:
+        call_as("10.0.0.1")
+    assert 0 < e.value.retry_after <= 30
+
+
+def test_clients_have_their_own_budget():
+    for _ in range(2):
+        call_as("10.0.0.1")
+    assert call_as("10.0.0.2") == {"nonprofits": []}
+
+
+def test_budget_is_shared_by_workers(tmp_path):
+    path = str(tmp_path / "rate.sqlite3")
+    worker_1 = SQLiteRateLimitBackend(path)
+    worker_2 = SQLiteRateLimitBackend(path)
+    assert worker_1.try_acquire("ip:10.0.0.1|npos", rate=1 / 60, capacity=1) == 0
+    assert worker_2.try_acquire("ip:10.0.0.1|npos", rate=1 / 60, capacity=1) > 0
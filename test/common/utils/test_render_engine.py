@@ -0,0 +1,96 @@
+import os
+import threading
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+from common.utils.render_engine import RenderEngine, in_render_process
+
+
+def render(item):
+    if item == "broken":
+        raise ValueError("can't draw this")
+    return f"{item}.png", os.getpid()
+
+
+@pytest.fixture(params=[2, 0])
+def engine(request):
+    return RenderEngine(processes=request.param, upload_threads=4)
+
+
+def test_renders_in_other_processes_and_publishes_in_order(engine):
+    published = []
+
+    def publish(item, rendered):
+        published.append(threading.current_thread().name)
+        filename, pid = rendered
+        return filename, pid != os.getpid()
+
+    results = engine.map(render, publish, ["ada", "grace", "linus"])
+
+    assert [filename for filename, _ in results] == ["ada.png", "grace.png", "linus.png"]
+    assert all(in_other_process == (engine.processes > 0) for _, in_other_process in results)
+    assert all(name.startswith("render upload") for name in published)
+
+
+def test_errors_are_raised_after_the_rest_finish(engine):
+    published = []
+    with pytest.raises(ValueError):
+        engine.map(render, lambda item, rendered: published.append(item), ["ada", "broken", "grace"])
+    assert sorted(published) == ["ada", "grace"]
+
+
+def test_render_returns_the_result(engine):
+    assert engine.render(render, "ada")[0] == "ada.png"
+
+
+warmed = []
+
+
+def warm():
+    warmed.append(os.getpid())
+
+
+def read_warmed(item):
+    return list(warmed), in_render_process(), os.getpid()
+
+
+def test_warmers_run_in_every_render_process_as_it_starts():
+    engine = RenderEngine(processes=2, upload_threads=4)
+    engine.warm_in_render_processes(warm)
+
+    render_warmed, render_process, pid = engine.render(read_warmed, "ada")
+    assert render_warmed == [pid] and render_process
+    assert warmed == [] and not in_render_process()
+
+
+def test_warmers_must_be_module_level_functions():
+    with pytest.raises(Exception):
+        RenderEngine(processes=2).warm_in_render_processes(lambda: None)
+
+
+def die_once(marker):
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return "rendered"
+
+
+def die(item):
+    os._exit(1)
+
+
+def test_renders_are_retried_on_new_processes_when_theirs_die(tmp_path):
+    engine = RenderEngine(processes=1, upload_threads=4)
+    engine.render(render, "ada")
+    broken, _ = engine._pools()
+
+    assert engine.render(die_once, str(tmp_path / "died")) == "rendered"
+    assert engine._pools()[0] is not broken
+    # The management thread of the dead pool was shut down along with it
+    assert broken._shutdown_thread
+
+
+def test_renders_that_keep_killing_their_process_fail():
+    engine = RenderEngine(processes=1, upload_threads=4)
+    with pytest.raises(BrokenProcessPool):
+        engine.render(die, "ada")
+    assert engine.render(render, "ada")[0] == "ada.png"
@@ -0,0 +1,255 @@
+import threading
+from slack_sdk.errors import SlackApiError
+from common.utils import slack
+
+
+class FakeClient:
+    def __init__(self, pages):
+        self.pages = pages
+        self.list_calls = 0
+        self.created = []
+        self.joins = []
+        self.invites = []
+
+    def conversations_list(self, exclude_archived=True, limit=1000, cursor=None):
+        self.list_calls += 1
+        index = int(cursor) if cursor else 0
+        next_cursor = str(index + 1) if index + 1 < len(self.pages) else ""
+        return {"channels": self.pages[index], "response_metadata": {"next_cursor": next_cursor}}
+
+    def conversations_join(self, channel):
+        self.joins.append(channel)
+
+    def conversations_invite(self, channel, users, force=False):
+        self.invites.append((channel, users))
+
+    def conversations_create(self, name):
+        self.created.append(name)
+        return {"channel": {"id": "CNEW", "name": name}}
+
+
+def use_client(monkeypatch, client):
+    monkeypatch.setattr(slack, "get_client", lambda: client)
+    slack.channel_directory.clear()
+
+
+def test_channel_directory_reads_every_page_once(monkeypatch):
+    client = FakeClient([
+        [{"name": "general", "id": "C1"}],
+        [{"name": "log-team-creation", "id": "C2"}],
+    ])
+    use_client(monkeypatch, client)
+
+    assert slack.get_channel_id_from_channel_name("log-team-creation") == "C2"
+    assert slack.get_channel_id_from_channel_name("general") == "C1"
+    assert client.list_calls == 2
+
+
+def test_created_channels_are_added_without_relisting(monkeypatch):
+    client = FakeClient([[{"name": "general", "id": "C1"}]])
+    use_client(monkeypatch, client)
+
+    assert slack.create_slack_channel("team-rocket") == "CNEW"
+    assert slack.get_channel_id_from_channel_name("team-rocket") == "CNEW"
+    assert client.list_calls == 1
+
+
+def test_channels_are_looked_up_while_the_workspace_is_listed(monkeypatch):
+    client = FakeClient([[{"name": "general", "id": "C1"}]])
+    use_client(monkeypatch, client)
+    slack.get_channel_id_from_channel_name("general")
+
+    listing = threading.Event()
+    release = threading.Event()
+
+    def slow_conversations_list(exclude_archived=True, limit=1000, cursor=None):
+        listing.set()
+        release.wait(5)
+        return {"channels": [{"name": "general", "id": "C1"}, {"name": "team-rocket", "id": "C2"}],
+                "response_metadata": {}}
+
+    monkeypatch.setattr(client, "conversations_list", slow_conversations_list)
+    # Long enough ago that a name we don't know re-lists the workspace
+    slack.channel_directory._loaded_at -= slack.CHANNEL_DIRECTORY_MISS_REFRESH + 1
+    refresh = threading.Thread(target=lambda: slack.get_channel_id_from_channel_name("team-rocket"))
+    refresh.start()
+    try:
+        assert listing.wait(5)
+        found = []
+        reader = threading.Thread(target=lambda: found.append(slack.get_channel_id_from_channel_name("general")))
+        reader.start()
+        reader.join(1)
+        assert found == ["C1"]
+        # Created while the listing that started before it is still running
+        slack.channel_directory.add("team-jets", "C3")
+    finally:
+        release.set()
+        refresh.join()
+    assert slack.get_channel_id_from_channel_name("team-rocket") == "C2"
+    assert slack.get_channel_id_from_channel_name("team-jets") == "C3"
+
+
+def test_archived_channel_names_are_not_created_again(monkeypatch):
+    client = FakeClient([[{"name": "general", "id": "C1"}, {"name": "team-rocket", "id": "C2", "is_archived": True}]])
+    use_client(monkeypatch, client)
+
+    assert slack.get_channel_id_from_channel_name("team-rocket") is None
+    assert slack.create_slack_channel("team-rocket") is None
+    assert client.created == []
+
+
+def test_taken_channel_names_are_reported(monkeypatch):
+    client = FakeClient([[{"name": "general", "id": "C1"}]])
+    use_client(monkeypatch, client)
+
+    def name_taken(name):
+        raise SlackApiError("name_taken", {"ok": False, "error": "name_taken"})
+
+    monkeypatch.setattr(client, "conversations_create", name_taken)
+    assert slack.create_slack_channel("team-secret") is None
+
+
+def test_user_ids_are_not_looked_up(monkeypatch):
+    client = FakeClient([[{"name": "general", "id": "C1"}]])
+    use_client(monkeypatch, client)
+
+    assert slack.get_channel_id_from_channel_name("U041117EYTQ") is None
+    assert client.list_calls == 0
+
+
+def test_invite_users_joins_once_and_invites_in_one_call(monkeypatch):
+    client = FakeClient([[{"name": "team-rocket", "id": "C1"}]])
+    use_client(monkeypatch, client)
+
+    slack.invite_users_to_channel(["oauth2|slack|T1Q7936BH-U1", "U2", "U3", "U2"], "team-rocket")
+
+    assert client.joins == ["C1"]
+    assert client.invites == [("C1", "U1,U2,U3")]
+
+
+def test_invites_are_chunked(monkeypatch):
+    client = FakeClient([[{"name": "team-rocket", "id": "C1"}]])
+    use_client(monkeypatch, client)
+    monkeypatch.setattr(slack, "MAX_USERS_PER_INVITE", 2)
+
+    slack.invite_users_to_channel(["U1", "U2", "U3"], "team-rocket")
+
+    assert client.invites == [("C1", "U1,U2"), ("C1", "U3")]
+
+
+class FakeUsersClient:
+    def __init__(self, pages):
+        self.pages = pages
+        self.list_calls = 0
+        self.info_calls = []
+
+    def users_list(self, limit=200, cursor=None):
+        self.list_calls += 1
+        index = int(cursor) if cursor else 0
+        next_cursor = str(index + 1) if index + 1 < len(self.pages) else ""
+        return {"members": self.pages[index], "response_metadata": {"next_cursor": next_cursor}}
+
+    def users_info(self, user):
+        self.info_calls.append(user)
+        return {"user": member(user)}
+
+
+def member(user_id):
+    return {"id": user_id, "name": user_id.lower(), "real_name": f"Real {user_id}", "profile": {"display_name": user_id}}
+
+
+def test_profiles_are_warmed_from_users_list_and_persisted(monkeypatch, tmp_path):
+    client = FakeUsersClient([[member("U1")], [member("U2")]])
+    monkeypatch.setattr(slack, "get_client", lambda: client)
+    path = str(tmp_path / "profiles.sqlite3")
+    monkeypatch.setattr(slack, "slack_profiles", slack.SlackProfileCache(path))
+
+    profiles = slack.get_user_info(["U1", "U2"])
+    assert profiles["U2"]["real_name"] == "Real U2"
+    assert client.list_calls == 2
+    assert client.info_calls == []
+
+    # A restarted worker reads them back without calling Slack
+    monkeypatch.setattr(slack, "slack_profiles", slack.SlackProfileCache(path))
+    assert slack.get_user_info(["U1"])["U1"]["name"] == "u1"
+    assert client.list_calls == 2
+
+
+def test_unknown_profiles_are_looked_up_alone(monkeypatch, tmp_path):
+    client = FakeUsersClient([[member("U1")]])
+    monkeypatch.setattr(slack, "get_client", lambda: client)
+    monkeypatch.setattr(slack, "slack_profiles", slack.SlackProfileCache(str(tmp_path / "profiles.sqlite3")))
+
+    slack.get_user_info(["U1"])
+    assert set(slack.get_user_info(["U1", "UEXTERNAL"])) == {"U1", "UEXTERNAL"}
+    assert client.list_calls == 1
+    assert client.info_calls == ["UEXTERNAL"]
+
+
+def test_failed_lookups_are_not_repeated(monkeypatch, tmp_path):
+    client = FakeUsersClient([[member("U1")]])
+    monkeypatch.setattr(slack, "get_client", lambda: client)
+    monkeypatch.setattr(slack, "slack_profiles", slack.SlackProfileCache(str(tmp_path / "profiles.sqlite3")))
+    monkeypatch.setattr(slack, "rate_limited_get_user_info", lambda user_id: client.info_calls.append(user_id))
+
+    assert set(slack.get_user_info(["U1", "UGONE"])) == {"U1"}
+    assert set(slack.get_user_info(["U1", "UGONE"])) == {"U1"}
+    assert client.info_calls == ["UGONE"]
+
+
+def test_profiles_are_served_while_the_workspace_is_listed(monkeypatch, tmp_path):
+    client = FakeUsersClient([[member("U1")]])
+    monkeypatch.setattr(slack, "get_client", lambda: client)
+    profiles = slack.SlackProfileCache(str(tmp_path / "profiles.sqlite3"))
+    monkeypatch.setattr(slack, "slack_profiles", profiles)
+    slack.get_user_info(["U1"])
+
+    listing = threading.Event()
+    release = threading.Event()
+
+    def slow_users_list(limit=200, cursor=None):
+        listing.set()
+        release.wait(5)
+        return {"members": [member("U1"), member("U2")], "response_metadata": {}}
+
+    monkeypatch.setattr(client, "users_list", slow_users_list)
+    refresh = threading.Thread(target=profiles.warm)
+    refresh.start()
+    try:
+        assert listing.wait(5)
+        served = []
+        reader = threading.Thread(target=lambda: served.append(slack.get_user_info(["U1"])))
+        reader.start()
+        reader.join(1)
+        assert served and set(served[0]) == {"U1"}
+    finally:
+        release.set()
+        refresh.join()
+    assert set(slack.get_user_info(["U1", "U2"])) == {"U1", "U2"}
+
+
+class FakePresenceClient(FakeUsersClient):
+    def __init__(self, pages, online):
+        super().__init__(pages)
+        self.online = online
+        self.presence_calls = []
+
+    def users_getPresence(self, user):
+        self.presence_calls.append(user)
+        return {"presence": "active" if user in self.online else "away"}
+
+
+def test_presence_scan_skips_deleted_users_and_bots_and_caches(monkeypatch):
+    human = dict(member("U1"), updated=0)
+    away = dict(member("U2"), updated=0)
+    deleted = dict(member("U3"), deleted=True)
+    bot = dict(member("B1"), is_bot=True)
+    client = FakePresenceClient([[human, deleted], [bot, away]], online={"U1"})
+    monkeypatch.setattr(slack, "get_client", lambda: client)
+    monkeypatch.setattr(slack, "presence_scanner", slack.PresenceScanner(calls_per_minute=6000, workers=2))
+
+    assert dict((m["id"], p) for m, p in slack.presence_scanner.scan()) == {"U1": "active", "U2": "away"}
+    assert sorted(client.presence_calls) == ["U1", "U2"]
+
+    assert len(slack.get_active_users()) == 1
+    assert sorted(client.presence_calls) == ["U1", "U2"]
@@ -0,0 +1,104 @@
+import pytest
+import sys
+sys.path.append("../../")
+from dotenv import load_dotenv
+load_dotenv()
+
+from db.firestore import FirestoreDatabaseInterface, fetch_all_by_id
+
+
+@pytest.fixture
+def db_interface():
+    interface = FirestoreDatabaseInterface()
+    interface.get_db().reset()
+    return interface
+
+
+def test_fetch_all_by_id_dedupes_and_skips_missing(db_interface):
+    db = db_interface.get_db()
+    db.collection("nonprofits").document("npo1").set({"name": "NPO 1"})
+
+    refs = [
+        db.collection("nonprofits").document("npo1"),
+        db.collection("nonprofits").document("npo1"),
+        db.collection("nonprofits").document("missing"),
+    ]
+    docs = fetch_all_by_id(db, refs)
+
+    assert list(docs.keys()) == ["npo1"]
+    assert docs["npo1"].to_dict()["name"] == "NPO 1"
+
+
+def test_get_user_profile_resolves_one_get_all_per_level(db_interface, monkeypatch):
+    db = db_interface.get_db()
+    db.collection("nonprofits").document("npo1").set({"name": "NPO 1", "problem_statements": []})
+    db.collection("nonprofits").document("npo2").set({"name": "NPO 2"})
+    npo1 = db.collection("nonprofits").document("npo1")
+    npo2 = db.collection("nonprofits").document("npo2")
+    for h in ["h1", "h2"]:
+        db.collection("hackathons").document(h).set({
+            "title": h, "start_date": "2024-10-01", "end_date": "2024-10-02",
+            "nonprofits": [npo1, npo2]
+        })
+    db.collection("users").document("u1").set({
+        "email_address": "a@b.c", "last_login": "", "user_id": "slack", "profile_image": "",
+        "hackathons": [db.collection("hackathons").document("h1"), db.collection("hackathons").document("h2")]
+    })
+
+    calls = []
+    original_get_all = db.get_all
+    def counting_get_all(refs, *args, **kwargs):
+        calls.append(len(refs))
+        return original_get_all(refs, *args, **kwargs)
+    monkeypatch.setattr(db, "get_all", counting_get_all)
+
+    user = db_interface.get_user_profile_by_db_id("u1")
+
+    assert calls == [2, 2]
+    assert [h.id for h in user.hackathons] == ["h1", "h2"]
+    assert [n["name"] for n in user.hackathons[0].nonprofits] == ["NPO 1", "NPO 2"]
+    assert "problem_statements" not in user.hackathons[0].nonprofits[0]
+
+
+def test_user_lookups_use_the_index(db_interface, monkeypatch):
+    db = db_interface.get_db()
+    db.collection("users").document("u1").set({"user_id": "oauth2|slack|T1Q7936BH-U1", "email_address": "a@b.c", "last_login": "", "profile_image": ""})
+
+    assert db_interface.fetch_user_by_user_id("U1").id == "u1"
+
+    # Later lookups are a get by id, not a query
+    def no_queries(*args, **kwargs):
+        raise AssertionError("where() should not be called")
+    monkeypatch.setattr(type(db.collection("users")), "where", no_queries)
+    assert db_interface.fetch_user_by_user_id("U1").id == "u1"
+    assert db_interface.fetch_user_by_email("a@b.c").id == "u1"
+
+
+def test_stale_index_entries_fall_back_to_the_query(db_interface):
+    db = db_interface.get_db()
+    db.collection("users").document("u1").set({"user_id": "oauth2|slack|T1Q7936BH-U1", "email_address": "a@b.c", "last_login": "", "profile_image": ""})
+    assert db_interface.fetch_user_by_user_id("U1").id == "u1"
+
+    # Another worker moves the Slack id to a new user document
+    db.collection("users").document("u1").delete()
+    db.collection("users").document("u2").set({"user_id": "oauth2|slack|T1Q7936BH-U1", "email_address": "a@b.c", "last_login": "", "profile_image": ""})
+
+    assert db_interface.fetch_user_by_user_id("U1").id == "u2"
+    assert db_interface.user_index.get_by_user_id("oauth2|slack|T1Q7936BH-U1") == "u2"
+
+
+def test_insert_and_delete_keep_the_index_consistent(db_interface):
+    from model.user import User
+    user = User()
+    user.user_id = "oauth2|slack|T1Q7936BH-U3"
+    user.email_address = "c@d.e"
+    user.last_login = ""
+    user.profile_image = ""
+    user.name = "Name"
+    user.nickname = "nick"
+    db_interface.insert_user(user)
+    assert db_interface.user_index.get_by_email("c@d.e") == user.id
+
+    db_interface.delete_user_by_db_id(user.id)
+    assert db_interface.user_index.get_by_user_id(user.user_id) is None
+    assert db_interface.fetch_user_by_user_id("U3") is None
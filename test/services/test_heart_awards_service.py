@@ -0,0 +1,69 @@
+import os
+import pytest
+from common.exceptions import InvalidInputError
+from common.utils.firebase import get_db
+from services import heart_awards_service, hearts_service
+
+
+def test_parse_csv():
+    awards = heart_awards_service.parse_heart_awards_csv(
+        "slackUsername,amount,reasons\nU1,1,code_quality;documentation\nU2,0.5,judge\n")
+    assert awards == [
+        {"slackUsername": "U1", "amount": 1, "reasons": ["code_quality", "documentation"]},
+        {"slackUsername": "U2", "amount": 0.5, "reasons": ["judge"]},
+    ]
+
+
+def test_invalid_reasons_are_rejected_up_front():
+    with pytest.raises(InvalidInputError):
+        heart_awards_service.validate_heart_awards([{"slackUsername": "U1", "amount": 1, "reasons": ["naps"]}])
+
+
+@pytest.mark.parametrize("amount", [0, -1, 0.25, 1.5, "nan", "inf"])
+def test_amounts_must_be_whole_or_half_hearts(amount):
+    with pytest.raises(InvalidInputError):
+        heart_awards_service.validate_heart_awards([{"slackUsername": "U1", "amount": amount, "reasons": ["judge"]}])
+
+
+def test_certificates_use_the_bundled_background(monkeypatch):
+    get_db().reset()
+    rendered = []
+    monkeypatch.setattr(heart_awards_service, "get_user_by_user_id", lambda slack_user_id: {"id": "u1", "name": "Ada"})
+    monkeypatch.setattr(heart_awards_service, "award_hearts_to_users", lambda awards: None)
+    monkeypatch.setattr(heart_awards_service.render_engine, "render",
+                        lambda render, *args, background_path: rendered.append(background_path))
+    monkeypatch.setattr(hearts_service, "announce_hearts", lambda *args: None)
+
+    awards = heart_awards_service.validate_heart_awards([{"slackUsername": "U1", "amount": 1, "reasons": ["judge"]}])
+    heart_awards_service.BulkHeartAwardJob(awards).run()
+
+    # Whatever the working directory is
+    assert rendered == [hearts_service.BACKUP_BACKGROUND_LOC]
+    assert os.path.exists(rendered[0])
+
+
+def test_job_awards_in_batches_and_records_progress(monkeypatch):
+    get_db().reset()
+    users = {"U1": {"id": "u1", "name": "Ada"}, "U2": {"id": "u2", "name": "Grace"}}
+    commits = []
+    announced = []
+    monkeypatch.setattr(heart_awards_service, "get_user_by_user_id", users.get)
+    monkeypatch.setattr(heart_awards_service, "award_hearts_to_users", commits.append)
+    monkeypatch.setattr(hearts_service, "announce_hearts", lambda slack_user_id, *args: announced.append(slack_user_id))
+
+    awards = heart_awards_service.validate_heart_awards([
+        {"slackUsername": "U1", "amount": 1, "reasons": ["judge"]},
+        {"slackUsername": "U2", "amount": 2, "reasons": ["mentor", "judge"]},
+        {"slackUsername": "U404", "amount": 1, "reasons": ["judge"]},
+    ])
+    job = heart_awards_service.BulkHeartAwardJob(awards, create_certificate_image=False)
+    job.run()
+
+    assert len(commits) == 1
+    assert sorted(commits[0]) == [("u1", 1, ["judge"]), ("u2", 2, ["mentor", "judge"])]
+    assert sorted(announced) == ["U1", "U2"]
+
+    progress = heart_awards_service.get_bulk_heart_award(job.id)
+    assert progress["status"] == "done"
+    assert (progress["succeeded"], progress["failed"]) == (2, 1)
+    assert progress["errors"][0]["slackUsername"] == "U404"
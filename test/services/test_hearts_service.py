@@ -0,0 +1,127 @@
+import os
+import pytest
+from model.user import User
+from services import hearts_service
+from common.utils.firebase import get_db, add_hearts_for_user, start_hearts_leaderboard_rebuild, HEARTS_LEADERBOARD_ENTRY
+from common.utils.cache import clear_all, poll_shared_events
+from common.utils.shared_cache import SQLiteSharedCache, set_shared_cache
+
+
+def make_user(id, name, history):
+    return User.deserialize({"id": id, "email_address": "", "last_login": "", "user_id": f"U{id}",
+                             "profile_image": "", "name": name, "history": history})
+
+
+@pytest.fixture(autouse=True)
+def db(monkeypatch):
+    db = get_db()
+    db.reset()
+    clear_all()
+    scans = []
+
+    def fetch_users():
+        scans.append(1)
+        return [
+            make_user("u1", "Ada", {"how": {"code_reliability": 1}, "what": {"code_quality": 0.5}}),
+            make_user("u2", "Grace", {"how": {"code_reliability": 3}}),
+            make_user("u3", "Nobody", {}),
+        ]
+
+    monkeypatch.setattr(hearts_service, "fetch_users", fetch_users)
+    db.scans = scans
+    return db
+
+
+def test_leaderboard_is_built_once_and_sorted(db):
+    assert [h["slackUsername"] for h in hearts_service.get_hearts_for_all_users()] == ["Grace", "Ada"]
+    assert hearts_service.get_hearts_for_all_users(limit=1, offset=1)[0]["totalHearts"] == 1.5
+    assert hearts_service.count_hearts_for_all_users() == 2
+
+    # Other workers read the stored aggregate instead of scanning the users
+    clear_all()
+    hearts_service.get_hearts_for_all_users()
+    assert len(db.scans) == 1
+
+
+def test_awards_update_the_leaderboard(db):
+    hearts_service.get_hearts_for_all_users()
+    db.collection("users").document("u1").set({"name": "Ada", "history": {"how": {"code_reliability": 1}}})
+
+    add_hearts_for_user("u1", 4, "code_reliability")
+
+    top = hearts_service.get_hearts_for_all_users(limit=1)[0]
+    assert top["slackUsername"] == "Ada"
+    assert top["history"]["how"]["code_reliability"] == 5
+    assert len(db.scans) == 1
+
+
+def test_awards_made_during_a_rebuild_are_kept(db, monkeypatch):
+    db.collection("users").document("u1").set({"name": "Ada", "history": {"how": {"code_reliability": 1}}})
+    fetch_users = hearts_service.fetch_users
+
+    def award_while_reading():
+        users = fetch_users()
+        # After the rebuild read Ada's history, before it wrote her entry
+        add_hearts_for_user("u1", 4, "code_reliability")
+        return users
+
+    monkeypatch.setattr(hearts_service, "fetch_users", award_while_reading)
+
+    ada = [h for h in hearts_service.get_hearts_for_all_users() if h["slackUsername"] == "Ada"][0]
+    assert ada["history"]["how"]["code_reliability"] == 5
+
+
+def test_one_worker_rebuilds_at_a_time(db):
+    assert start_hearts_leaderboard_rebuild()
+
+    # Another worker finds the lease taken and serves what is there without scanning the users
+    assert hearts_service.get_hearts_for_all_users() == []
+    assert len(db.scans) == 0
+
+
+def test_awards_are_applied_without_reloading_the_leaderboard(db, monkeypatch):
+    hearts_service.get_hearts_for_all_users()
+    db.collection("users").document("u1").set({"name": "Ada", "history": {"how": {"code_reliability": 1}}})
+    monkeypatch.setattr(hearts_service, "get_hearts_leaderboard_entries",
+                        lambda *args, **kwargs: pytest.fail("the whole leaderboard was read again"))
+
+    add_hearts_for_user("u1", 4, "code_reliability")
+
+    assert [h["totalHearts"] for h in hearts_service.get_hearts_for_all_users()] == [5, 3]
+    assert hearts_service.count_hearts_for_all_users() == 2
+
+
+def test_awards_from_other_workers_are_applied(db, tmp_path):
+    backend = SQLiteSharedCache(str(tmp_path / "cache.sqlite3"))
+    previous = set_shared_cache(backend)
+    try:
+        hearts_service.get_hearts_for_all_users()
+        poll_shared_events(force=True)
+
+        # Another worker awards Ada, this one only learns of it through the shared cache
+        db.collection("leaderboards").document("hearts").collection("entries").document("u1").set(
+            {"slackUsername": "Ada", "totalHearts": 10})
+        other_worker = SQLiteSharedCache(backend.path)
+        other_worker.invalidate({(HEARTS_LEADERBOARD_ENTRY, "u1")}, [(HEARTS_LEADERBOARD_ENTRY, "u1")])
+        poll_shared_events(force=True)
+
+        assert [h["slackUsername"] for h in hearts_service.get_hearts_for_all_users()] == ["Ada", "Grace"]
+    finally:
+        set_shared_cache(previous)
+
+
+def test_certificate_backgrounds_are_generated_before_rendering(monkeypatch):
+    generated = []
+    rendered = []
+    monkeypatch.setattr(hearts_service, "generate_background_image", generated.append)
+    monkeypatch.setattr(hearts_service.render_engine, "render",
+                        lambda render, *args, background_path: rendered.append(background_path) or "cert.png")
+    monkeypatch.setattr(hearts_service, "publish_certificate", lambda userid, filename: None)
+
+    hearts_service.generate_certificate_image("u1", "Ada", ["judge"], 1, generate_backround_image=True)
+    hearts_service.generate_certificate_image("u1", "Ada", ["judge"], 1, generate_backround_image=True)
+
+    # Each certificate draws on its own background file, removed once it is rendered
+    assert rendered == generated
+    assert len(set(rendered)) == 2
+    assert not any(os.path.exists(path) for path in rendered)
@@ -0,0 +1,71 @@
+import time
+import pytest
+from common.utils.cache import poll_shared_events
+from common.utils.shared_cache import SQLiteSharedCache, set_shared_cache
+from services import users_service
+
+
+@pytest.fixture
+def shared_cache(tmp_path):
+    backend = SQLiteSharedCache(str(tmp_path / "cache.sqlite3"))
+    previous = set_shared_cache(backend)
+    yield backend
+    set_shared_cache(previous)
+
+
+class FakeResponse:
+    def __init__(self, json):
+        self._json = json
+
+    def json(self):
+        return self._json
+
+
+def fake_apis(monkeypatch, expires_at_seconds=None):
+    calls = []
+
+    def fake_get(url, headers=None):
+        calls.append(url)
+        if "oauth_token" in url:
+            return FakeResponse({"slack": {"access_token": "xoxp", "expires_at_seconds": expires_at_seconds}})
+        return FakeResponse({"ok": True, "sub": "U1", "email": "a@b.c"})
+
+    monkeypatch.setattr(users_service.requests, "get", fake_get)
+    users_service.invalidate_slack_identity()
+    return calls
+
+
+def test_slack_identity_is_cached_until_logout(monkeypatch):
+    calls = fake_apis(monkeypatch)
+
+    assert users_service.get_slack_user_from_propel_user_id("propel1")["sub"] == "oauth2|slack|T1Q7936BH-U1"
+    assert users_service.get_slack_user_from_propel_user_id("propel1")["sub"] == "oauth2|slack|T1Q7936BH-U1"
+    assert len(calls) == 2
+
+    users_service.invalidate_slack_identity("propel1")
+    users_service.get_slack_user_from_propel_user_id("propel1")
+    assert len(calls) == 4
+
+
+def test_slack_identity_is_not_cached_past_token_expiry(monkeypatch):
+    calls = fake_apis(monkeypatch, expires_at_seconds=time.time() + 30)
+
+    users_service.get_slack_user_from_propel_user_id("propel1")
+    users_service.get_slack_user_from_propel_user_id("propel1")
+    assert len(calls) == 4
+
+
+def test_logout_in_another_worker_evicts_the_identity(monkeypatch, shared_cache):
+    calls = fake_apis(monkeypatch)
+
+    users_service.get_slack_user_from_propel_user_id("propel1")
+    poll_shared_events(force=True)
+
+    # The user logs out through another worker
+    other_worker = SQLiteSharedCache(shared_cache.path)
+    other_worker.invalidate({(users_service.SLACK_IDENTITY, "propel1"), (users_service.SLACK_IDENTITY, "*")},
+                            [(users_service.SLACK_IDENTITY, "propel1")])
+
+    poll_shared_events(force=True)
+    users_service.get_slack_user_from_propel_user_id("propel1")
+    assert len(calls) == 4